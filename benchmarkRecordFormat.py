@@ -0,0 +1,54 @@
+import argparse
+import copy
+import hashlib
+import json
+import time
+import terminaltables
+
+from bleSimulator import generateRecords
+from recordFormat import prepareRecords, dumpsJson, _recordIdFromFields
+
+def legacyPipeline(recordsPerUser):
+    #the post-processing of main.py before prepareRecords: deepcopy, flatten, sort, md5 and strftime per record, generic json
+    normalized = copy.deepcopy(recordsPerUser)
+    allRecords = [record for userRecords in normalized for record in userRecords]
+    allRecords.sort(key = lambda record: record["datetime"], reverse = True)
+    for record in allRecords:
+        uniqueStr = f"{record['datetime'].strftime('%Y%m%d%H%M%S')}_{record['sys']}_{record['dia']}_{record['bpm']}"
+        record["id"] = hashlib.md5(uniqueStr.encode()).hexdigest()[:12]
+        record["datetime"] = record["datetime"].strftime("%Y-%m-%d %H:%M:%S")
+    return json.dumps({"records": allRecords}).encode("utf-8")
+
+def singlePassPipeline(recordsPerUser):
+    return dumpsJson({"records": prepareRecords(recordsPerUser)})
+
+def bestOf(function, recordsPerUser, repeat):
+    bestTime = float("inf")
+    for _ in range(repeat):
+        _recordIdFromFields.cache_clear()       #measure the cold id computation, not the memoized one
+        startTime = time.perf_counter()
+        function(recordsPerUser)
+        bestTime = min(bestTime, time.perf_counter() - startTime)
+    return bestTime
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the post-processing and serialization of record responses")
+    parser.add_argument("-n", "--records", type = int, action = "append", help = "records per user, can be repeated (default: 60, 10000, 100000)")
+    parser.add_argument("-u", "--users",   type = int, default = 2,       help = "number of users")
+    parser.add_argument("-r", "--repeat",  type = int, default = 5,       help = "runs per measurement, the best one is reported")
+    args = parser.parse_args()
+
+    tableEntries = [["RECORDS", "LEGACY [ms]", "SINGLE PASS [ms]", "SPEEDUP"]]
+    for numRecords in (args.records or [60, 10000, 100000]):
+        recordsPerUser = [generateRecords(numRecords, seed = userIdx) for userIdx in range(args.users)]
+        legacyRecords = json.loads(legacyPipeline(recordsPerUser))["records"]
+        legacyRecords.sort(key = lambda record: (record["datetime"], record["id"]), reverse = True)      #prepareRecords orders equal datetimes by id
+        if singlePassPipeline(recordsPerUser) != dumpsJson({"records": legacyRecords}):
+            raise ValueError("single pass pipeline output differs from the legacy pipeline")
+        legacyTime     = bestOf(legacyPipeline, recordsPerUser, args.repeat)
+        singlePassTime = bestOf(singlePassPipeline, recordsPerUser, args.repeat)
+        tableEntries.append([numRecords * args.users, f"{legacyTime * 1e3:.1f}", f"{singlePassTime * 1e3:.1f}", f"{legacyTime / singlePassTime:.1f}x"])
+    print(terminaltables.AsciiTable(tableEntries).table)
+
+if __name__ == "__main__":
+    main()
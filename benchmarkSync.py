@@ -0,0 +1,84 @@
+import asyncio
+import argparse
+import logging
+import time
+import terminaltables
+
+from omblepy import bluetoothTxRxHandler, logger
+from bleSimulator import simulatedOmronDevice, simulatedBleakClient, generateRecords
+from bleTrace import traceRecorder, traceReplayClient
+from deviceSpecific.hem_7142t1 import deviceSpecificDriver
+
+#name -> getRecords arguments
+scenarios = {
+    "full":        {"useUnreadCounter": False, "syncTime": False},
+    "unread-only": {"useUnreadCounter": True,  "syncTime": False},
+    "time-sync":   {"useUnreadCounter": False, "syncTime": True},
+}
+
+async def runSession(client, scenarioArgs, captureTrace = None):
+    bleTraceRecorder = None
+    if captureTrace:
+        bleTraceRecorder = traceRecorder(captureTrace, metadata = {"device": "hem_7142t1", "mac_address": client.address, **scenarioArgs})
+    startTime = time.perf_counter()
+    try:
+        await client.connect()
+        await client.pair(protection_level = 2)
+        bluetoothTxRxObj = bluetoothTxRxHandler(client, traceRecorder = bleTraceRecorder)
+        allRecs = await deviceSpecificDriver().getRecords(btobj = bluetoothTxRxObj, **scenarioArgs)
+        await client.disconnect()
+    finally:
+        if bleTraceRecorder is not None:
+            bleTraceRecorder.close()
+    wallTime = time.perf_counter() - startTime
+    return wallTime, sum(len(userRecs) for userRecs in allRecs), client.stats
+
+def simulatedClient(args, seed):
+    recordsPerUser = [generateRecords(args.records, seed = seed)]
+    device = simulatedOmronDevice(deviceSpecificDriver, recordsPerUser, unreadRecordsPerUser = [min(args.unread, args.records)])
+    return simulatedBleakClient(device, latencyS = args.latency, jitterS = args.jitter, lossProbability = args.loss,
+                                corruptionProbability = args.corruption, connectLatencyS = args.connectLatency, seed = seed)
+
+async def main():
+    parser = argparse.ArgumentParser(description="benchmark getRecords sessions against a simulated hem-7142t1")
+    parser.add_argument("-s", "--scenario",   choices = list(scenarios), action = "append", help = "scenario to run, can be repeated (default: all)")
+    parser.add_argument("-r", "--repeat",     type = int,   default = 1,    help = "sessions per scenario")
+    parser.add_argument("--records",          type = int,   default = 60,   help = "records stored on the simulated device")
+    parser.add_argument("--unread",           type = int,   default = 5,    help = "records marked as unread")
+    parser.add_argument("--latency",          type = float, default = 0.01, help = "latency per ble packet in seconds")
+    parser.add_argument("--jitter",           type = float, default = 0.0,  help = "maximum additional random latency per ble packet in seconds")
+    parser.add_argument("--loss",             type = float, default = 0.0,  help = "probability that a ble packet is lost")
+    parser.add_argument("--corruption",       type = float, default = 0.0,  help = "probability that a ble packet is corrupted")
+    parser.add_argument("--connectLatency",   type = float, default = 0.0,  help = "time to connect in seconds")
+    parser.add_argument("--captureTrace",     type = str,                   help = "write the trace of the last simulated session to this file")
+    parser.add_argument("--replay",           type = str,                   help = "replay a captured trace file instead of using the simulator")
+    parser.add_argument("--speed",            type = float, default = 1.0,  help = "replay speed factor, 0 replays without delays")
+    parser.add_argument("--loggerDebug",      action = "store_true",        help = "Enable verbose logger output")
+    args = parser.parse_args()
+
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG if args.loggerDebug else logging.WARNING)
+
+    if args.replay:
+        tableEntries = [["TRACE", "RUN", "WALL [s]", "RECORDS", "TX PACKETS", "RX PACKETS", "MISMATCHES", "RX BYTES/S"]]
+        for runIdx in range(args.repeat):
+            client = traceReplayClient(args.replay, speed = args.speed)
+            scenarioArgs = {"useUnreadCounter": client.metadata.get("useUnreadCounter", False), "syncTime": client.metadata.get("syncTime", False)}
+            wallTime, numRecords, stats = await runSession(client, scenarioArgs)
+            tableEntries.append([args.replay, runIdx, f"{wallTime:.3f}", numRecords, stats["tx_packets"], stats["rx_packets"],
+                                 stats["mismatches"], f"{stats['rx_bytes'] / wallTime:.0f}"])
+        print(terminaltables.AsciiTable(tableEntries).table)
+        return
+
+    tableEntries = [["SCENARIO", "RUN", "WALL [s]", "RECORDS", "ROUND TRIPS", "RETRIES", "LOST", "CORRUPTED", "RX BYTES/S"]]
+    for scenarioName in (args.scenario or list(scenarios)):
+        for runIdx in range(args.repeat):
+            wallTime, numRecords, stats = await runSession(simulatedClient(args, seed = runIdx), scenarios[scenarioName], args.captureTrace)
+            tableEntries.append([scenarioName, runIdx, f"{wallTime:.3f}", numRecords, stats["commands"], stats["retries"],
+                                 stats["lost_packets"], stats["corrupted_packets"], f"{stats['rx_bytes'] / wallTime:.0f}"])
+    print(terminaltables.AsciiTable(tableEntries).table)
+
+if __name__ == "__main__":
+    asyncio.run(main())
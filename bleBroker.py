@@ -0,0 +1,278 @@
+import asyncio
+import argparse
+import concurrent.futures
+import logging
+import os
+import pickle
+import queue
+import threading
+from multiprocessing.connection import Listener, Client
+
+import bleSession
+from bleSession import readDeviceRecords
+from omblepy import scanBLEDevices
+from syncDaemon import recordCache, syncDaemon
+from syncJobs import jobRegistry
+from recordStore import recordStore
+from recordAggregates import recordAggregates
+from storageWriter import storageWriter
+from shardedStorage import shardedStorage
+from bleMetrics import renderPrometheusText
+
+logger = logging.getLogger("omblepy")
+
+#operations a broker client may call on the backend of the broker
+brokerOperations = ("readDevice", "cachedRead", "scan", "addDevice", "metrics", "submitSyncJob", "getSyncJob", "cancelSyncJob")
+
+class bleBackend:
+    #every bluetooth operation of the api, must only exist once per adapter: either in the single api process
+    #or in the broker process which the api workers reach through brokerClient.
+    #sync jobs live here as well, so that every api worker sees the jobs that another one started
+    def __init__(self, cache, daemon, store, driverClass, jobs = None):
+        self.cache       = cache
+        self.daemon      = daemon
+        self.store       = store
+        self.driverClass = driverClass
+        self.jobs        = jobs if jobs is not None else jobRegistry()
+
+    async def readDevice(self, macAddr, useUnreadCounter = False, syncTime = False, pairing = False, updateCache = False, progressCallback = None):
+        """Live session, new records are stored in the record store, full reads can also replace the cache entry."""
+        sessionResult = await readDeviceRecords(macAddr, self.driverClass, useUnreadCounter = useUnreadCounter, syncTime = syncTime,
+                                                pairing = pairing, progressCallback = progressCallback)
+        if not pairing:
+            await self.store.addSession(sessionResult)
+        if updateCache:
+            sessionResult = self.cache.put(sessionResult)
+        return sessionResult
+
+    async def cachedRead(self, macAddr, maxAgeS = None):
+        return await self.daemon.cachedRead(macAddr, maxAgeS)
+
+    async def scan(self, scanTimeoutS = 5.0):
+        return await scanBLEDevices(scanTimeoutS)
+
+    async def addDevice(self, macAddr):
+        self.daemon.addDevice(macAddr)
+
+    async def metrics(self):
+        return renderPrometheusText()
+
+    async def _runSyncJob(self, job, macAddr, newRecordsOnly, syncTime):
+        return await self.readDevice(macAddr, useUnreadCounter = newRecordsOnly, syncTime = syncTime,
+                                     updateCache = not newRecordsOnly, progressCallback = job.updateProgress)
+
+    async def submitSyncJob(self, macAddr, newRecordsOnly = False, syncTime = False):
+        """Start a background read of the device, returns the job (syncJob.toDict, the result is the session) right away."""
+        self.daemon.addDevice(macAddr)
+        params = {"mac_address": macAddr, "new_records_only": newRecordsOnly, "sync_time": syncTime}
+        job = self.jobs.submit(params, lambda job: self._runSyncJob(job, macAddr, newRecordsOnly, syncTime))
+        return job.toDict()
+
+    async def getSyncJob(self, jobId):
+        job = self.jobs.get(jobId)
+        return job.toDict() if job is not None else None
+
+    async def cancelSyncJob(self, jobId):
+        job = self.jobs.cancel(jobId)
+        return job.toDict() if job is not None else None
+
+
+def brokerAuthkey():
+    """
+    Shared secret of the broker and its clients from OMRON_BLE_BROKER_AUTHKEY. Required: the connection pickles
+    its requests, without the handshake any process that can open the socket could run code in the broker.
+    """
+    authkey = os.environ.get("OMRON_BLE_BROKER_AUTHKEY")
+    if not authkey:
+        raise RuntimeError("OMRON_BLE_BROKER_AUTHKEY must be set to the same secret for the ble broker and the api workers")
+    return authkey.encode()
+
+class brokerServer:
+    #serves a bleBackend on a unix socket, every request uses its own connection and thread:
+    #request (operation, kwargs, wantsProgress) -> ("progress", bytesRead, bytesTotal)* -> ("result", value) or ("error", exception)
+    #anything the client sends while the operation runs (or closing the connection) cancels it
+    def __init__(self, backend, address, authkey, pollIntervalS = 0.2):
+        if not authkey:
+            raise ValueError("the ble broker requires an authkey")
+        self.backend       = backend
+        self.address       = address
+        self.authkey       = authkey
+        self.pollIntervalS = pollIntervalS
+        self.listener      = None
+        self.loop          = None
+
+    def _sendError(self, conn, exception):
+        try:
+            pickle.dumps(exception)
+        except Exception:
+            exception = RuntimeError(str(exception))
+        conn.send(("error", exception))
+
+    def _handleConnection(self, conn):
+        with conn:
+            try:
+                operation, kwargs, wantsProgress = conn.recv()
+            except (EOFError, OSError, ValueError):
+                return
+            if operation not in brokerOperations:
+                self._sendError(conn, ValueError(f"unknown broker operation {operation!r}"))
+                return
+            progressQueue = queue.SimpleQueue()
+            if wantsProgress:
+                kwargs["progressCallback"] = lambda bytesRead, bytesTotal: progressQueue.put((bytesRead, bytesTotal))
+            future = asyncio.run_coroutine_threadsafe(getattr(self.backend, operation)(**kwargs), self.loop)
+            try:
+                while True:
+                    #wait instead of result(timeout), a TimeoutError raised by the operation must not look like "still running"
+                    concurrent.futures.wait([future], timeout = self.pollIntervalS)
+                    while not progressQueue.empty():
+                        conn.send(("progress", *progressQueue.get()))
+                    if future.done():
+                        conn.send(("result", future.result()))
+                        return
+                    if conn.poll():
+                        logger.info(f"broker client cancelled {operation}")
+                        future.cancel()
+                        return
+            except concurrent.futures.CancelledError:
+                self._sendError(conn, RuntimeError(f"{operation} was cancelled by the broker"))
+            except (EOFError, BrokenPipeError, ConnectionResetError):
+                future.cancel()
+            except Exception as e:
+                self._sendError(conn, e)
+
+    def _acceptLoop(self):
+        while True:
+            try:
+                conn = self.listener.accept()
+            except OSError:
+                #the listener was closed
+                return
+            except Exception as e:
+                logger.warning(f"broker connection rejected: {e}")
+                continue
+            threading.Thread(target = self._handleConnection, args = (conn,), daemon = True).start()
+
+    async def serve(self):
+        """Accept broker clients until cancelled."""
+        self.loop = asyncio.get_running_loop()
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+        self.listener = Listener(self.address, family = "AF_UNIX", authkey = self.authkey)
+        #only the user of the broker may connect
+        os.chmod(self.address, 0o600)
+        threading.Thread(target = self._acceptLoop, daemon = True).start()
+        logger.info(f"ble broker listening on {self.address}")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            self.listener.close()
+
+
+class brokerClient:
+    #same coroutine interface as bleBackend, used by api workers when a broker owns the adapter
+    def __init__(self, address, authkey, pollIntervalS = 0.2):
+        if not authkey:
+            raise ValueError("the ble broker requires an authkey")
+        self.address       = address
+        self.authkey       = authkey
+        self.pollIntervalS = pollIntervalS
+
+    def _exchange(self, operation, kwargs, progressCallback, loop, cancelEvent):
+        with Client(self.address, family = "AF_UNIX", authkey = self.authkey) as conn:
+            conn.send((operation, kwargs, progressCallback is not None))
+            while True:
+                if cancelEvent.is_set():
+                    conn.send(("cancel",))
+                    return None
+                if not conn.poll(self.pollIntervalS):
+                    continue
+                try:
+                    reply = conn.recv()
+                except EOFError:
+                    raise ConnectionError(f"ble broker closed the connection during {operation}")
+                if reply[0] == "progress":
+                    loop.call_soon_threadsafe(progressCallback, *reply[1:])
+                    continue
+                return reply
+
+    async def _call(self, operation, progressCallback = None, **kwargs):
+        cancelEvent = threading.Event()
+        try:
+            replyType, value = await asyncio.to_thread(self._exchange, operation, kwargs, progressCallback, asyncio.get_running_loop(), cancelEvent)
+        except asyncio.CancelledError:
+            #the exchange thread tells the broker to cancel the operation and returns
+            cancelEvent.set()
+            raise
+        if replyType == "error":
+            raise value
+        return value
+
+    async def readDevice(self, macAddr, useUnreadCounter = False, syncTime = False, pairing = False, updateCache = False, progressCallback = None):
+        return await self._call("readDevice", progressCallback, macAddr = macAddr, useUnreadCounter = useUnreadCounter,
+                                syncTime = syncTime, pairing = pairing, updateCache = updateCache)
+
+    async def cachedRead(self, macAddr, maxAgeS = None):
+        return await self._call("cachedRead", macAddr = macAddr, maxAgeS = maxAgeS)
+
+    async def scan(self, scanTimeoutS = 5.0):
+        return await self._call("scan", scanTimeoutS = scanTimeoutS)
+
+    async def addDevice(self, macAddr):
+        return await self._call("addDevice", macAddr = macAddr)
+
+    async def metrics(self):
+        return await self._call("metrics")
+
+    async def submitSyncJob(self, macAddr, newRecordsOnly = False, syncTime = False):
+        return await self._call("submitSyncJob", macAddr = macAddr, newRecordsOnly = newRecordsOnly, syncTime = syncTime)
+
+    async def getSyncJob(self, jobId):
+        return await self._call("getSyncJob", jobId = jobId)
+
+    async def cancelSyncJob(self, jobId):
+        return await self._call("cancelSyncJob", jobId = jobId)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="owns the bluetooth adapter and serves ble sessions to the api workers over a unix socket")
+    parser.add_argument("--socket",      type = str,   default = os.environ.get("OMRON_BLE_BROKER", "omron-ble-broker.sock"), help = "unix socket path (OMRON_BLE_BROKER)")
+    parser.add_argument("--journal",     type = str,   default = os.environ.get("OMRON_RECORD_JOURNAL", "records.jsonl"),      help = "record journal, read by the workers")
+    parser.add_argument("--interval",    type = float, default = float(os.environ.get("OMRON_SYNC_INTERVAL_S", "300")),        help = "background sync interval in seconds")
+    parser.add_argument("--mac",         type = str,   action = "append", default = [],                                       help = "device synced in the background, can be repeated")
+    parser.add_argument("--csvDir",      type = str,   default = os.environ.get("OMRON_CSV_DIR"),                              help = "write userN.csv and ubpm.json of every new record to this directory")
+    parser.add_argument("--csvLayout",   choices = ["sharded", "flat"], default = os.environ.get("OMRON_CSV_LAYOUT", "sharded"),    help = "sharded: <csvDir>/<mac>/userN.csv with a manifest, flat: <csvDir>/userN.csv")
+    parser.add_argument("--traceDir",    type = str,   default = os.environ.get("OMRON_TRACE_DIR"),                            help = "capture every ble session to a trace file in this directory")
+    parser.add_argument("--loggerDebug", action = "store_true",                                                                  help = "Enable verbose logger output")
+    args = parser.parse_args()
+
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG if args.loggerDebug else logging.INFO)
+
+    from deviceSpecific.hem_7142t1 import deviceSpecificDriver
+    bleSession.traceDirectory = args.traceDir
+    macAddrs = args.mac + [mac.strip() for mac in os.environ.get("OMRON_SYNC_MACS", "").split(",") if mac.strip()]
+    cache  = recordCache()
+    store  = recordStore(args.journal)
+    aggregates = recordAggregates(store)
+    store.listeners.append(aggregates.addChanges)
+    recordWriter = storageWriter(args.csvDir, shards = shardedStorage(args.csvDir) if args.csvLayout == "sharded" else None) if args.csvDir else None
+    if recordWriter is not None:
+        store.listeners.append(recordWriter.submitChanges)
+    daemon = syncDaemon(cache, deviceSpecificDriver, intervalS = args.interval, macAddrs = macAddrs, store = store)
+    backend = bleBackend(cache, daemon, store, deviceSpecificDriver, jobs = jobRegistry(retentionS = float(os.environ.get("OMRON_JOB_RETENTION_S", "3600"))))
+    server = brokerServer(backend, args.socket, brokerAuthkey())
+    daemon.start()
+    try:
+        await server.serve()
+    finally:
+        backend.jobs.cancelAll()
+        await daemon.stop()
+        aggregates.saveSnapshot()
+        if recordWriter is not None:
+            await recordWriter.closeAsync()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,116 @@
+import threading
+import time
+from contextlib import contextmanager
+
+#minimal metrics registry rendering the prometheus text exposition format,
+#shared by the cli (written to a file) and the api (served on /metrics)
+
+allMetrics = []
+
+def _formatLabels(labelNames, labelValues, extraLabels = ()):
+    labelPairs = list(zip(labelNames, labelValues)) + list(extraLabels)
+    if not labelPairs:
+        return ""
+    escaped = []
+    for labelName, labelValue in labelPairs:
+        labelValue = str(labelValue).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        escaped.append(f'{labelName}="{labelValue}"')
+    return "{" + ",".join(escaped) + "}"
+
+def _formatValue(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class counterMetric:
+    metricType = "counter"
+
+    def __init__(self, name, helpText, labelNames = ()):
+        self.name       = name
+        self.helpText   = helpText
+        self.labelNames = tuple(labelNames)
+        self.values     = dict()            #tuple of label values -> value
+        self.lock       = threading.Lock()
+        allMetrics.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[labelName]) for labelName in self.labelNames)
+
+    def inc(self, amount = 1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def renderLines(self):
+        with self.lock:
+            return [f"{self.name}{_formatLabels(self.labelNames, key)} {_formatValue(value)}" for key, value in self.values.items()]
+
+
+class gaugeMetric(counterMetric):
+    metricType = "gauge"
+
+    def dec(self, amount = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class histogramMetric(counterMetric):
+    metricType = "histogram"
+    defaultBuckets = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, name, helpText, labelNames = (), buckets = defaultBuckets):
+        super().__init__(name, helpText, labelNames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            bucketCounts, totalSum, totalCount = self.values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for bucketIdx, upperBound in enumerate(self.buckets):
+                if value <= upperBound:
+                    bucketCounts[bucketIdx] += 1
+            self.values[key] = (bucketCounts, totalSum + value, totalCount + 1)
+
+    @contextmanager
+    def time(self, **labels):
+        #also usable around awaits, only the wall time between enter and exit is measured
+        startTime = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - startTime, **labels)
+
+    def renderLines(self):
+        lines = []
+        with self.lock:
+            for key, (bucketCounts, totalSum, totalCount) in self.values.items():
+                for upperBound, bucketCount in zip(self.buckets, bucketCounts):
+                    lines.append(f"{self.name}_bucket{_formatLabels(self.labelNames, key, [('le', _formatValue(upperBound))])} {bucketCount}")
+                lines.append(f"{self.name}_sum{_formatLabels(self.labelNames, key)} {_formatValue(totalSum)}")
+                lines.append(f"{self.name}_count{_formatLabels(self.labelNames, key)} {totalCount}")
+        return lines
+
+
+def renderPrometheusText():
+    lines = []
+    for metric in allMetrics:
+        lines.append(f"# HELP {metric.name} {metric.helpText}")
+        lines.append(f"# TYPE {metric.name} {metric.metricType}")
+        lines.extend(metric.renderLines())
+    return "\n".join(lines) + "\n"
+
+
+#ble session metrics
+blePhaseSeconds          = histogramMetric("omron_ble_phase_seconds", "Duration of the phases of a ble session (scan, connect, pair, start_transmission, end_transmission, decode).", ["phase"])
+bleBlockRoundTripSeconds = histogramMetric("omron_ble_block_roundtrip_seconds", "Round trip time of a single eeprom block read or write including retries.", ["operation"],
+                                           buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.15, 0.2, 0.3, 0.5, 1.0, 2.0, 4.0))
+bleRetriesTotal          = counterMetric("omron_ble_retries_total", "Commands sent again after the answer timed out.", ["device"])
+bleTimeoutsTotal         = counterMetric("omron_ble_timeouts_total", "Commands without an answer within the timeout.", ["device"])
+bleCrcErrorsTotal        = counterMetric("omron_ble_crc_errors_total", "Received packets with a crc mismatch.", ["device"])
+recordsReadTotal         = counterMetric("omron_records_read_total", "Measurement records read from the devices.", ["device", "user"])
+bleSessionsInFlight      = gaugeMetric("omron_ble_sessions_in_flight", "Ble sessions currently connected or connecting.")
@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import pathlib
+import time
+import bleak
+
+from omblepy import bluetoothTxRxHandler, advTracker
+from bleTrace import traceRecorder
+from bleMetrics import blePhaseSeconds, bleSessionsInFlight
+
+logger = logging.getLogger("omblepy")
+
+inFlightSessions = dict()   #mac -> running session, only one radio session per device at a time
+
+traceDirectory = None        #when set, every session is captured to a trace file in this directory
+
+#bounds for the cleanup of a cancelled session
+abortTransmissionTimeoutS = 2.0
+disconnectTimeoutS        = 5.0
+
+async def findDevice(macAddr, scanTimeoutS = 5.0):
+    """Scan once, feed the advertisement tracker and return the BLEDevice for macAddr or None."""
+    with blePhaseSeconds.time(phase="scan"):
+        devices = await bleak.BleakScanner.discover(timeout=scanTimeoutS, return_adv=True)
+    selectedDevice = None
+    for addr, (bleDev, advData) in devices.items():
+        advTracker.update(addr, bleDev, advData)
+        if addr.upper() == macAddr.upper():
+            selectedDevice = bleDev
+    return selectedDevice
+
+async def _runDeviceSession(macAddr, driverClass, useUnreadCounter, syncTime, pairing, scanTimeoutS, progressCallback):
+    selectedDevice = await findDevice(macAddr, scanTimeoutS)
+    if selectedDevice is None:
+        raise LookupError(f"Device {macAddr} not found during scan.")
+
+    client = bleak.BleakClient(selectedDevice.address)
+    bluetoothTxRxObj = None
+    sessionTraceRecorder = None
+    if traceDirectory is not None:
+        traceFile = pathlib.Path(traceDirectory) / f"{selectedDevice.address.replace(':', '')}_{time.strftime('%Y_%m_%d__%H_%M_%S')}.ombt"
+        sessionTraceRecorder = traceRecorder(traceFile, metadata = {"device": driverClass.__module__, "mac_address": selectedDevice.address,
+                                             "useUnreadCounter": useUnreadCounter, "syncTime": syncTime, "pairing": pairing})
+    logger.info(f"Device: {selectedDevice.address} {selectedDevice.name}")
+    bleSessionsInFlight.inc()
+    try:
+        with blePhaseSeconds.time(phase="connect"):
+            await client.connect()
+        with blePhaseSeconds.time(phase="pair"):
+            await client.pair(protection_level=2)
+        if not client.is_connected:
+            raise OSError("Failed to connect to the BLE device.")
+
+        bluetoothTxRxObj = bluetoothTxRxHandler(client, traceRecorder = sessionTraceRecorder)
+        devSpecificDriver = driverClass()
+        sessionResult = {"mac_address": selectedDevice.address, "device_name": selectedDevice.name, "records": None}
+
+        if pairing:
+            if devSpecificDriver.deviceUseLockUnlock:
+                await bluetoothTxRxObj.writeNewUnlockKey()
+            await bluetoothTxRxObj.startTransmission()
+            await bluetoothTxRxObj.endTransmission()
+            return sessionResult
+
+        syncStartTime = time.monotonic()
+        #the api has always sent an additional start of transmission before getRecords, keep it for the hem-7142t1
+        await bluetoothTxRxObj.startTransmission()
+        sessionResult["records"] = await devSpecificDriver.getRecords(
+            btobj            = bluetoothTxRxObj,
+            useUnreadCounter = useUnreadCounter,
+            syncTime         = syncTime,
+            progressCallback = progressCallback,
+        )
+        advTracker.markSynced(selectedDevice.address, syncStartTime)
+        return sessionResult
+    except asyncio.CancelledError:
+        logger.info(f"session of {selectedDevice.address} cancelled")
+        if bluetoothTxRxObj is not None and client.is_connected:
+            await bluetoothTxRxObj.abortTransmission(abortTransmissionTimeoutS)
+        raise
+    finally:
+        bleSessionsInFlight.dec()
+        if sessionTraceRecorder is not None:
+            sessionTraceRecorder.close()
+        if client.is_connected:
+            try:
+                await asyncio.wait_for(client.disconnect(), disconnectTimeoutS)
+            except Exception as e:
+                logger.warning(f"disconnect from {selectedDevice.address} failed: {e!r}")
+
+async def _awaitSession(runningSession, progressCallback = None):
+    #shield, so that one waiter going away does not cancel the session of the others,
+    #the session itself is only cancelled when the last waiter is gone
+    sessionTask = runningSession["task"]
+    runningSession["waiters"] += 1
+    if progressCallback is not None:
+        runningSession["progressCallbacks"].append(progressCallback)
+    try:
+        return await asyncio.shield(sessionTask)
+    finally:
+        runningSession["waiters"] -= 1
+        if progressCallback is not None:
+            runningSession["progressCallbacks"].remove(progressCallback)
+        if runningSession["waiters"] == 0 and not sessionTask.done():
+            logger.info("all requests of the running session are gone, cancelling it")
+            #the cleanup of the cancelled session can take a while, nobody may join it in the meantime
+            runningSession["cancelling"] = True
+            sessionTask.cancel()
+
+def _canJoinSession(runningSession, useUnreadCounter, syncTime, pairing):
+    #a cancelled session only finishes its cleanup, it would end in CancelledError for the new request
+    if runningSession["cancelling"]:
+        return False
+    #pairing writes a new key and never shares a session
+    if pairing or runningSession["pairing"]:
+        return False
+    #the unread counter changes which records are transferred, so the read mode has to match
+    if useUnreadCounter != runningSession["useUnreadCounter"]:
+        return False
+    #a request without time sync can use the result of a session which also syncs the time, but not the other way round
+    return runningSession["syncTime"] or not syncTime
+
+async def readDeviceRecords(macAddr, driverClass, useUnreadCounter = False, syncTime = False, pairing = False, scanTimeoutS = 5.0, progressCallback = None):
+    """
+    Complete scan / connect / pair / read / disconnect sequence for a single device.
+    Concurrent compatible requests for the same mac share the result of the running session,
+    incompatible ones (and requests arriving while a cancelled session cleans up) wait until it has finished.
+    progressCallback(bytesRead, bytesTotal) follows the record readout of the session this request is served by.
+    Returns a dict with mac_address, device_name and records (list of record lists per user, None when pairing).
+    Raises LookupError when the device is not found during the scan.
+    """
+    macKey = macAddr.upper()
+    while True:
+        runningSession = inFlightSessions.get(macKey)
+        if runningSession is None:
+            break
+        if _canJoinSession(runningSession, useUnreadCounter, syncTime, pairing):
+            logger.info(f"joining running session of {macAddr}")
+            return await _awaitSession(runningSession, progressCallback)
+        logger.info(f"waiting for running session of {macAddr} to finish")
+        await asyncio.wait([runningSession["task"]])
+
+    progressCallbacks = []
+    def _sessionProgress(bytesRead, bytesTotal):
+        for callback in list(progressCallbacks):
+            callback(bytesRead, bytesTotal)
+    sessionTask = asyncio.create_task(_runDeviceSession(macAddr, driverClass, useUnreadCounter, syncTime, pairing, scanTimeoutS, _sessionProgress))
+    runningSession = {"task": sessionTask, "useUnreadCounter": useUnreadCounter, "syncTime": syncTime, "pairing": pairing,
+                      "progressCallbacks": progressCallbacks, "waiters": 0, "cancelling": False}
+    inFlightSessions[macKey] = runningSession
+    def _removeFinishedSession(task):
+        if inFlightSessions.get(macKey) is runningSession:
+            del inFlightSessions[macKey]
+    sessionTask.add_done_callback(_removeFinishedSession)
+    return await _awaitSession(runningSession, progressCallback)
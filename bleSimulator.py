@@ -0,0 +1,269 @@
+import asyncio
+import datetime
+import logging
+import random
+
+from omblepy import bluetoothTxRxHandler, parentService_UUID, examplePairingKey
+
+logger = logging.getLogger("omblepy")
+
+def _xorCrc(packetBytes):
+    xorCrc = 0
+    for byte in packetBytes:
+        xorCrc ^= byte
+    return xorCrc
+
+def _buildResponse(packetType, address, dataBytes):
+    #same framing as the device: size, type, address, number of data bytes, data, padding, crc
+    response = bytearray()
+    response += (len(dataBytes) + 8).to_bytes(1, 'big')
+    response += packetType
+    response += address.to_bytes(2, 'big')
+    response += len(dataBytes).to_bytes(1, 'big')
+    response += dataBytes
+    response += b'\x00'
+    response.append(_xorCrc(response))
+    return response
+
+def _setBits(bigInt, totalNumBits, firstValidBitIdx, lastValidBitIdx, value):
+    #inverse of sharedDeviceDriverCode._bytearrayBitsToInt, bit 0 is the most significant bit
+    numValidBits = (lastValidBitIdx - firstValidBitIdx) + 1
+    if(value < 0 or value >= 2**numValidBits):
+        raise ValueError(f"value {value} does not fit into bits {firstValidBitIdx}-{lastValidBitIdx}")
+    return bigInt | (value << (totalNumBits - (lastValidBitIdx + 1)))
+
+def encodeHem7142t1Record(recordDict):
+    """Inverse of deviceSpecific/hem_7142t1.py deviceSpecific_ParseRecordFormat."""
+    recordByteSize = 0x0e
+    numBits = recordByteSize * 8
+    dt = recordDict["datetime"]
+    bigInt = 0
+    bigInt = _setBits(bigInt, numBits, 68-16,  73-16,  dt.minute)
+    bigInt = _setBits(bigInt, numBits, 74-16,  79-16,  dt.second)
+    bigInt = _setBits(bigInt, numBits, 80-16,  80-16,  recordDict["mov"])
+    bigInt = _setBits(bigInt, numBits, 81-16,  81-16,  recordDict["ihb"])
+    bigInt = _setBits(bigInt, numBits, 82-16,  85-16,  dt.month)
+    bigInt = _setBits(bigInt, numBits, 86-16,  90-16,  dt.day)
+    bigInt = _setBits(bigInt, numBits, 91-16,  95-16,  dt.hour)
+    bigInt = _setBits(bigInt, numBits, 98-16,  103-16, dt.year - 2000)
+    bigInt = _setBits(bigInt, numBits, 104-16, 111-16, recordDict["bpm"])
+    bigInt = _setBits(bigInt, numBits, 112-16, 119-16, recordDict["dia"])
+    bigInt = _setBits(bigInt, numBits, 120-16, 127-16, recordDict["sys"] - 25)
+    return bigInt.to_bytes(recordByteSize, "little")
+
+def generateRecords(numRecords, seed = 0, startDate = datetime.datetime(2024, 1, 1, 7, 30, 0)):
+    """Plausible measurements twice a day, deterministic for a given seed."""
+    rng = random.Random(seed)
+    records = []
+    for recordIdx in range(numRecords):
+        records.append({
+            "datetime": startDate + datetime.timedelta(hours = 12 * recordIdx, minutes = rng.randrange(60), seconds = rng.randrange(60)),
+            "sys":      rng.randrange(100, 170),
+            "dia":      rng.randrange(60, 100),
+            "bpm":      rng.randrange(50, 100),
+            "mov":      int(rng.random() < 0.05),
+            "ihb":      int(rng.random() < 0.05),
+        })
+    return records
+
+
+class simulatedOmronDevice:
+    #eeprom image and command processing of a hem-7142t1, all addresses are taken from the driver class
+    def __init__(self, driverClass, recordsPerUser, unreadRecordsPerUser = None, deviceTime = datetime.datetime(2024, 1, 1, 12, 0, 0)):
+        self.driver       = driverClass
+        eepromSize        = max(driverClass.settingsWriteAddress + driverClass.settingsTimeSyncBytes[1],
+                                max(startAddr + count * driverClass.recordByteSize for startAddr, count in zip(driverClass.userStartAdressesList, driverClass.perUserRecordsCountList)))
+        self.eeprom       = bytearray(b'\xff' * eepromSize)
+        self.deviceId     = bytes(range(0x10))
+        self.pairingKey   = None
+        self.keyProgrammingMode = False
+        if unreadRecordsPerUser is None:
+            unreadRecordsPerUser = [0] * len(recordsPerUser)
+
+        unreadRecordsSettings = bytearray(driverClass.settingsUnreadRecordsBytes[1] - driverClass.settingsUnreadRecordsBytes[0])
+        for userIdx, userRecords in enumerate(recordsPerUser):
+            numSlots = driverClass.perUserRecordsCountList[userIdx]
+            if(len(userRecords) > numSlots):
+                raise ValueError(f"user{userIdx+1} has only {numSlots} record slots")
+            for slotIdx, record in enumerate(userRecords):
+                recordAddress = driverClass.userStartAdressesList[userIdx] + slotIdx * driverClass.recordByteSize
+                self.eeprom[recordAddress:recordAddress + driverClass.recordByteSize] = encodeHem7142t1Record(record)
+            unreadRecordsSettings[2*userIdx+0] = len(userRecords) % numSlots     #ring buffer slot which is written next
+            unreadRecordsSettings[2*userIdx+4] = unreadRecordsPerUser[userIdx]
+        self._writeSettings(driverClass.settingsUnreadRecordsBytes[0], unreadRecordsSettings)
+
+        timeSyncSettings = bytearray(driverClass.settingsTimeSyncBytes[1] - driverClass.settingsTimeSyncBytes[0])
+        timeSyncSettings[8:14] = bytes([deviceTime.year - 2000, deviceTime.month, deviceTime.day, deviceTime.hour, deviceTime.minute, deviceTime.second])
+        timeSyncSettings[14] = sum(timeSyncSettings[:14]) & 0xff
+        self._writeSettings(driverClass.settingsTimeSyncBytes[0], timeSyncSettings)
+
+    def _writeSettings(self, settingsOffset, dataBytes):
+        #the device exposes the settings at the read address and accepts changes at the write address
+        for baseAddress in (self.driver.settingsReadAddress, self.driver.settingsWriteAddress):
+            self.eeprom[baseAddress + settingsOffset:baseAddress + settingsOffset + len(dataBytes)] = dataBytes
+
+    def unreadRecords(self, userIdx):
+        return self.eeprom[self.driver.settingsReadAddress + self.driver.settingsUnreadRecordsBytes[0] + 2*userIdx + 4]
+
+    def deviceTime(self):
+        timeBytes = self.eeprom[self.driver.settingsReadAddress + self.driver.settingsTimeSyncBytes[0] + 8:][:6]
+        return datetime.datetime(timeBytes[0] + 2000, *timeBytes[1:6])
+
+    def handleCommand(self, command):
+        """Returns the response packet for a complete command packet, None if the device would stay silent."""
+        if(_xorCrc(command)):
+            logger.debug(f"simulator ignores command with bad crc {command.hex()}")
+            return None
+        commandType = bytes(command[1:3])
+        address     = int.from_bytes(command[3:5], 'big')
+        numBytes    = command[5]
+        if(commandType == bytes.fromhex("0000")):
+            return _buildResponse(bytes.fromhex("8000"), 0, self.deviceId)
+        if(commandType == bytes.fromhex("0100")):
+            return _buildResponse(bytes.fromhex("8100"), address, self.eeprom[address:address + numBytes])
+        if(commandType == bytes.fromhex("01c0")):
+            dataBytes = command[6:6 + numBytes]
+            self.eeprom[address:address + numBytes] = dataBytes
+            settingsStart = self.driver.settingsWriteAddress
+            if(settingsStart <= address < settingsStart + self.driver.settingsTimeSyncBytes[1]):
+                self._writeSettings(address - settingsStart, dataBytes)
+            return _buildResponse(bytes.fromhex("81c0"), address, dataBytes)
+        if(commandType == bytes.fromhex("0f00")):
+            response = bytearray.fromhex("088f0000000000")
+            response.append(_xorCrc(response))
+            return response
+        logger.warning(f"simulator got unknown command {command.hex()}")
+        return None
+
+    def handleUnlockCommand(self, command):
+        if(command[0] == 0x02):
+            self.keyProgrammingMode = True
+            return bytearray.fromhex("8200") + bytes(14)
+        if(command[0] == 0x00 and self.keyProgrammingMode):
+            self.pairingKey = bytes(command[1:17])
+            self.keyProgrammingMode = False
+            return bytearray.fromhex("8000") + bytes(14)
+        if(command[0] == 0x01):
+            status = 0x00 if bytes(command[1:17]) == self.pairingKey else 0x01
+            return bytearray([0x81, status]) + bytes(14)
+        return bytearray.fromhex("8f01") + bytes(14)
+
+
+class simulatedGattCharacteristic:
+    def __init__(self, uuid, handle):
+        self.uuid   = uuid
+        self.handle = handle
+
+
+class simulatedGattService:
+    def __init__(self, uuid):
+        self.uuid = uuid
+
+
+class simulatedBleakClient:
+    #drop in replacement for bleak.BleakClient talking to a simulatedOmronDevice
+    #every 16 byte ble packet is delayed by latencyS plus uniform jitter and can be lost or corrupted
+    def __init__(self, device, address = "00:5F:BF:00:00:01", latencyS = 0.01, jitterS = 0.0, lossProbability = 0.0, corruptionProbability = 0.0, connectLatencyS = 0.0, seed = 0):
+        self.device                = device
+        self.address               = address
+        self.latencyS              = latencyS
+        self.jitterS               = jitterS
+        self.lossProbability       = lossProbability
+        self.corruptionProbability = corruptionProbability
+        self.connectLatencyS       = connectLatencyS
+        self.rng                   = random.Random(seed)
+        self.is_connected          = False
+        self.services              = [simulatedGattService(parentService_UUID)]
+        self.notifyCallbacks       = dict()         #uuid -> callback
+        self.txBuffer              = bytearray()
+        self.lastTxStartPacket     = None
+        self.stats                 = {"tx_packets": 0, "rx_packets": 0, "commands": 0, "retries": 0,
+                                      "lost_packets": 0, "corrupted_packets": 0, "tx_bytes": 0, "rx_bytes": 0}
+
+    async def connect(self, **kwargs):
+        await asyncio.sleep(self.connectLatencyS)
+        self.is_connected = True
+        return True
+
+    async def pair(self, protection_level = None, **kwargs):
+        return True
+
+    async def disconnect(self):
+        self.is_connected = False
+        self.notifyCallbacks.clear()
+        return True
+
+    async def start_notify(self, uuid, callback, **kwargs):
+        self.notifyCallbacks[uuid] = callback
+
+    async def stop_notify(self, uuid):
+        self.notifyCallbacks.pop(uuid, None)
+
+    def _transferPacket(self, packet):
+        #returns the packet as it arrives on the other side, None if it is lost
+        if(self.rng.random() < self.lossProbability):
+            self.stats["lost_packets"] += 1
+            return None
+        packet = bytearray(packet)
+        if(self.rng.random() < self.corruptionProbability):
+            self.stats["corrupted_packets"] += 1
+            packet[self.rng.randrange(len(packet))] ^= 1 << self.rng.randrange(8)
+        return packet
+
+    def _packetDelay(self):
+        return self.latencyS + self.rng.uniform(0, self.jitterS)
+
+    def _deliverNotification(self, uuid, handle, packet):
+        callback = self.notifyCallbacks.get(uuid)
+        if callback is None or not self.is_connected:
+            return
+        self.stats["rx_packets"] += 1
+        self.stats["rx_bytes"]   += len(packet)
+        try:
+            callback(simulatedGattCharacteristic(uuid, handle), packet)
+        except Exception as e:
+            #bleak logs exceptions raised in notification callbacks and keeps going, so does the simulator
+            logger.debug(f"exception in notification callback: {e!r}")
+
+    def _sendResponse(self, response):
+        loop = asyncio.get_running_loop()
+        delay = 0.0
+        for channelIdx in range((len(response) + 15) // 16):
+            delay += self._packetDelay()
+            packet = self._transferPacket(response[16 * channelIdx:16 * (channelIdx + 1)])
+            if packet is None:
+                continue
+            uuid   = bluetoothTxRxHandler.deviceRxChannelUUIDs[channelIdx]
+            handle = bluetoothTxRxHandler.deviceDataRxChannelIntHandles[channelIdx]
+            loop.call_later(delay, self._deliverNotification, uuid, handle, packet)
+
+    async def write_gatt_char(self, uuid, data, response = False):
+        if not self.is_connected:
+            raise OSError("simulated device is not connected")
+        self.stats["tx_packets"] += 1
+        self.stats["tx_bytes"]   += len(data)
+        if(uuid == bluetoothTxRxHandler.deviceUnlock_UUID):
+            await asyncio.sleep(self._packetDelay())
+            unlockResponse = self.device.handleUnlockCommand(bytearray(data))
+            asyncio.get_running_loop().call_soon(self._deliverNotification, uuid, uuid, unlockResponse)
+            return
+        channelIdx = bluetoothTxRxHandler.deviceTxChannelUUIDs.index(uuid)
+        if(channelIdx == 0):
+            if(self.lastTxStartPacket == bytes(data)):
+                self.stats["retries"] += 1
+            self.lastTxStartPacket = bytes(data)
+            self.txBuffer = bytearray()
+        packet = self._transferPacket(data)
+        if packet is None:
+            self.txBuffer = None            #command incomplete, the device stays silent
+            return
+        if self.txBuffer is None:
+            return
+        self.txBuffer += packet
+        if(len(self.txBuffer) >= self.txBuffer[0]):
+            command = self.txBuffer[:self.txBuffer[0]]
+            self.txBuffer = None
+            self.stats["commands"] += 1
+            deviceResponse = self.device.handleCommand(command)
+            if deviceResponse is not None:
+                self._sendResponse(deviceResponse)
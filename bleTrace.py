@@ -0,0 +1,144 @@
+import asyncio
+import json
+import logging
+import struct
+import time
+
+logger = logging.getLogger("omblepy")
+
+#trace file layout:
+#  header: magic, version, capture start (unix time, float64), metadata json length (uint16), metadata json
+#  entries: direction (uint8), channel (uint8), microseconds since capture start (uint32), length (uint8), bytes
+traceMagic        = b"OMBT"
+traceVersion      = 1
+traceHeaderStruct = struct.Struct("<4sBdH")
+traceEntryStruct  = struct.Struct("<BBIB")
+directionTx       = 0
+directionRx       = 1
+unlockChannelIdx  = 4               #channel number used for the unlock characteristic
+
+
+class traceRecorder:
+    def __init__(self, filename, metadata = None):
+        self.file      = open(filename, "wb")
+        self.startTime = time.perf_counter()
+        metadataBytes  = json.dumps(metadata or {}).encode("utf-8")
+        self.file.write(traceHeaderStruct.pack(traceMagic, traceVersion, time.time(), len(metadataBytes)))
+        self.file.write(metadataBytes)
+
+    def _record(self, direction, channelIdx, dataBytes):
+        if self.file is None:
+            return
+        offsetUs = int((time.perf_counter() - self.startTime) * 1e6)
+        self.file.write(traceEntryStruct.pack(direction, channelIdx, offsetUs, len(dataBytes)))
+        self.file.write(bytes(dataBytes))
+
+    def recordTx(self, channelIdx, dataBytes):
+        self._record(directionTx, channelIdx, dataBytes)
+
+    def recordRx(self, channelIdx, dataBytes):
+        self._record(directionRx, channelIdx, dataBytes)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def readTrace(filename):
+    """Returns (metadata dict, list of (direction, channel, seconds since capture start, bytes))."""
+    with open(filename, "rb") as infile:
+        traceBytes = infile.read()
+    magic, version, captureStart, metadataLength = traceHeaderStruct.unpack_from(traceBytes, 0)
+    if(magic != traceMagic or version != traceVersion):
+        raise ValueError(f"{filename} is not a trace file of version {traceVersion}")
+    offset   = traceHeaderStruct.size
+    metadata = json.loads(traceBytes[offset:offset + metadataLength])
+    metadata["capture_start"] = captureStart
+    offset  += metadataLength
+    entries  = []
+    while(offset < len(traceBytes)):
+        direction, channelIdx, offsetUs, length = traceEntryStruct.unpack_from(traceBytes, offset)
+        offset += traceEntryStruct.size
+        entries.append((direction, channelIdx, offsetUs / 1e6, bytearray(traceBytes[offset:offset + length])))
+        offset += length
+    return metadata, entries
+
+
+class traceCharacteristic:
+    def __init__(self, uuid, handle):
+        self.uuid   = uuid
+        self.handle = handle
+
+
+class traceReplayClient:
+    #drop in replacement for bleak.BleakClient, answers every write with the notifications that followed it in the trace
+    #speed > 1 replays faster than captured, speed = 0 delivers all notifications without delay
+    def __init__(self, filename, speed = 1.0, address = None):
+        from omblepy import bluetoothTxRxHandler, parentService_UUID
+        self.handlerClass    = bluetoothTxRxHandler
+        self.metadata, self.entries = readTrace(filename)
+        self.speed           = speed
+        self.address         = address or self.metadata.get("mac_address", "00:00:00:00:00:00")
+        self.is_connected    = False
+        self.services        = [traceCharacteristic(parentService_UUID, None)]
+        self.notifyCallbacks = dict()           #uuid -> callback
+        self.nextEntryIdx    = 0
+        self.stats           = {"tx_packets": 0, "rx_packets": 0, "rx_bytes": 0, "mismatches": 0}
+
+    async def connect(self, **kwargs):
+        self.is_connected = True
+        return True
+
+    async def pair(self, protection_level = None, **kwargs):
+        return True
+
+    async def disconnect(self):
+        self.is_connected = False
+        return True
+
+    async def start_notify(self, uuid, callback, **kwargs):
+        self.notifyCallbacks[uuid] = callback
+
+    async def stop_notify(self, uuid):
+        self.notifyCallbacks.pop(uuid, None)
+
+    def _channelUUID(self, channelIdx, direction):
+        if(channelIdx == unlockChannelIdx):
+            return self.handlerClass.deviceUnlock_UUID
+        if(direction == directionTx):
+            return self.handlerClass.deviceTxChannelUUIDs[channelIdx]
+        return self.handlerClass.deviceRxChannelUUIDs[channelIdx]
+
+    def _deliverNotification(self, channelIdx, dataBytes):
+        uuid     = self._channelUUID(channelIdx, directionRx)
+        callback = self.notifyCallbacks.get(uuid)
+        if callback is None or not self.is_connected:
+            return
+        self.stats["rx_packets"] += 1
+        self.stats["rx_bytes"]   += len(dataBytes)
+        handle = uuid if channelIdx == unlockChannelIdx else self.handlerClass.deviceDataRxChannelIntHandles[channelIdx]
+        try:
+            callback(traceCharacteristic(uuid, handle), dataBytes)
+        except Exception as e:
+            logger.debug(f"exception in notification callback: {e!r}")
+
+    async def write_gatt_char(self, uuid, data, response = False):
+        self.stats["tx_packets"] += 1
+        #skip to the next write in the trace
+        while(self.nextEntryIdx < len(self.entries) and self.entries[self.nextEntryIdx][0] != directionTx):
+            self.nextEntryIdx += 1
+        if(self.nextEntryIdx >= len(self.entries)):
+            raise EOFError("trace exhausted, the replayed session sent more data than the captured one")
+        _, channelIdx, txTime, txBytes = self.entries[self.nextEntryIdx]
+        self.nextEntryIdx += 1
+        if(self._channelUUID(channelIdx, directionTx) != uuid or bytes(txBytes) != bytes(data)):
+            #e.g. the time written by a time sync, the captured answers are replayed anyway
+            self.stats["mismatches"] += 1
+            logger.debug(f"replay mismatch, captured {txBytes.hex()} on ch{channelIdx}, got {bytes(data).hex()}")
+        loop = asyncio.get_running_loop()
+        while(self.nextEntryIdx < len(self.entries) and self.entries[self.nextEntryIdx][0] == directionRx):
+            _, rxChannelIdx, rxTime, rxBytes = self.entries[self.nextEntryIdx]
+            self.nextEntryIdx += 1
+            delay = (rxTime - txTime) / self.speed if self.speed > 0 else 0.0
+            loop.call_later(delay, self._deliverNotification, rxChannelIdx, rxBytes)
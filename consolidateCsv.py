@@ -0,0 +1,171 @@
+import argparse
+import csv
+import datetime
+import heapq
+import logging
+import os
+import pathlib
+import re
+import tempfile
+import time
+import terminaltables
+import numpy
+
+from csvColumnCache import iterCsvChunks, sidecarPaths
+from timestampCodec import formatTimestampColumn
+
+logger = logging.getLogger("omblepy")
+
+#every appendCsv run leaves a full backup_userN_<time>.csv copy of the history. This merges the backups and the current
+#userN.csv of a user into one history in a single streaming pass (k-way merge on datetime, memory grows with the number
+#of files and not with the number of rows) and deletes the backups that the retention policy does not keep.
+
+csvFieldNames  = ["datetime", "dia", "sys", "bpm", "mov", "ihb"]    #column order written by omblepy.appendCsv
+backupPattern  = re.compile(r"^backup_user(\d+)_(\d{4}_\d{2}_\d{2}__\d{2}_\d{2}_\d{2})\.csv$")
+backupTimeText = "%Y_%m_%d__%H_%M_%S"
+mergeBlockBytes = 64 << 10      #csv bytes read at once from every merged file
+writeBatchRows  = 8192
+
+def findUserFiles(directory):
+    """{user: (userN.csv or None, [(backup time, backup path)] newest first)} of the csv files in directory."""
+    users = dict()
+    for path in pathlib.Path(directory).iterdir():
+        match = backupPattern.match(path.name)
+        if match:
+            backupTime = datetime.datetime.strptime(match.group(2), backupTimeText)
+            users.setdefault(int(match.group(1)), [None, []])[1].append((backupTime, path))
+            continue
+        match = re.match(r"^user(\d+)\.csv$", path.name)
+        if match:
+            users.setdefault(int(match.group(1)), [None, []])[0] = path
+    return {user: (currentFile, sorted(backups, reverse = True)) for user, (currentFile, backups) in sorted(users.items())}
+
+def _iterSortedRows(csvPath, priority):
+    #rows (datetime seconds, priority, dia, sys, bpm, mov, ihb) of a csv that appendCsv wrote sorted by datetime
+    lastSeconds = None
+    for records in iterCsvChunks(csvPath, mergeBlockBytes):
+        seconds = records["datetime"].astype(numpy.int64)
+        if len(seconds) and ((lastSeconds is not None and seconds[0] < lastSeconds) or (numpy.diff(seconds) < 0).any()):
+            raise ValueError(f"{csvPath} is not sorted by datetime")
+        if len(seconds):
+            lastSeconds = seconds[-1]
+        yield from zip(seconds.tolist(), [priority] * len(seconds), *(records[field].tolist() for field in csvFieldNames[1:]))
+
+def _writeRows(rows, outputPath):
+    #temp file in the same directory + rename, the output is never seen half written
+    outputPath = pathlib.Path(outputPath)
+    numRows = 0
+    tmpFile = tempfile.NamedTemporaryFile("w", dir = outputPath.parent, prefix = outputPath.name + ".", suffix = ".tmp", newline = "", encoding = "utf-8", delete = False)
+    try:
+        with tmpFile:
+            writer = csv.writer(tmpFile)
+            writer.writerow(csvFieldNames)
+            batch = []
+            def writeBatch():
+                columns = list(zip(*batch))
+                timestamps = formatTimestampColumn(numpy.array(columns[0], dtype = "datetime64[s]")).tolist()
+                writer.writerows(zip(timestamps, *columns[2:]))
+                batch.clear()
+            for row in rows:
+                batch.append(row)
+                numRows += 1
+                if len(batch) == writeBatchRows:
+                    writeBatch()
+            if batch:
+                writeBatch()
+            tmpFile.flush()
+            os.fsync(tmpFile.fileno())
+        os.replace(tmpFile.name, outputPath)
+    except BaseException:
+        os.unlink(tmpFile.name)
+        raise
+    return numRows
+
+def mergeCsvFiles(csvPaths, outputPath, maxOpenFiles = 256):
+    """
+    Merge sorted csv histories into outputPath, a datetime that is in several files is taken from the first of them
+    (pass the newest file first). More than maxOpenFiles inputs are merged in groups through temporary files.
+    Returns the number of rows written.
+    """
+    csvPaths = list(csvPaths)
+    if len(csvPaths) > maxOpenFiles:
+        with tempfile.TemporaryDirectory(dir = pathlib.Path(outputPath).parent) as tmpDirectory:
+            groupPaths = []
+            for groupIdx in range(0, len(csvPaths), maxOpenFiles):
+                groupPaths.append(pathlib.Path(tmpDirectory) / f"group{len(groupPaths)}.csv")
+                mergeCsvFiles(csvPaths[groupIdx:groupIdx + maxOpenFiles], groupPaths[-1], maxOpenFiles)
+            return mergeCsvFiles(groupPaths, outputPath, maxOpenFiles)
+
+    def dedupedRows():
+        lastSeconds = None
+        for row in heapq.merge(*(_iterSortedRows(path, priority) for priority, path in enumerate(csvPaths))):
+            if row[0] != lastSeconds:
+                lastSeconds = row[0]
+                yield row
+    return _writeRows(dedupedRows(), outputPath)
+
+def backupsToKeep(backups, keepLast, keepDaily, keepMonthly, now = None):
+    """
+    Retention policy for [(backup time, path)] newest first: the keepLast newest backups, plus the newest backup of each
+    of the last keepDaily days and of each of the last keepMonthly months. Returns the set of kept paths.
+    """
+    now = now or datetime.datetime.now()
+    kept = {path for _, path in backups[:keepLast]}
+    newestPerDay, newestPerMonth = dict(), dict()
+    for backupTime, path in backups:
+        newestPerDay.setdefault(backupTime.date(), path)
+        newestPerMonth.setdefault((backupTime.year, backupTime.month), path)
+    firstKeptDay = now.date() - datetime.timedelta(days = keepDaily - 1)
+    kept.update(path for day, path in newestPerDay.items() if keepDaily > 0 and day >= firstKeptDay)
+    firstKeptMonth = now.year * 12 + now.month - keepMonthly
+    kept.update(path for (year, month), path in newestPerMonth.items() if year * 12 + month > firstKeptMonth)
+    return kept
+
+def consolidateUser(currentFile, backups, outputPath, keepLast, keepDaily, keepMonthly, dryRun = False):
+    """Merge the current file and the backups of one user into outputPath and prune the backups, returns a summary dict."""
+    inputPaths = ([currentFile] if currentFile is not None else []) + [path for _, path in backups]
+    bytesBefore = sum(path.stat().st_size for path in inputPaths)
+    numRows = 0
+    if not dryRun:
+        numRows = mergeCsvFiles(inputPaths, outputPath)
+    kept = backupsToKeep(backups, keepLast, keepDaily, keepMonthly)
+    pruned = [path for _, path in backups if path not in kept]
+    for path in pruned:
+        if dryRun:
+            logger.info(f"would delete {path}")
+            continue
+        path.unlink()
+        for sidecarPath in sidecarPaths(path):
+            sidecarPath.unlink(missing_ok = True)
+    bytesAfter = None if dryRun else pathlib.Path(outputPath).stat().st_size + sum(path.stat().st_size for path in kept)
+    return {"files": len(inputPaths), "rows": numRows, "pruned": len(pruned), "kept": len(kept), "bytesBefore": bytesBefore, "bytesAfter": bytesAfter}
+
+def main():
+    parser = argparse.ArgumentParser(description="merge the backup_userN_*.csv copies and userN.csv of every user into one history and prune old backups")
+    parser.add_argument("directory", nargs = "?", default = ".",      help = "directory with the userN.csv and backup files (default: current directory)")
+    parser.add_argument("--user",        type = int, action = "append", help = "only this user, can be repeated")
+    parser.add_argument("--keepLast",    type = int, default = 3,      help = "newest backups that are always kept")
+    parser.add_argument("--keepDaily",   type = int, default = 7,      help = "keep the newest backup of each of the last DAYS days")
+    parser.add_argument("--keepMonthly", type = int, default = 12,     help = "keep the newest backup of each of the last MONTHS months")
+    parser.add_argument("--dryRun",      action = "store_true",        help = "only show which backups would be deleted")
+    parser.add_argument("--loggerDebug", action = "store_true",        help = "Enable verbose logger output")
+    args = parser.parse_args()
+
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG if args.loggerDebug else logging.INFO)
+
+    tableRows = [["USER", "FILES", "ROWS", "BACKUPS KEPT", "BACKUPS DELETED", "MB BEFORE", "MB AFTER", "SECONDS"]]
+    for user, (currentFile, backups) in findUserFiles(args.directory).items():
+        if args.user and user not in args.user:
+            continue
+        startTime = time.perf_counter()
+        outputPath = pathlib.Path(args.directory) / f"user{user}.csv"
+        summary = consolidateUser(currentFile, backups, outputPath, args.keepLast, args.keepDaily, args.keepMonthly, args.dryRun)
+        tableRows.append([user, summary["files"], summary["rows"], summary["kept"], summary["pruned"],
+                          f"{summary['bytesBefore'] / 1e6:.1f}", f"{summary['bytesAfter'] / 1e6:.1f}" if summary["bytesAfter"] is not None else "-", f"{time.perf_counter() - startTime:.2f}"])
+    print(terminaltables.AsciiTable(tableRows).table)
+
+if __name__ == "__main__":
+    main()
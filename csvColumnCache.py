@@ -0,0 +1,190 @@
+import csv
+import hashlib
+import io
+import json
+import logging
+import os
+import pathlib
+import tempfile
+
+import numpy
+
+from timestampCodec import parseTimestampBytes, parseTimestampColumn, timestampLength
+
+logger = logging.getLogger("omblepy")
+
+#binary sidecar of a userN.csv history: a structured .npy array (memory mapped when it is reused) and a small json
+#describing how much of the csv it covers. A csv that only got new lines appended (the covered bytes hash the same)
+#is extended by parsing the new lines, any other change of the csv rebuilds the sidecar.
+
+sidecarVersion = 2
+recordDtype    = numpy.dtype([("datetime", "datetime64[s]"), ("dia", "<i2"), ("sys", "<i2"), ("bpm", "<i2"), ("mov", "<i1"), ("ihb", "<i1")])
+chunkBytes     = 4 << 20    #csv bytes parsed at once by the chunked reader
+
+def sidecarPaths(csvPath):
+    csvPath = pathlib.Path(csvPath)
+    return csvPath.with_name(csvPath.name + ".npy"), csvPath.with_name(csvPath.name + ".npy.json")
+
+def _parseCsvLinesSlow(text, header):
+    #csv module fallback for quoted fields, empty fields or additional columns
+    rows = list(csv.reader(io.StringIO(text)))
+    records = numpy.zeros(len(rows), dtype = recordDtype)
+    for fieldIdx, field in enumerate(header):
+        if field not in recordDtype.names:
+            continue
+        column = [row[fieldIdx] for row in rows]
+        if field == "datetime":
+            records[field] = parseTimestampColumn(column)
+        else:
+            records[field] = [int(value) if value else 0 for value in column]
+    return records
+
+def _parseUnsignedIntegers(buffer, starts, ends):
+    lengths = ends - starts
+    if len(lengths) and (lengths.min() < 1 or lengths.max() > 6):
+        raise ValueError("integer field is empty or too long")
+    values = numpy.zeros(len(starts), dtype = numpy.int64)
+    for digitIdx in range(lengths.max() if len(lengths) else 0):
+        inField = digitIdx < lengths
+        digits = buffer[numpy.minimum(starts + digitIdx, ends - 1)].astype(numpy.int64) - ord("0")
+        if ((digits < 0) | (digits > 9))[inField].any():
+            raise ValueError("integer field contains a non digit")
+        values = numpy.where(inField, values * 10 + digits, values)
+    return values
+
+def _parseCsvBlock(block, header):
+    """Records of complete csv lines (no header line), the lines are split and parsed with numpy."""
+    buffer = numpy.frombuffer(block, dtype = numpy.uint8)
+    lineEnds = numpy.flatnonzero(buffer == ord("\n"))
+    numLines, numFields = len(lineEnds), len(header)
+    try:
+        separators = numpy.flatnonzero((buffer == ord(",")) | (buffer == ord("\n")))
+        if len(separators) != numLines * numFields or (buffer == ord('"')).any():
+            raise ValueError("lines with a different number of fields or quoted fields")
+        fieldEnds = separators.reshape(numLines, numFields)
+        fieldStarts = numpy.empty_like(fieldEnds)
+        fieldStarts[:, 0] = numpy.concatenate([[0], lineEnds[:-1] + 1])
+        fieldStarts[:, 1:] = fieldEnds[:, :-1] + 1
+        #csv.writer terminates lines with \r\n
+        fieldEnds[:, -1] -= buffer[numpy.maximum(lineEnds - 1, 0)] == ord("\r")
+        records = numpy.zeros(numLines, dtype = recordDtype)
+        for fieldIdx, field in enumerate(header):
+            if field == "datetime":
+                if (fieldEnds[:, fieldIdx] - fieldStarts[:, fieldIdx] != timestampLength).any():
+                    raise ValueError("datetime field with an unexpected length")
+                records[field] = parseTimestampBytes(buffer, fieldStarts[:, fieldIdx])
+            elif field in recordDtype.names:
+                records[field] = _parseUnsignedIntegers(buffer, fieldStarts[:, fieldIdx], fieldEnds[:, fieldIdx])
+        return records
+    except ValueError:
+        return _parseCsvLinesSlow(block.decode("utf-8"), header)
+
+def _readHeader(csvFile):
+    return csvFile.readline().decode("utf-8-sig").strip().split(",")
+
+def _iterCsvBlocks(csvFile, header, blockBytes = chunkBytes):
+    #yields (records, bytes consumed) per block of complete lines starting at the current position of csvFile,
+    #a last line without line break is parsed at the end like csv.DictReader does, with 0 bytes consumed:
+    #it may still be written, so a sidecar never covers it
+    pending = b""
+    while True:
+        data = csvFile.read(blockBytes)
+        if not data:
+            if pending.strip():
+                yield _parseCsvBlock(pending + b"\n", header), 0
+            return
+        data = pending + data
+        completeLength = data.rfind(b"\n") + 1
+        pending = data[completeLength:]
+        if completeLength:
+            yield _parseCsvBlock(data[:completeLength], header), completeLength
+
+def iterCsvChunks(csvPath, blockBytes = chunkBytes):
+    """
+    Stream the records of a csv as structured arrays (see recordDtype), about blockBytes of csv per array,
+    so that histories of any size are read in bounded memory.
+    """
+    with open(csvPath, "rb") as csvFile:
+        header = _readHeader(csvFile)
+        for records, _ in _iterCsvBlocks(csvFile, header, blockBytes):
+            yield records
+
+def _prefixHash(csvFile, coveredLength):
+    #hashing is much cheaper than parsing, and omblepy rewrites whole files, so every covered byte is checked
+    digest = hashlib.md5()
+    csvFile.seek(0)
+    remaining = coveredLength
+    while remaining > 0:
+        block = csvFile.read(min(chunkBytes, remaining))
+        if not block:
+            break
+        digest.update(block)
+        remaining -= len(block)
+    return digest.hexdigest()
+
+def _readSidecar(csvPath, csvStat):
+    npyPath, metaPath = sidecarPaths(csvPath)
+    try:
+        meta = json.loads(metaPath.read_text())
+        if meta.get("version") != sidecarVersion:
+            return None, None
+        if meta["csv_size"] == csvStat.st_size and meta["csv_mtime_ns"] == csvStat.st_mtime_ns:
+            return meta, numpy.load(npyPath, mmap_mode = "r")
+        return meta, None
+    except (OSError, ValueError, KeyError):
+        return None, None
+
+def _replaceAtomically(path, mode, writeContent):
+    #unique temp file + rename, a reader never sees a partially written sidecar and concurrent writers never share a temp file
+    tmpFile = tempfile.NamedTemporaryFile(mode, dir = path.parent, prefix = path.name + ".", suffix = ".tmp", delete = False)
+    try:
+        with tmpFile:
+            writeContent(tmpFile)
+        os.replace(tmpFile.name, path)
+    except BaseException:
+        os.unlink(tmpFile.name)
+        raise
+
+def _writeSidecar(csvPath, csvStat, records, meta):
+    npyPath, metaPath = sidecarPaths(csvPath)
+    try:
+        _replaceAtomically(npyPath, "wb", lambda npyFile: numpy.save(npyFile, records))
+        #csv_size is the covered length, a csv with a last line that is not covered never matches as unchanged
+        meta = {**meta, "version": sidecarVersion, "csv_size": meta["covered_length"], "csv_mtime_ns": csvStat.st_mtime_ns}
+        _replaceAtomically(metaPath, "w", lambda metaFile: json.dump(meta, metaFile))
+    except OSError as e:
+        logger.warning(f"could not write the column cache of {csvPath}: {e}")
+
+def loadCsvColumns(csvPath, useCache = True):
+    """
+    All records of a csv written by omblepy.appendCsv as a structured numpy array with the fields of recordDtype,
+    e.g. records["sys"], records["datetime"] (datetime64[s]). Unchanged csv files are memory mapped from the sidecar.
+    """
+    csvPath = pathlib.Path(csvPath)
+    csvStat = csvPath.stat()
+    meta, cachedRecords = _readSidecar(csvPath, csvStat) if useCache else (None, None)
+    if cachedRecords is not None:
+        return cachedRecords
+
+    with open(csvPath, "rb") as csvFile:
+        chunks = []             #the records of the sidecar, the covered lines
+        tailRecords = []        #last line without line break
+        parsedRecords = 0
+        if meta is not None and meta["covered_length"] <= csvStat.st_size and meta["prefix_hash"] == _prefixHash(csvFile, meta["covered_length"]):
+            #only lines were appended since the sidecar was written
+            header, coveredLength = meta["header"], meta["covered_length"]
+            chunks.append(numpy.load(sidecarPaths(csvPath)[0]))
+        else:
+            csvFile.seek(0)
+            header = _readHeader(csvFile)
+            coveredLength = csvFile.tell()
+        csvFile.seek(coveredLength)
+        for records, consumedLength in _iterCsvBlocks(csvFile, header):
+            (chunks if consumedLength else tailRecords).append(records)
+            parsedRecords += len(records)
+            coveredLength += consumedLength
+        records = numpy.concatenate(chunks) if chunks else numpy.empty(0, dtype = recordDtype)
+        logger.debug(f"column cache of {csvPath}: {len(records) + sum(map(len, tailRecords))} records, {parsedRecords} of them parsed")
+        if useCache:
+            _writeSidecar(csvPath, csvStat, records, {"header": header, "covered_length": coveredLength, "prefix_hash": _prefixHash(csvFile, coveredLength)})
+    return numpy.concatenate([records] + tailRecords) if tailRecords else records
@@ -1,16 +1,28 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Query, WebSocket, WebSocketDisconnect
+from fastapi.responses import PlainTextResponse, Response
 from pydantic import BaseModel
+from typing import Optional
+from contextlib import asynccontextmanager
 import asyncio
-from bleak import BleakClient, BleakScanner
-from omblepy import bluetoothTxRxHandler, scanBLEDevices, appendCsv, saveUBPMJson
+import bleSession
+from bleBroker import bleBackend, brokerClient, brokerAuthkey
+from syncDaemon import recordCache, syncDaemon
+from syncJobs import jobRegistry
+from recordStore import recordStore
+from recordAggregates import recordAggregates
+from storageWriter import storageWriter
+from shardedStorage import shardedStorage
+from wsHub import wsHub
+from requestProfiler import requestProfiler
+from recordFormat import prepareRecords, latestRecord, dumpsJson, negotiateMediaType, availableMediaTypes, encodeRecordsBody, compressBody, mediaTypeJson
+from recordFormat import recordSetEtag, etagWithEncoding, etagMatches, parseDeviceDatetime
+from timestampCodec import formatTimestamp
 import logging
 import os
 json_path = os.path.join('ubpm.json')
-import hashlib
-
 # Memastikan driver spesifik tersedia
 from deviceSpecific.hem_7142t1 import deviceSpecificDriver
-from datetime import datetime, timezone
+from datetime import datetime
 from copy import deepcopy
 
 
@@ -19,8 +31,96 @@ bleClient           = None
 deviceSpecific = None
 bleClient = None
 
-app = FastAPI()
-connected_clients = []
+# Rekam setiap sesi BLE ke file trace bila OMRON_TRACE_DIR diisi (untuk analisis performa)
+bleSession.traceDirectory = os.environ.get("OMRON_TRACE_DIR") or None
+
+# Broker BLE: bila OMRON_BLE_BROKER berisi path Unix socket dari `bleBroker.py`, semua sesi BLE, cache dan
+# sinkronisasi latar belakang dijalankan oleh broker sehingga uvicorn bisa dijalankan dengan `--workers N`
+ble_broker_address = os.environ.get("OMRON_BLE_BROKER") or None
+
+# Journal semua record yang pernah dibaca, sumber change feed `GET /changes`
+# (dengan broker, journal ditulis oleh broker dan setiap worker hanya mengikutinya)
+record_store = recordStore(os.environ.get("OMRON_RECORD_JOURNAL", "records.jsonl"), readOnly=ble_broker_address is not None)
+
+# Dashboard yang berlangganan record baru lewat WebSocket `/ws/records`
+ws_hub = wsHub(
+    maxQueue=int(os.environ.get("OMRON_WS_MAX_QUEUE", "100")),
+    heartbeatS=float(os.environ.get("OMRON_WS_HEARTBEAT_S", "20")),
+)
+record_store.listeners.append(ws_hub.publish)
+
+# Statistik per perangkat dan user yang diperbarui setiap ada record baru, snapshot disimpan di samping journal
+record_aggregates = recordAggregates(
+    record_store,
+    snapshotPath=os.environ.get("OMRON_AGGREGATE_SNAPSHOT") or None,
+    snapshotIntervalS=float(os.environ.get("OMRON_AGGREGATE_SNAPSHOT_INTERVAL_S", "60")),
+)
+record_store.listeners.append(record_aggregates.addChanges)
+
+# Ekspor userN.csv dan ubpm.json seperti omblepy.py ke direktori OMRON_CSV_DIR (bila diisi), ditulis di thread terpisah
+# agar I/O disk tidak menahan event loop. Dengan broker, file ditulis oleh broker (`bleBroker.py --csvDir`).
+# OMRON_CSV_LAYOUT=sharded (bawaan): satu direktori per MAC dengan manifest.json, flat: userN.csv langsung di direktori
+csv_directory = os.environ.get("OMRON_CSV_DIR") or None
+storage_writer = storageWriter(
+    csv_directory,
+    maxPendingSessions=int(os.environ.get("OMRON_CSV_MAX_PENDING", "16")),
+    shards=shardedStorage(csv_directory) if os.environ.get("OMRON_CSV_LAYOUT", "sharded") == "sharded" else None,
+) if csv_directory is not None and ble_broker_address is None else None
+if storage_writer is not None:
+    record_store.listeners.append(storage_writer.submitChanges)
+
+# Cache + background sync, MAC yang disinkronkan bisa diisi lewat env OMRON_SYNC_MACS (dipisah koma)
+record_cache = recordCache()
+sync_daemon = syncDaemon(
+    record_cache,
+    deviceSpecificDriver,
+    intervalS=float(os.environ.get("OMRON_SYNC_INTERVAL_S", "300")),
+    macAddrs=[mac.strip() for mac in os.environ.get("OMRON_SYNC_MACS", "").split(",") if mac.strip()],
+    store=record_store,
+)
+
+# Job sinkronisasi asinkron disimpan oleh backend BLE (di broker bila ada, sehingga terlihat dari semua worker),
+# job yang selesai disimpan selama OMRON_JOB_RETENTION_S detik
+if ble_broker_address is not None:
+    ble_backend = brokerClient(ble_broker_address, brokerAuthkey())
+else:
+    ble_backend = bleBackend(record_cache, sync_daemon, record_store, deviceSpecificDriver,
+                             jobs=jobRegistry(retentionS=float(os.environ.get("OMRON_JOB_RETENTION_S", "3600"))))
+
+@asynccontextmanager
+async def lifespan(app):
+    if ble_broker_address is not None:
+        follow_task = asyncio.create_task(record_store.followJournal())
+    else:
+        sync_daemon.start()
+    yield
+    if ble_broker_address is not None:
+        follow_task.cancel()
+    else:
+        ble_backend.jobs.cancelAll()
+        await sync_daemon.stop()
+        record_aggregates.saveSnapshot()
+    if storage_writer is not None:
+        await storage_writer.closeAsync()
+
+app = FastAPI(lifespan=lifespan)
+
+# Profiling per request (header `X-Profile: 1` atau query `?profile=1`), hanya aktif bila OMRON_PROFILING_ENABLED=1
+request_profiler = requestProfiler(
+    enabled=os.environ.get("OMRON_PROFILING_ENABLED", "0").lower() in ("1", "true", "yes"),
+    profileDirectory=os.environ.get("OMRON_PROFILE_DIR", "profiles"),
+    maxProfiles=int(os.environ.get("OMRON_PROFILE_KEEP", "50")),
+    slowCallbackS=float(os.environ.get("OMRON_SLOW_CALLBACK_S", "0.1")),
+)
+
+@app.middleware("http")
+async def profiling_middleware(request: Request, call_next):
+    if not request_profiler.isRequested(request.headers, request.query_params):
+        return await call_next(request)
+    response, profile_name = await request_profiler.profile(f"{request.method} {request.url.path}", call_next(request))
+    if profile_name is not None:
+        response.headers["X-Profile-File"] = profile_name
+    return response
 
 # Model untuk input pengguna
 class BLEDevice(BaseModel):
@@ -39,6 +139,12 @@ class ConnectAndReadInput(BaseModel):
     new_records_only: bool
     sync_time: bool
     pairing: bool
+    max_age: Optional[float] = None  # detik, cache yang lebih tua dari ini memaksa pembacaan langsung dari perangkat
+
+class SyncJobInput(BaseModel):
+    mac_address: str
+    new_records_only: bool = False
+    sync_time: bool = False
     
 RX_CHANNEL_UUIDS = [
     "49123040-aee8-11e1-a74d-0002a5d5c51b",
@@ -48,48 +154,6 @@ RX_CHANNEL_UUIDS = [
 ]
 ble_client = None 
 
-def parse_device_dt(dt):
-    """
-    Terima string atau datetime. Return datetime object (naive, lokal).
-    Menerima format "YYYY-MM-DD HH:MM:SS" dan ISO "YYYY-MM-DDTHH:MM:SS".
-    """
-    if isinstance(dt, datetime):
-        return dt
-    if not isinstance(dt, str):
-        raise ValueError("unsupported datetime type: %r" % type(dt))
-    # coba iso first (handles both 'T' and space in py3.11+)
-    try:
-        # Python 3.11/3.12: fromisoformat accepts both 'T' and ' '
-        return datetime.fromisoformat(dt)
-    except Exception:
-        # fallback: common format with space
-        for fmt in ("%Y-%m-%d %H:%M:%S", "%Y/%m/%d %H:%M:%S"):
-            try:
-                return datetime.strptime(dt, fmt)
-            except Exception:
-                pass
-    # kalau masih gagal, raise
-    raise ValueError(f"Cannot parse datetime string: {dt!r}")
-
-def normalize_records_datetime(records):
-    """
-    records: List[List[dict]] (per_user -> list of dicts)
-    Parses each record['datetime'] into a datetime object and stores original as record['_device_datetime_raw'].
-    Returns a NEW nested list (deepcopy) so source isn't mutated.
-    """
-    recs_copy = deepcopy(records)
-    for per_user in recs_copy:
-        for rec in per_user:
-            if "datetime" in rec:
-                raw = rec["datetime"]
-                try:
-                    dtobj = parse_device_dt(raw)
-                except Exception:
-                    # jika parsing gagal, set now() as fallback but keep raw
-                    dtobj = datetime.now()
-                rec["datetime"] = dtobj
-    return recs_copy
-
 def adjust_latest_to_today_non_destructive(latest_record, anchor_dt=None):
     """
     Return a copy of latest_record with date replaced to today's date, keep time.
@@ -102,180 +166,314 @@ def adjust_latest_to_today_non_destructive(latest_record, anchor_dt=None):
     rec["datetime"] = dt.replace(year=anchor_dt.year, month=anchor_dt.month, day=anchor_dt.day)
     return rec
 
-def generate_record_id(record): #Generate ID
-    """Generate unique ID from datetime"""
-    dt_str = record["datetime"].strftime("%Y%m%d%H%M%S") if isinstance(record["datetime"], datetime) else record["datetime"].replace("-", "").replace(":", "").replace(" ", "")
-    # Tambahkan sys/dia/bpm untuk extra uniqueness
-    unique_str = f"{dt_str}_{record['sys']}_{record['dia']}_{record['bpm']}"
-    return hashlib.md5(unique_str.encode()).hexdigest()[:12]  # 12 char hex
+class FastJSONResponse(Response):
+    """JSON response without jsonable_encoder, datetimes are written as "YYYY-MM-DD HH:MM:SS"."""
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return dumpsJson(content)
+
+def negotiate_media_type(request: Request, supported=None):
+    """
+    Format dari header Accept, dipanggil di awal endpoint sebelum membaca perangkat
+    sehingga format yang tidak didukung langsung dijawab 406.
+    """
+    supported = availableMediaTypes() if supported is None else supported
+    media_type = negotiateMediaType(request.headers.get("accept"), supported)
+    if media_type is None:
+        raise HTTPException(status_code=406, detail=f"Supported formats: {', '.join(supported)}")
+    return media_type
+
+def records_response(request: Request, content, media_type):
+    """
+    Record response in media_type (see negotiate_media_type: rows, columnar json, msgpack or arrow),
+    compressed with br/gzip according to Accept-Encoding when the body is large.
+    Carries a strong ETag, GET requests with a matching If-None-Match get a 304 without encoding the body.
+    """
+    etag = recordSetEtag(content, media_type)
+    headers = {"Vary": "Accept, Accept-Encoding"}
+    if request.method in ("GET", "HEAD") and etagMatches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={**headers, "ETag": etag})
+    body, content_encoding = compressBody(encodeRecordsBody(content, media_type), request.headers.get("accept-encoding"))
+    headers["ETag"] = etagWithEncoding(etag, content_encoding)
+    if content_encoding is not None:
+        headers["Content-Encoding"] = content_encoding
+    return Response(body, media_type=media_type, headers=headers)
 
 
 @app.get("/")
 def read_root():
     return {"message": "Omron BLE Python Backend is running"}
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Histogram durasi tiap fase BLE dan counter retry/timeout/CRC/record dalam format Prometheus."""
+    return PlainTextResponse(await ble_backend.metrics(), media_type="text/plain; version=0.0.4")
+
 @app.get("/scan")
 async def scan_devices():
     """Memindai perangkat BLE."""
     try:
-        devices = await scanBLEDevices()
+        devices = await ble_backend.scan()
         return {"devices": devices, "message": "Perangkat BLE berhasil dipindai"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Tolong hidupkan bluetooth: {str(e)}")
     
 
+async def read_device_session(data: ConnectAndReadInput):
+    """
+    Records from the cache when the request does not change device state,
+    otherwise (unread counter / time sync) a live BLE session.
+    """
+    if data.new_records_only or data.sync_time:
+        if storage_writer is not None:
+            # backpressure: tidak memulai sesi BLE baru selama penulisan CSV masih tertinggal
+            await storage_writer.waitForCapacity()
+        return await ble_backend.readDevice(
+            data.mac_address,
+            useUnreadCounter=data.new_records_only,
+            syncTime=data.sync_time,
+        )
+    return await ble_backend.cachedRead(data.mac_address, data.max_age)
+
+async def cancel_on_disconnect(request: Request, coro, poll_interval=0.5):
+    """
+    Await coro, but cancel it as soon as the HTTP client disconnects,
+    so that an abandoned request does not keep the device busy.
+    """
+    task = asyncio.create_task(coro)
+    while True:
+        done, _ = await asyncio.wait({task}, timeout=poll_interval)
+        if done:
+            return task.result()
+        if await request.is_disconnected():
+            logger.info(f"client of {request.url.path} disconnected, cancelling BLE session")
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            raise HTTPException(status_code=499, detail="Client closed request.")
+
+async def pair_device(data: ConnectAndReadInput):
+    await ble_backend.readDevice(data.mac_address, pairing=True)
+    return { "message": "Pairing successful." }
+
+def format_fetched_at(session):
+    if "fetched_at" not in session:
+        return None
+    return formatTimestamp(datetime.fromtimestamp(session["fetched_at"]))
+
+def format_records_response(session):
+    """All records of a session, newest first, with id and string datetime."""
+    # Normalize, ID dan sort dalam satu langkah tanpa deepcopy, JANGAN adjust
+    all_records = prepareRecords(session["records"], newestFirst=True)
+
+    return {
+        "message": "Data read successfully.",
+        "mac_address": session["mac_address"],
+        "device_name": session["device_name"],
+        "fetched_at": format_fetched_at(session),
+        "records": all_records  # ✅ datetime sudah string
+    }
+
 @app.post("/latest-bp-records")
-async def connect_and_read_latest(data: ConnectAndReadInput):
+async def connect_and_read_latest(data: ConnectAndReadInput, request: Request):
     """
     Menghubungkan ke perangkat Omron dan hanya membaca data pengukuran terbaru.
     Parameter:
     - `pairing`: Jika True, hanya melakukan pairing.
     - `sync_time`: Jika True, menyinkronkan waktu perangkat.
+    - `max_age`: Umur maksimum cache (detik) sebelum dibaca ulang dari perangkat.
     """
+    # Record terbaru hanya tersedia sebagai JSON
+    negotiate_media_type(request, [mediaTypeJson])
     try:
-        devices = await BleakScanner.discover()
-        selected_device = next((dev for dev in devices if dev.address == data.mac_address), None)
-        if not selected_device:
-            raise HTTPException(status_code=404, detail="Device not found during scan.")
-        
-        client = BleakClient(selected_device.address)
-        print("Device: ", selected_device.address, selected_device.name)
-        try:
-            await client.connect()
-            await client.pair(protection_level=2)
-            if not client.is_connected:
-                raise HTTPException(status_code=500, detail="Failed to connect to the BLE device.")
-
-            bluetoothTxRxObj = bluetoothTxRxHandler(client)
-            dev_driver = deviceSpecificDriver()
-
-            if data.pairing:
-                if hasattr(dev_driver, "deviceUseLockUnlock") and dev_driver.deviceUseLockUnlock:
-                # if dev_driver.deviceUseLockUnlock:
-                    await bluetoothTxRxObj.writeNewUnlockKey()
-                await bluetoothTxRxObj.startTransmission()
-                await bluetoothTxRxObj.endTransmission()
-                return { "message": "Pairing successful." }
-            else:
-                await bluetoothTxRxObj.startTransmission()
-                records = await dev_driver.getRecords(
-                    btobj=bluetoothTxRxObj,
-                    useUnreadCounter=data.new_records_only,
-                    # useUnreadCounter=True, # Hanya baca catatan terbaru
-                    syncTime=data.sync_time,
-                )
-
-                normalized = normalize_records_datetime(records)
-                flat = [rec for per_user in normalized for rec in per_user]
-                            
-                # Ambil yang terbaru berdasarkan datetime object
-                latest_device_record = max(flat, key=lambda r: r["datetime"])
-
-                # JANGAN adjust lagi - langsung pakai data asli
-                # latest_corrected = adjust_latest_to_today_non_destructive(latest_device_record)
-
-                # Generate ID
-                latest_device_record["id"] = generate_record_id(latest_device_record)
-                
-                # serializable
-                lr = dict(latest_device_record)
-                if isinstance(lr["datetime"], datetime):
-                    lr["datetime"] = lr["datetime"].strftime("%Y-%m-%d %H:%M:%S")
-                    # lr["datetime"] = lr["datetime"].isoformat()
-                return {
-                    "message": "Newest record read with success.",
-                    "mac_address": selected_device.address,
-                    "device_name": selected_device.name,
-                    "latest_record": lr
-                }
-        finally:
-            if client.is_connected:
-                await client.disconnect()
+        if data.pairing:
+            return await cancel_on_disconnect(request, pair_device(data))
+
+        session = await cancel_on_disconnect(request, read_device_session(data))
+
+        # Ambil yang terbaru berdasarkan datetime object, sudah dengan ID dan datetime string
+        # JANGAN adjust lagi - langsung pakai data asli
+        # latest_corrected = adjust_latest_to_today_non_destructive(latest_device_record)
+        lr = latestRecord(session["records"])
+        if lr is None:
+            raise HTTPException(status_code=404, detail="No records found.")
+
+        return FastJSONResponse({
+            "message": "Newest record read with success.",
+            "mac_address": session["mac_address"],
+            "device_name": session["device_name"],
+            "fetched_at": format_fetched_at(session),
+            "latest_record": lr
+        })
+    except HTTPException:
+        raise
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
 @app.post("/connect-and-read")
-async def connect_and_read(data: ConnectAndReadInput):
+async def connect_and_read(data: ConnectAndReadInput, request: Request):
     """
     Menghubungkan ke perangkat Omron, membaca data, dan menyimpannya ke CSV/JSON.
     Parameter:
     - `pairing`: Jika True, hanya melakukan pairing.
     - `new_records_only`: Jika True, hanya membaca catatan baru.
     - `sync_time`: Jika True, menyinkronkan waktu perangkat.
+    - `max_age`: Umur maksimum cache (detik) sebelum dibaca ulang dari perangkat.
     """
+    media_type = negotiate_media_type(request)
     try:
-        devices = await BleakScanner.discover()
-        selected_device = next((dev for dev in devices if dev.address == data.mac_address), None)
-        if not selected_device:
-            raise HTTPException(status_code=404, detail="Device not found during scan.")
-        
-        client = BleakClient(selected_device.address)
-        print("Device: ", selected_device.address, selected_device.name)
-        try:
-            await client.connect()
-            await client.pair(protection_level=2)
-            if not client.is_connected:
-                raise HTTPException(status_code=500, detail="Failed to connect to the BLE device.")
-
-            bluetoothTxRxObj = bluetoothTxRxHandler(client)
-            dev_driver = deviceSpecificDriver()
-
-            if data.pairing:
-                if hasattr(dev_driver, "deviceUseLockUnlock") and dev_driver.deviceUseLockUnlock:
-                    await bluetoothTxRxObj.writeNewUnlockKey()
-                await bluetoothTxRxObj.startTransmission()
-                await bluetoothTxRxObj.endTransmission()
-                return { "message": "Pairing successful." }
-            else:
-                await bluetoothTxRxObj.startTransmission()
-                records = await dev_driver.getRecords(
-                    btobj=bluetoothTxRxObj,
-                    useUnreadCounter=data.new_records_only,
-                    syncTime=data.sync_time,
-                )
-
-                # HANYA normalize, JANGAN adjust
-                normalized = normalize_records_datetime(records)
-
-                
-
-                #Tanpa save ke CSV & JSON 
-                # Flatten dan SORT DULU berdasarkan datetime object
-                all_records = []
-                for user_records in normalized:
-                    for rec in user_records:
-                        all_records.append(rec)
-                
-                # Sort berdasarkan datetime object (TERBARU KE TERLAMA)
-                all_records.sort(key=lambda r: r["datetime"], reverse=True)
-                
-                # BARU convert datetime ke string setelah sorting
-                for rec in all_records:
-                    rec["id"] = generate_record_id(rec) # Generate ID sebelum convert datetime ke string
-                    if isinstance(rec["datetime"], datetime):
-                        rec["datetime"] = rec["datetime"].strftime("%Y-%m-%d %H:%M:%S")
-
-                return {
-                    "message": "Data read successfully.",
-                    "mac_address": selected_device.address,
-                    "device_name": selected_device.name,
-                    "records": all_records  # ✅ datetime sudah string
-                }
-
-                                # Simpan langsung tanpa koreksi waktu
-                # appendCsv(normalized)
-                # saveUBPMJson(normalized)
-
-                # return {
-                #     "message": "Data read successfully.",
-                #     "mac_address": selected_device.address,
-                #     "device_name": selected_device.name,
-                #     "records": [r for u in normalized for r in u]
-                # }
-        finally:
-            if client.is_connected:
-                await client.disconnect()
+        if data.pairing:
+            return await cancel_on_disconnect(request, pair_device(data))
+
+        session = await cancel_on_disconnect(request, read_device_session(data))
+        # CSV/JSON ditulis oleh storage_writer bila OMRON_CSV_DIR diisi
+        return records_response(request, format_records_response(session), media_type)
+    except HTTPException:
+        raise
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
-        import traceback
-        print("TRACEBACK:", traceback.format_exc())
-        raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
\ No newline at end of file
+        logger.exception("connect-and-read failed")
+        raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
+
+@app.get("/records")
+async def get_records(
+    request: Request,
+    device: Optional[str] = None,
+    mac_address: Optional[str] = None,
+    user: Optional[int] = Query(None, ge=1),
+    limit: int = Query(100, ge=1, le=10000),
+    cursor: Optional[str] = None,
+    from_: Optional[str] = Query(None, alias="from"),
+    to: Optional[str] = None,
+):
+    """
+    Record tersimpan di journal (tanpa membaca perangkat), terbaru lebih dulu. Setiap record membawa `mac_address` dan `user`.
+    - `device` (atau `mac_address`) / `user`: filter opsional, tanpa filter record semua perangkat digabung.
+    - `limit`: jumlah record per halaman, `next_cursor` dari respons dipakai sebagai `cursor` halaman berikutnya.
+    - `from` / `to`: batas datetime (inklusif), misalnya `2024-05-01` atau `2024-05-01 12:00:00`; `to` tanpa jam berarti sampai akhir hari itu.
+    - `If-None-Match` dengan ETag sebelumnya dijawab 304 bila halaman tidak berubah.
+    """
+    media_type = negotiate_media_type(request)
+    device = device or mac_address
+    try:
+        changes, next_cursor = record_store.queryRecords(device, user, from_, to, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return records_response(request, {
+        "device": device.upper() if device else None,
+        "user": user,
+        "next_cursor": next_cursor,
+        "records": [{**change["record"], "mac_address": change["mac_address"], "user": change["user"]} for change in changes],
+    }, media_type)
+
+@app.get("/stats")
+async def get_stats(
+    device: Optional[str] = None,
+    user: Optional[int] = Query(None, ge=1),
+    bucket: str = Query("day", pattern="^(day|week|month)$"),
+    from_: Optional[str] = Query(None, alias="from"),
+    to: Optional[str] = None,
+):
+    """
+    Rata-rata/min/max/jumlah per `bucket` (day, week, month) dari statistik tersimpan, per perangkat dan user.
+    `from` / `to` membatasi bucket yang mengandung tanggal tersebut, ukuran respons mengikuti rentang yang diminta.
+    """
+    try:
+        from_day = formatTimestamp(parseDeviceDatetime(from_))[:10] if from_ is not None else None
+        to_day = formatTimestamp(parseDeviceDatetime(to))[:10] if to is not None else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    series = []
+    for mac, device_user in record_aggregates.devices():
+        if (device is not None and mac != device.upper()) or (user is not None and device_user != user):
+            continue
+        series.append({"mac_address": mac, "user": device_user, "buckets": record_aggregates.buckets(mac, device_user, bucket, from_day, to_day)})
+    return FastJSONResponse({"bucket": bucket, "from": from_day, "to": to_day, "series": series})
+
+def format_sync_job(job):
+    """Job dari backend BLE, hasil job (sesi) diformat seperti /connect-and-read."""
+    if job["result"] is not None:
+        job = {**job, "result": format_records_response(job["result"])}
+    return job
+
+@app.post("/sync", status_code=202)
+async def start_sync_job(data: SyncJobInput):
+    """
+    Memulai sinkronisasi di latar belakang dan langsung mengembalikan job_id.
+    Status, progres per blok EEPROM dan hasil bisa dipantau lewat `GET /jobs/{job_id}`.
+    """
+    job = await ble_backend.submitSyncJob(data.mac_address, newRecordsOnly=data.new_records_only, syncTime=data.sync_time)
+    return {"job_id": job["job_id"], "status": job["status"]}
+
+@app.get("/jobs/{job_id}")
+async def get_sync_job(job_id: str):
+    job = await ble_backend.getSyncJob(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return FastJSONResponse(format_sync_job(job))
+
+@app.delete("/jobs/{job_id}")
+async def cancel_sync_job(job_id: str):
+    job = await ble_backend.cancelSyncJob(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return {"job_id": job["job_id"], "status": job["status"] if job["finished_at"] is not None else "cancelling"}
+
+@app.get("/changes")
+async def get_changes(
+    request: Request,
+    since: int = Query(0, ge=0),
+    limit: int = Query(500, ge=1, le=10000),
+    wait: float = Query(0, ge=0, le=60),
+):
+    """
+    Record baru dari semua perangkat setelah cursor `since` (nomor urut perubahan), beserta `next_cursor`.
+    Dengan `wait` > 0 request ditahan (long-poll) sampai ada record baru atau `wait` detik berlalu.
+    """
+    try:
+        changes, next_cursor = record_store.changesSince(since, limit)
+        if not changes and wait > 0:
+            await cancel_on_disconnect(request, record_store.waitForChanges(since, wait))
+            changes, next_cursor = record_store.changesSince(since, limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return FastJSONResponse({
+        "changes": changes,
+        "next_cursor": next_cursor,
+        "has_more": next_cursor < record_store.lastSeq,
+    })
+
+@app.get("/aggregates")
+async def get_aggregates(mac_address: str, user: int = Query(1, ge=1)):
+    """
+    Statistik tersimpan satu user perangkat tanpa membaca seluruh riwayat: hari, minggu dan bulan terakhir,
+    rata-rata 7 hari bergulir serta rata-rata pagi dan malam dalam 7 hari tersebut.
+    """
+    summary = record_aggregates.summary(mac_address, user)
+    if summary is None:
+        raise HTTPException(status_code=404, detail="No records of this device user.")
+    return FastJSONResponse(summary)
+
+@app.websocket("/ws/records")
+async def subscribe_records(websocket: WebSocket):
+    """
+    Mengirim setiap record baru (dari jalur sinkronisasi mana pun) ke dashboard yang berlangganan.
+    Filter opsional lewat query `mac_address` dan `user`, keduanya boleh diulang.
+    Pesan: `{"type": "record", "seq", "mac_address", "device_name", "user", "record"}` dan `{"type": "heartbeat"}`.
+    """
+    try:
+        users = [int(user) for user in websocket.query_params.getlist("user")]
+    except ValueError:
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+    try:
+        await ws_hub.serve(websocket, macAddrs=websocket.query_params.getlist("mac_address"), users=users)
+    except WebSocketDisconnect:
+        pass
@@ -5,10 +5,17 @@ import re                                                           #regex to ma
 import argparse                                                     #to process command line arguments
 import datetime
 import sys
+import os
 import pathlib
 import logging
 import csv
 import json
+import tempfile
+import time
+from bleTrace import traceRecorder, unlockChannelIdx
+from csvColumnCache import loadCsvColumns
+from timestampCodec import parseTimestamp, formatTimestamp, toDatetimeList
+from bleMetrics import blePhaseSeconds, bleBlockRoundTripSeconds, bleRetriesTotal, bleTimeoutsTotal, bleCrcErrorsTotal, bleSessionsInFlight, renderPrometheusText
 
 #global constants
 parentService_UUID        = "ecbe3980-c9a2-11e1-b1bd-0002a5d5c51b"
@@ -23,6 +30,57 @@ def convertByteArrayToHexString(array):
     return (bytes(array).hex())
 
 
+class advertisementTracker:
+    #omron devices update their advertisement payload when new measurements are stored,
+    #remembering the last payload per mac address allows a poller to skip devices without changes
+    def __init__(self, maxStalenessS = 6 * 3600.0):
+        self.maxStalenessS   = maxStalenessS    #sync anyway if the last sync is older than this
+        self.lastPayloads    = dict()           #mac -> fingerprint of the last seen advertisement
+        self.lastSeenTimes   = dict()           #mac -> monotonic time of the last seen advertisement
+        self.lastChangeTimes = dict()           #mac -> monotonic time of the last advertisement change
+        self.lastSyncTimes   = dict()           #mac -> monotonic time of the last successful sync
+
+    @staticmethod
+    def _advertisementFingerprint(bleDev, advData):
+        #rssi and tx power vary with every packet, so they are not part of the comparison
+        #the omron status flags are carried inside the manufacturer specific data
+        return (
+            advData.local_name or bleDev.name,
+            tuple(sorted((companyId, bytes(payload)) for companyId, payload in advData.manufacturer_data.items())),
+            tuple(sorted((uuid, bytes(payload)) for uuid, payload in advData.service_data.items())),
+            tuple(sorted(advData.service_uuids)),
+        )
+
+    def update(self, macAddr, bleDev, advData):
+        macAddr     = macAddr.upper()
+        fingerprint = self._advertisementFingerprint(bleDev, advData)
+        now         = time.monotonic()
+        self.lastSeenTimes[macAddr] = now
+        if(self.lastPayloads.get(macAddr) == fingerprint):
+            return False
+        if(macAddr in self.lastPayloads):
+            logger.debug(f"advertisement of {macAddr} changed: {self.lastPayloads[macAddr]} -> {fingerprint}")
+        self.lastPayloads[macAddr]    = fingerprint
+        self.lastChangeTimes[macAddr] = now
+        return True
+
+    def needsSync(self, macAddr):
+        macAddr  = macAddr.upper()
+        lastSync = self.lastSyncTimes.get(macAddr)
+        if(lastSync is None):
+            return True
+        if(self.lastChangeTimes.get(macAddr, lastSync) > lastSync):
+            return True
+        return (time.monotonic() - lastSync) >= self.maxStalenessS
+
+    def markSynced(self, macAddr, syncStartTime = None):
+        #pass the monotonic time at which the sync started, so that changes seen during the sync are not lost
+        self.lastSyncTimes[macAddr.upper()] = time.monotonic() if syncStartTime is None else syncStartTime
+
+
+advTracker = advertisementTracker()                     #shared by all scans of this process
+
+
 class bluetoothTxRxHandler:
     #BTLE Characteristic IDs
     deviceRxChannelUUIDs  = [
@@ -41,14 +99,19 @@ class bluetoothTxRxHandler:
     deviceDataRxChannelIntHandles = [31,0x31 ]
     deviceUnlock_UUID         = "b305b680-aee7-11e1-a730-0002a5d5c51b"
 
-    def __init__(self, ble_client, pairing=False):
+    def __init__(self, ble_client, pairing=False, traceRecorder=None):
         self.ble_client = ble_client
+        self.traceRecorder = traceRecorder #optional bleTrace.traceRecorder, records every tx write and rx notification
         self.currentRxNotifyStateFlag = False
         self.rxPacketType = None
         self.rxEepromAddress = None
         self.rxDataBytes = None
         self.rxFinishedFlag = False
         self.rxRawChannelBuffer = [None] * 4 #a buffer for each channel
+        self.transmissionActive = False
+
+    def _deviceLabel(self):
+        return getattr(self.ble_client, "address", "unknown")
 
     async def _enableRxChannelNotifyAndCallback(self):
         if(self.currentRxNotifyStateFlag != True):
@@ -74,6 +137,8 @@ class bluetoothTxRxHandler:
         else:
             rxChannelId = self.deviceDataRxChannelIntHandles.index(BleakGATTChar.handle)
         self.rxRawChannelBuffer[rxChannelId] = rxBytes
+        if self.traceRecorder is not None:
+            self.traceRecorder.recordRx(rxChannelId, rxBytes)
 
         logger.debug(f"rx ch{rxChannelId} < {convertByteArrayToHexString(rxBytes)}")
         if self.rxRawChannelBuffer[0]:                               #if there is data present in the first rx buffer
@@ -93,6 +158,7 @@ class bluetoothTxRxHandler:
             for byte in combinedRawRx:
                 xorCrc ^= byte
             if(xorCrc):
+                bleCrcErrorsTotal.inc(device=self._deviceLabel())
                 raise ValueError(f"data corruption in rx\ncrc: {xorCrc}\ncombniedBuffer: {convertByteArrayToHexString(combinedRawRx)}")
                 return
             #extract information
@@ -119,6 +185,8 @@ class bluetoothTxRxHandler:
             requiredTxChannels = range((len(command) + 15) // 16)
             for channelIdx in requiredTxChannels:
                 logger.debug(f"tx ch{channelIdx} > {convertByteArrayToHexString(commandCopy[:16])}")
+                if self.traceRecorder is not None:
+                    self.traceRecorder.recordTx(channelIdx, commandCopy[:16])
                 await self.ble_client.write_gatt_char(self.deviceTxChannelUUIDs[channelIdx], commandCopy[:16])
                 commandCopy = commandCopy[16:]
 
@@ -131,29 +199,48 @@ class bluetoothTxRxHandler:
             if(currentTimeout >= 0):
                 break
             retries += 1
+            bleTimeoutsTotal.inc(device=self._deviceLabel())
             logger.warning(f"Transmission failed, count of retries: {retries} / 3")
             if(retries >= 3):
                 ValueError("Same transmission failed 3 times, abort")
                 return
+            bleRetriesTotal.inc(device=self._deviceLabel())
 
     async def startTransmission(self):
-        await self._enableRxChannelNotifyAndCallback()
-        startDataReadout    = bytearray.fromhex("0800000000100018")
-        await self._waitForRxOrRetry(startDataReadout)
+        with blePhaseSeconds.time(phase="start_transmission"):
+            await self._enableRxChannelNotifyAndCallback()
+            startDataReadout    = bytearray.fromhex("0800000000100018")
+            self.transmissionActive = True
+            await self._waitForRxOrRetry(startDataReadout)
         if(self.rxPacketType != bytearray.fromhex("8000")):
             raise ValueError("invalid response to data readout start")
 
     async def endTransmission(self):
         stopDataReadout         = bytearray.fromhex("080f000000000007")
-        await self._waitForRxOrRetry(stopDataReadout)
+        with blePhaseSeconds.time(phase="end_transmission"):
+            await self._waitForRxOrRetry(stopDataReadout)
         if(self.rxPacketType != bytearray.fromhex("8f00")):
             raise ValueError("invlid response to data readout end")
             return
         if(self.rxDataBytes[0]):
             raise ValueError(f"Device reported error status code {self.rxDataBytes[0]} while sending endTransmission command.")
             return
+        self.transmissionActive = False
         await self._disableRxChannelNotifyAndCallback()
 
+    async def abortTransmission(self, timeoutS = 2.0):
+        #best effort end of an interrupted transmission, e.g. after the caller was cancelled
+        #gives up after timeoutS so that the following disconnect is not delayed further
+        if(not self.transmissionActive):
+            return
+        try:
+            await asyncio.wait_for(self.endTransmission(), timeoutS)
+            logger.info("interrupted transmission ended cleanly")
+        except Exception as e:
+            #also BleakError / OSError of a dropped link, the cancellation of the caller must not be replaced
+            logger.warning(f"could not end interrupted transmission: {e!r}")
+        self.transmissionActive = False
+
     async def _writeBlockEeprom(self, address, dataByteArray):
         dataWriteCommand = bytearray()
         dataWriteCommand += (len(dataByteArray) + 8).to_bytes(1, 'big') #total packet size with 6byte header and 2byte crc
@@ -167,7 +254,8 @@ class bluetoothTxRxHandler:
             xorCrc ^= byte
         dataWriteCommand += b'\x00'
         dataWriteCommand.append(xorCrc)
-        await self._waitForRxOrRetry(dataWriteCommand)
+        with bleBlockRoundTripSeconds.time(operation="write"):
+            await self._waitForRxOrRetry(dataWriteCommand)
         if(self.rxEepromAddress != address.to_bytes(2, 'big')):
             raise ValueError(f"recieved packet address {self.rxEepromAddress} does not match the written address {address.to_bytes(2, 'big')}")
         if(self.rxPacketType != bytearray.fromhex("81c0")):
@@ -184,7 +272,8 @@ class bluetoothTxRxHandler:
             xorCrc ^= byte
         dataReadCommand += b'\x00'
         dataReadCommand.append(xorCrc)
-        await self._waitForRxOrRetry(dataReadCommand)
+        with bleBlockRoundTripSeconds.time(operation="read"):
+            await self._waitForRxOrRetry(dataReadCommand)
         if(self.rxEepromAddress != address.to_bytes(2, 'big')):
             raise ValueError(f"revieved packet address {self.rxEepromAddress} does not match requested address {address.to_bytes(2, 'big')}")
         if(self.rxPacketType != bytearray.fromhex("8100")):
@@ -200,7 +289,8 @@ class bluetoothTxRxHandler:
             startAddress += nextSubblockSize
         return
 
-    async def readContinuousEepromData(self, startAddress, bytesToRead, btBlockSize = 0x10):
+    async def readContinuousEepromData(self, startAddress, bytesToRead, btBlockSize = 0x10, progressCallback = None):
+        #progressCallback is called with the number of bytes of each finished block
         eepromBytesData = bytearray()
         while(bytesToRead != 0):
             nextSubblockSize = min(bytesToRead, btBlockSize)
@@ -208,13 +298,22 @@ class bluetoothTxRxHandler:
             eepromBytesData += await self._readBlockEeprom(startAddress, nextSubblockSize)
             startAddress    += nextSubblockSize
             bytesToRead     -= nextSubblockSize
+            if progressCallback is not None:
+                progressCallback(nextSubblockSize)
         return eepromBytesData
 
     def _callbackForUnlockChannel(self, UUID_or_intHandle, rxBytes):
+        if self.traceRecorder is not None:
+            self.traceRecorder.recordRx(unlockChannelIdx, rxBytes)
         self.rxDataBytes = rxBytes
         self.rxFinishedFlag = True
         return
 
+    async def _writeUnlockChannel(self, dataBytes):
+        if self.traceRecorder is not None:
+            self.traceRecorder.recordTx(unlockChannelIdx, dataBytes)
+        await self.ble_client.write_gatt_char(self.deviceUnlock_UUID, dataBytes, response=True)
+
     async def writeNewUnlockKey(self, newKeyByteArray = examplePairingKey):
         if(len(newKeyByteArray) != 16):
             raise ValueError(f"key has to be 16 bytes long, is {len(newKeyByteArray)}")
@@ -222,7 +321,7 @@ class bluetoothTxRxHandler:
         #enable key programming mode
         await self.ble_client.start_notify(self.deviceUnlock_UUID, self._callbackForUnlockChannel)
         self.rxFinishedFlag = False
-        await self.ble_client.write_gatt_char(self.deviceUnlock_UUID, b'\x02' + b'\x00'*16, response=True)
+        await self._writeUnlockChannel(b'\x02' + b'\x00'*16)
         while(self.rxFinishedFlag == False):
             await asyncio.sleep(0.1)
         deviceResponse = self.rxDataBytes
@@ -231,7 +330,7 @@ class bluetoothTxRxHandler:
             return
         #program new key
         self.rxFinishedFlag = False
-        await self.ble_client.write_gatt_char(self.deviceUnlock_UUID, b'\x00' + newKeyByteArray, response=True)
+        await self._writeUnlockChannel(b'\x00' + newKeyByteArray)
         while(self.rxFinishedFlag == False):
             await asyncio.sleep(0.1)
         deviceResponse = self.rxDataBytes
@@ -246,7 +345,7 @@ class bluetoothTxRxHandler:
     async def unlockWithUnlockKey(self, keyByteArray = examplePairingKey):
         await self.ble_client.start_notify(self.deviceUnlock_UUID, self._callbackForUnlockChannel)
         self.rxFinishedFlag = False
-        await self.ble_client.write_gatt_char(self.deviceUnlock_UUID, b'\x01' + keyByteArray, response=True)
+        await self._writeUnlockChannel(b'\x01' + keyByteArray)
         while(self.rxFinishedFlag == False):
             await asyncio.sleep(0.1)
         deviceResponse = self.rxDataBytes
@@ -257,46 +356,78 @@ class bluetoothTxRxHandler:
         return
 
 def readCsv(filename):
-    records = []
-    with open(filename, mode='r', newline='', encoding='utf-8') as infile:
-        reader = csv.DictReader(infile)
-        for oldRecordDict in reader:
-            oldRecordDict["datetime"] = datetime.datetime.strptime(oldRecordDict["datetime"], "%Y-%m-%d %H:%M:%S")
-            records.append(oldRecordDict)
-    return records
-
-def appendCsv(allRecords):
+    #parsed once into a binary sidecar next to the csv, later runs only parse appended lines
+    records = loadCsvColumns(filename)
+    columns = {field: records[field].tolist() for field in records.dtype.names}
+    columns["datetime"] = toDatetimeList(records["datetime"])
+    return [dict(zip(columns, values)) for values in zip(*columns.values())]
+
+#NamedTemporaryFile creates files readable only by the owner, the written files get the usual permissions
+processUmask = os.umask(0o022)
+os.umask(processUmask)
+fileCreationMode = 0o666 & ~processUmask
+
+def _writeFileAtomically(path, writeContent, **openArgs):
+    #temp file + rename, readers and a crash never see a half written file.
+    #the temp file name is unique, so that processes writing the same file do not write into each other's temp file
+    tmpFile = tempfile.NamedTemporaryFile("w", dir = path.parent, prefix = path.name + ".", suffix = ".tmp", delete = False, **openArgs)
+    try:
+        with tmpFile:
+            writeContent(tmpFile)
+            tmpFile.flush()
+            os.fsync(tmpFile.fileno())
+        os.chmod(tmpFile.name, fileCreationMode)
+        os.replace(tmpFile.name, path)
+    except BaseException:
+        os.unlink(tmpFile.name)
+        raise
+
+def mergeIntoCsv(csvFile, newRecords, backupFile = None):
+    """
+    Merge records (datetime as datetime.datetime) into a csv history, a record replaces an old one with the same datetime.
+    Returns all records of the file sorted by datetime, with the datetime formatted as "YYYY-MM-DD HH:MM:SS".
+    Without new records the file is only read, it is neither backed up nor rewritten.
+    """
+    csvFile = pathlib.Path(csvFile)
+    if not newRecords:
+        oldRecords = readCsv(csvFile) if csvFile.is_file() else []
+        return [{**record, "datetime": formatTimestamp(record["datetime"])} for record in oldRecords]
+    datesOfNewRecords = {record["datetime"] for record in newRecords}
+    if(csvFile.is_file()):
+        if backupFile is not None:
+            backupFile.write_bytes(csvFile.read_bytes())
+        newRecords.extend(filter(lambda x: x["datetime"] not in datesOfNewRecords, readCsv(csvFile)))
+    mergedRecords = sorted(newRecords, key = lambda x: x["datetime"])
+    logger.info(f"writing data to {csvFile}")
+    def writeRecords(outfile):
+        writer = csv.DictWriter(outfile, fieldnames = ["datetime", "dia", "sys", "bpm", "mov", "ihb"])
+        writer.writeheader()
+        for recordDict in mergedRecords:
+            recordDict["datetime"] = formatTimestamp(recordDict["datetime"])
+            writer.writerow(recordDict)
+    _writeFileAtomically(csvFile, writeRecords, newline='', encoding='utf-8')
+    return mergedRecords
+
+def appendCsv(allRecords, directory = "."):
+    directory = pathlib.Path(directory)
     for userIdx in range(len(allRecords)):
-        oldCsvFile = pathlib.Path(f"user{userIdx+1}.csv")
         dateText = datetime.datetime.now().strftime('%Y_%m_%d__%H_%M_%S')
-        backup = pathlib.Path(f"backup_user{userIdx+1}_{dateText}.csv")
-        datesOfNewRecords = [record["datetime"] for record in allRecords[userIdx]]
-        if(oldCsvFile.is_file()):
-            backup.write_bytes(oldCsvFile.read_bytes())
-            records = readCsv(f"user{userIdx+1}.csv")
-            allRecords[userIdx].extend(filter(lambda x: x["datetime"] not in datesOfNewRecords,records))
-        allRecords[userIdx] = sorted(allRecords[userIdx], key = lambda x: x["datetime"])
-        logger.info(f"writing data to user{userIdx+1}.csv")
-        with open(f"user{userIdx+1}.csv", mode='w', newline='', encoding='utf-8') as outfile:
-            writer = csv.DictWriter(outfile, fieldnames = ["datetime", "dia", "sys", "bpm", "mov", "ihb"])
-            writer.writeheader()
-            for recordDict in allRecords[userIdx]:
-                recordDict["datetime"] = recordDict["datetime"].strftime("%Y-%m-%d %H:%M:%S")
-                writer.writerow(recordDict)
-
-def saveUBPMJson(allRecords):
-    f = pathlib.Path(f"ubpm.json")
+        backup = directory / f"backup_user{userIdx+1}_{dateText}.csv"
+        allRecords[userIdx] = mergeIntoCsv(directory / f"user{userIdx+1}.csv", allRecords[userIdx], backup)
+
+def saveUBPMJson(allRecords, directory = "."):
+    f = pathlib.Path(directory) / "ubpm.json"
     UBPM = {}
     UBPM["UBPM"] = {}
     for userIdx in range(len(allRecords)):
         UBPM["UBPM"][f"U{userIdx+1}"] = []
         for rec in allRecords[userIdx]:
-            recdate=datetime.datetime.strptime(rec["datetime"], "%Y-%m-%d %H:%M:%S")
+            recdate=parseTimestamp(rec["datetime"])
             UBPM["UBPM"][f"U{userIdx+1}"].append({
-                                "date": recdate.strftime("%d.%m.%Y"),
-                                'time': recdate.strftime("%H:%M:%S"), 'msg': "",
+                                "date": f"{recdate.day:02d}.{recdate.month:02d}.{recdate.year:04d}",
+                                'time': rec["datetime"][11:], 'msg': "",
                                 'sys': int(rec['sys']), 'dia': int(rec['dia']), 'bpm': int(rec['bpm']), 'ihb': int(rec['ihb']), 'mov': int(rec['mov']) })
-    f.write_text(json.dumps(UBPM, indent=4, sort_keys=True, default=str))
+    _writeFileAtomically(f, lambda jsonFile: json.dump(UBPM, jsonFile, indent=4, sort_keys=True, default=str), encoding='utf-8')
 
 async def selectBLEdevices():
     print("Select your Omron device from the list below...")
@@ -304,24 +435,30 @@ async def selectBLEdevices():
         devices = await bleak.BleakScanner.discover(return_adv=True)
         devices = list(sorted(devices.items(), key = lambda x: x[1][1].rssi, reverse=True))
         tableEntries = []
-        tableEntries.append(["ID", "MAC", "NAME", "RSSI"])
+        tableEntries.append(["ID", "MAC", "NAME", "RSSI", "NEW DATA"])
         for deviceIdx, (macAddr, (bleDev, advData)) in enumerate(devices):
-            tableEntries.append([deviceIdx, macAddr, bleDev.name, advData.rssi])
+            advTracker.update(macAddr, bleDev, advData)
+            tableEntries.append([deviceIdx, macAddr, bleDev.name, advData.rssi, "yes" if advTracker.needsSync(macAddr) else "no"])
         print(terminaltables.AsciiTable(tableEntries).table)
         res = input("Enter ID or just press Enter to rescan.\n")
         if(res.isdigit() and int(res) in range(len(devices))):
             break
     return devices[int(res)][0]
 
-async def scanBLEDevices():
+async def scanBLEDevices(scanTimeoutS = 5.0):
     """Scan perangkat BLE tanpa input interaktif."""
     from bleak import BleakScanner
-    devices = await BleakScanner.discover()
-    return [
-        # {"id": idx, "mac": dev.address, "name": dev.name or "Unknown", "rssi": dev.rssi}
-        {"id": idx, "mac": dev.address, "name": dev.name or "Unknown", "rssi": getattr(dev, 'rssi', None)}
-        for idx, dev in enumerate(devices)
-    ]
+    devices = await BleakScanner.discover(timeout=scanTimeoutS, return_adv=True)
+    scanResult = []
+    for idx, (macAddr, (dev, advData)) in enumerate(devices.items()):
+        advTracker.update(macAddr, dev, advData)
+        scanResult.append({"id": idx, "mac": dev.address, "name": dev.name or "Unknown", "rssi": advData.rssi, "has_new_data": advTracker.needsSync(macAddr)})
+    return scanResult
+
+async def scanForDevicesWithNewData(macAddrs, scanTimeoutS = 5.0):
+    """Return the subset of macAddrs which are in range and advertise new data or exceeded the maximum staleness."""
+    seenMacs = {device["mac"].upper() for device in await scanBLEDevices(scanTimeoutS)}
+    return [macAddr for macAddr in macAddrs if macAddr.upper() in seenMacs and advTracker.needsSync(macAddr)]
 
 async def main():
     # global self.ble_client
@@ -333,6 +470,9 @@ async def main():
     parser.add_argument("-m", "--mac",                          type=ascii, help="Bluetooth Mac address of the device (e.g. 00:1b:63:84:45:e6). If not specified, will scan for devices and display a selection dialog.")
     parser.add_argument('-n', "--newRecOnly", action="store_true",          help="Considers the unread records counter and only reads new records. Resets these counters afterwards. If not enabled, all records are read and the unread counters are not cleared.")
     parser.add_argument('-t', "--timeSync",   action="store_true",          help="Update the time on the omron device by using the current system time.")
+    parser.add_argument("--metrics",                            type=str,   help="Write timing histograms and counters of this session in prometheus text format to this file.")
+    parser.add_argument("--captureTrace",                       type=str,   help="Record every tx write and rx notification to this binary trace file, which can be replayed with benchmarkSync.py --replay.")
+    parser.add_argument("--storageDir",                         type=str,   help="Write the records to STORAGEDIR/<mac>/userN.csv with a manifest.json instead of userN.csv in the current directory, several devices can share it.")
     args = parser.parse_args()
 
     #setup logging
@@ -375,11 +515,22 @@ async def main():
         bleAddr = await selectBLEdevices() if args.mac is None else args.mac.strip("'").strip('\"')
     from bleak import BleakClient
     ble_client = BleakClient(bleAddr)
+    bleTraceRecorder = None
+    if(args.captureTrace):
+        bleTraceRecorder = traceRecorder(args.captureTrace, metadata = {"device": args.device.strip("'").strip('\"'), "mac_address": bleAddr,
+                                         "useUnreadCounter": args.newRecOnly, "syncTime": args.timeSync, "pairing": args.pair})
+    #csv / json files are written on their own thread while the ble connection is closed
+    from storageWriter import storageWriter
+    from shardedStorage import shardedStorage
+    recordWriter = storageWriter(shards = shardedStorage(args.storageDir) if args.storageDir else None)
+    bleSessionsInFlight.inc()
     try:
         logger.info(f"Attempt connecting to {bleAddr}.")
-        await ble_client.connect()
+        with blePhaseSeconds.time(phase="connect"):
+            await ble_client.connect()
         await asyncio.sleep(0.5)
-        await ble_client.pair(protection_level=2)
+        with blePhaseSeconds.time(phase="pair"):
+            await ble_client.pair(protection_level=2)
         devSpecificDriver = deviceSpecific.deviceSpecificDriver()
         #verify that the device is an omron device by checking presence of certain bluetooth services
         if devSpecificDriver.deviceCheckParentUUID:
@@ -391,7 +542,7 @@ async def main():
                              This means that either, you connected to a wrong device,
                              or that your OS has a bug when reading BT LE device attributes (certain linux versions).""")
                 return
-        bluetoothTxRxObj = bluetoothTxRxHandler(ble_client)
+        bluetoothTxRxObj = bluetoothTxRxHandler(ble_client, traceRecorder = bleTraceRecorder)
         if(args.pair):
             if devSpecificDriver.deviceUseLockUnlock:
                 await bluetoothTxRxObj.writeNewUnlockKey()
@@ -400,14 +551,18 @@ async def main():
             await bluetoothTxRxObj.endTransmission()
         else:
             logger.info("communication started")
+            syncStartTime = time.monotonic()
             
             allRecs = await devSpecificDriver.getRecords(btobj = bluetoothTxRxObj, useUnreadCounter = args.newRecOnly, syncTime = args.timeSync)
             logger.info("communication finished")
-            appendCsv(allRecs)
-            saveUBPMJson(allRecs)
+            advTracker.markSynced(bleAddr, syncStartTime)
+            recordWriter.submit(allRecs, bleAddr)
     except Exception as e: 
         logger.error("Error occured : " + str(e))
     finally:
+        if bleTraceRecorder is not None:
+            bleTraceRecorder.close()
+            logger.info(f"ble trace written to {args.captureTrace}")
         logger.info("unpair and disconnect")
         if ble_client.is_connected:
 #            await ble_client.unpair()
@@ -417,6 +572,11 @@ async def main():
                 logger.error("Bleak AssertionError during disconnect. This usually happens when using the bluezdbus adapter.")
                 logger.error("You can find the upstream issue at: https://github.com/hbldh/bleak/issues/641")
                 logger.error(f"AssertionError details: {e}")
+        bleSessionsInFlight.dec()
+        await recordWriter.closeAsync()
+        if(args.metrics):
+            pathlib.Path(args.metrics).write_text(renderPrometheusText())
+            logger.info(f"metrics written to {args.metrics}")
 
 # Hanya jalankan main() jika file ini dieksekusi langsung
 if __name__ == "__main__":
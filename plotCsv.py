@@ -1,31 +1,19 @@
 from matplotlib import pyplot as plt
 from matplotlib.widgets import Slider
-from matplotlib.dates import DateFormatter
-import csv
+from matplotlib.dates import DateFormatter, date2num
+from matplotlib.collections import PolyCollection, LineCollection
+from matplotlib.transforms import Bbox
 import numpy
 import argparse
-from datetime import datetime, timedelta
+from datetime import timedelta
 
+from recordBinning import binRecords, binUnits
+from csvColumnCache import loadCsvColumns
 
-parser = argparse.ArgumentParser(description="python tool to plot csv recordings from omblepy")
-parser.add_argument("-w", "--windowsize", type=int, default="7", help="size of the viewing plot x axis window")
-parser.add_argument("-b", "--binsize", type=int, default="1", help="number of days over which the measurements are combined and averaged")
-parser.add_argument("inputfile", type=str, help="path to the input csv file")
-args = parser.parse_args()
-
-daysInOneBin = args.binsize
-dateWindowLengthInDays = args.windowsize
-inputpath = args.inputfile.strip("'").strip('\"')
-
-date1 = []
-dia1 = []
-sys1 = []
-with open(inputpath, mode='r', newline='', encoding='utf-8') as infile:
-    reader = csv.DictReader(infile)
-    for record in reader:
-        date1.append(datetime.strptime(record["datetime"], "%Y-%m-%d %H:%M:%S"))
-        sys1.append(float(record["sys"]))
-        dia1.append(float(record["dia"]))
+def readCsvColumns(inputpath, useCache = True):
+    """Returns (datetime64[s] array, sys array, dia array) of a userN.csv written by omblepy."""
+    records = loadCsvColumns(inputpath, useCache)
+    return records["datetime"], records["sys"].astype(float), records["dia"].astype(float)
 
 
 def gradient_image(ax, extent, direction=0.3, cmap_range=(0, 1), **kwargs):
@@ -39,86 +27,183 @@ def gradient_image(ax, extent, direction=0.3, cmap_range=(0, 1), **kwargs):
                    vmin=0, vmax=1,aspect='auto', **kwargs)
     return im
 
-def averageValuesInBins(dates, dia, sys, timedelta = timedelta(days = 1)):
-    dateDecimated = []
-    diaDecimated = []
-    sysDecimated = []
-    lastDate = datetime(1990, 1, 1).date()
-    for dateIdx, date in enumerate(date1):
-        if(lastDate <= date.date() and date.date() <= lastDate + timedelta):
-            numSameDates += 1
-            sysDecimated[-1] += sys1[dateIdx]
-            diaDecimated[-1] += dia1[dateIdx]
-        else:
-            if(dateIdx != 0):
-                sysDecimated[-1] /= numSameDates #average
-                diaDecimated[-1] /= numSameDates #average
-            numSameDates = 1
-            dateDecimated.append(date.date())
-            sysDecimated.append(sys1[dateIdx])
-            diaDecimated.append(dia1[dateIdx])
-            lastDate = date.date()
-        if(dateIdx == len(date1) - 1):
-            sysDecimated[-1] /= numSameDates #average
-            diaDecimated[-1] /= numSameDates #average
-    return dateDecimated, diaDecimated, sysDecimated
-
-
-dateDecimated, diaDecimated, sysDecimated = averageValuesInBins(date1, dia1, sys1, timedelta(days = daysInOneBin))
-
-heighDecimated = []
-for idx in range(len(diaDecimated)):
-    heighDecimated.append(sysDecimated[idx] - diaDecimated[idx])
+def binWidthInDays(binUnit, daysInOneBin):
+    return {"week": 7, "month": 28}.get(binUnit, daysInOneBin)
 
 def colorPressureRangeBackground(ax, yMin, yMax, alpha):
-    yLim = plt.gca().get_ylim()
+    yLim = ax.get_ylim()
     extYmin = (yMin - yLim[0]) / (yLim[1] - yLim[0])
     extYmax = (yMax - yLim[0]) / (yLim[1] - yLim[0])
     gradient_image(ax, extent=(0, 1, extYmin, extYmax), transform=ax.transAxes, cmap=plt.cm.hsv, cmap_range=(0.35, 0.0), alpha = alpha)
-    
-fig, dataAxes = plt.subplots()
-plt.ylim(60, 180) #needs to be done before colorPressureRangeBackground is run, so that the function knows the graph dimension in y axis
-colorPressureRangeBackground(dataAxes, 70, 110, 0.2)
-colorPressureRangeBackground(dataAxes, 120, 160, 0.2)
-plt.bar(dateDecimated, bottom=diaDecimated, height=heighDecimated, width=daysInOneBin-0.5, color="blue")
-plt.xlim([min(dateDecimated) - timedelta(days = daysInOneBin), max(dateDecimated) + timedelta(days = daysInOneBin)])
-plt.xticks(rotation = 90)
-date_form = DateFormatter("%d.%m.%y")
-dataAxes.xaxis.set_major_formatter(date_form)
-plt.xlabel("time")
-plt.ylabel("blood pressure [mmHg]")
-
-
-#time offset slider
-sliderMaxValue = ((max(dateDecimated) - min(dateDecimated)).days - (dateWindowLengthInDays - 1))
-plt.subplots_adjust(bottom = 0.3)
-if(sliderMaxValue > 0):
-    lastVal = 0
-    def update(val):
-        global dataAxes
-        global dateDecimated
-        global lastVal
-        if(abs(lastVal//1 - val//1)<1):
-            return #speed up, return when no update is neccesary, since matplotlib x axis granularity is only days
-        lastVal = val
-        #add pading left and right of daysInOneBin
-        newXmin = min(dateDecimated) - timedelta(days = daysInOneBin) + timedelta(days = val) 
-        newXmax = min(dateDecimated) + timedelta(days = dateWindowLengthInDays + daysInOneBin - 1) + timedelta(days = val)
-        dataAxes.set_xlim([newXmin, newXmax])
-    axTimeOffset = plt.axes([0.3, 0.0, 0.60, 0.1])
-    print(max(dateDecimated))
-    print(min(dateDecimated))
-
-    timeOffset_slider = Slider(
-        ax=axTimeOffset,
-        label="scroll x-axis [days]",
-        valmin=0,
-        valmax=sliderMaxValue,
-        valinit=sliderMaxValue,
-        orientation="horizontal"
-    )
-    timeOffset_slider.on_changed(update)
-    update(sliderMaxValue)
-
-
-plt.show()
+
+def minMaxDownsample(x, bottom, top, maxBars):
+    """
+    Merge neighbouring bars into groups until at most maxBars remain, a group spans from the lowest bottom
+    to the highest top of its bars. Returns (x of the first bar, bottom, top, x of the last bar) per group.
+    """
+    if len(x) <= maxBars:
+        return x, bottom, top, x
+    groupSize = -(-len(x) // maxBars)
+    groupStarts = numpy.arange(0, len(x), groupSize)
+    groupEnds = numpy.minimum(groupStarts + groupSize, len(x)) - 1
+    return x[groupStarts], numpy.minimum.reduceat(bottom, groupStarts), numpy.maximum.reduceat(top, groupStarts), x[groupEnds]
+
+class downsampledBarView:
+    #draws only the bins of the visible x window and never more bars than the axes has pixel columns / pixelsPerBar,
+    #wider windows show the min/max envelope of the merged bins. All bars are in one collection, so that a
+    #window change is a vertex update and the bars can be blitted while the slider is dragged.
+    def __init__(self, ax, binStartDays, bottoms, tops, barWidthDays, rangeBottoms = None, rangeTops = None, pixelsPerBar = 2):
+        self.ax           = ax
+        self.x            = date2num(binStartDays)
+        self.bottoms      = numpy.asarray(bottoms)
+        self.tops         = numpy.asarray(tops)
+        self.barWidthDays = barWidthDays
+        self.pixelsPerBar = pixelsPerBar
+        self.rangeBottoms = None if rangeBottoms is None else numpy.asarray(rangeBottoms)
+        self.rangeTops    = None if rangeTops is None else numpy.asarray(rangeTops)
+        self.rangeLines   = None
+        if self.rangeBottoms is not None:
+            #lowest dia to highest sys of every bin behind the mean bars
+            self.rangeLines = ax.add_collection(LineCollection([], colors="gray", linewidths=1))
+        self.bars = ax.add_collection(PolyCollection([], facecolors="blue", edgecolors="none"))
+        ax.callbacks.connect("xlim_changed", lambda ax: self.updateWindow())
+
+    def artists(self):
+        return [artist for artist in (self.rangeLines, self.bars) if artist is not None]
+
+    def _visibleSlice(self):
+        xMin, xMax = self.ax.get_xlim()
+        return slice(numpy.searchsorted(self.x, xMin - self.barWidthDays, "left"), numpy.searchsorted(self.x, xMax + self.barWidthDays, "right"))
+
+    def updateWindow(self):
+        visible = self._visibleSlice()
+        maxBars = max(1, int(self.ax.bbox.width / self.pixelsPerBar))
+        xFirst, bottoms, tops, xLast = minMaxDownsample(self.x[visible], self.bottoms[visible], self.tops[visible], maxBars)
+        left  = xFirst - (self.barWidthDays - 0.5) / 2
+        right = xLast + (self.barWidthDays - 0.5) / 2
+        self.bars.set_verts(numpy.stack([
+            numpy.stack([left, bottoms], axis=-1), numpy.stack([left, tops], axis=-1),
+            numpy.stack([right, tops], axis=-1), numpy.stack([right, bottoms], axis=-1)], axis=1))
+        if self.rangeLines is not None:
+            xFirst, rangeBottoms, rangeTops, xLast = minMaxDownsample(self.x[visible], self.rangeBottoms[visible], self.rangeTops[visible], maxBars)
+            xCenter = (xFirst + xLast) / 2
+            self.rangeLines.set_segments(numpy.stack([numpy.stack([xCenter, rangeBottoms], axis=-1), numpy.stack([xCenter, rangeTops], axis=-1)], axis=1))
+
+def plotBins(dataAxes, bins, daysInOneBin, showRange = False):
+    dateDecimated = list(bins["bin_start"].astype(object))
+    dataAxes.set_ylim(60, 180) #needs to be done before colorPressureRangeBackground is run, so that the function knows the graph dimension in y axis
+    colorPressureRangeBackground(dataAxes, 70, 110, 0.2)
+    colorPressureRangeBackground(dataAxes, 120, 160, 0.2)
+    barView = downsampledBarView(dataAxes, bins["bin_start"], bins["dia_mean"], bins["sys_mean"], daysInOneBin,
+                                 rangeBottoms = bins["dia_min"] if showRange else None, rangeTops = bins["sys_max"] if showRange else None)
+    dataAxes.xaxis_date()
+    dataAxes.set_xlim([min(dateDecimated) - timedelta(days = daysInOneBin), max(dateDecimated) + timedelta(days = daysInOneBin)])
+    dataAxes.tick_params(axis="x", labelrotation=90)
+    date_form = DateFormatter("%d.%m.%y")
+    dataAxes.xaxis.set_major_formatter(date_form)
+    dataAxes.set_xlabel("time")
+    dataAxes.set_ylabel("blood pressure [mmHg]")
+    barView.updateWindow()
+    return dateDecimated, barView
+
+class blittedScroller:
+    #redraws only the bars and the slider while the slider is dragged, the axis labels are updated once the mouse is released
+    def __init__(self, fig, ax, animatedArtists, sliderAxes = None):
+        self.fig         = fig
+        self.ax          = ax
+        self.artists     = animatedArtists
+        self.sliderAxes  = sliderAxes     #axes of a Slider created with drawon = False
+        self.backgrounds = None
+        self.dragging    = False
+        for artist in self.artists + ([sliderAxes] if sliderAxes is not None else []):
+            artist.set_animated(True)
+        fig.canvas.mpl_connect("draw_event", self.onDraw)
+        fig.canvas.mpl_connect("button_release_event", self.onRelease)
+
+    def _blitBoxes(self):
+        boxes = [self.ax.bbox]
+        if self.sliderAxes is not None:
+            #label and value text of the slider are left and right of its axes, the whole figure row is blitted
+            boxes.append(Bbox.from_extents(self.fig.bbox.x0, self.sliderAxes.bbox.y0, self.fig.bbox.x1, self.sliderAxes.bbox.y1))
+        return boxes
+
+    def _drawAnimated(self):
+        for artist in self.artists:
+            self.ax.draw_artist(artist)
+        if self.sliderAxes is not None:
+            self.fig.draw_artist(self.sliderAxes)
+
+    def onDraw(self, event):
+        #animated artists are skipped by a full draw, save the background and draw them on top of it
+        self.backgrounds = [self.fig.canvas.copy_from_bbox(box) for box in self._blitBoxes()]
+        self._drawAnimated()
+
+    def onRelease(self, event):
+        if self.dragging:
+            self.dragging = False
+            self.fig.canvas.draw_idle()
+
+    def redraw(self):
+        canvas = self.fig.canvas
+        if self.backgrounds is None or not getattr(canvas, "supports_blit", False):
+            canvas.draw_idle()
+            return
+        self.dragging = True
+        for background in self.backgrounds:
+            canvas.restore_region(background)
+        self._drawAnimated()
+        for box in self._blitBoxes():
+            canvas.blit(box)
+
+def main():
+    parser = argparse.ArgumentParser(description="python tool to plot csv recordings from omblepy")
+    parser.add_argument("-w", "--windowsize", type=int, default="7", help="size of the viewing plot x axis window")
+    parser.add_argument("-b", "--binsize", type=int, default="1", help="number of days over which the measurements are combined and averaged")
+    parser.add_argument("--bin", choices=binUnits, default="day", help="calendar unit of the bins, --binsize applies to day bins")
+    parser.add_argument("--showRange", action="store_true", help="draw the min dia to max sys range of every bin")
+    parser.add_argument("--noCache", action="store_true", help="parse the csv without reading or writing the .npy column cache next to it")
+    parser.add_argument("inputfile", type=str, help="path to the input csv file")
+    args = parser.parse_args()
+
+    daysInOneBin = binWidthInDays(args.bin, args.binsize)
+    dateWindowLengthInDays = args.windowsize
+    inputpath = args.inputfile.strip("'").strip('\"')
+
+    dates, sys, dia = readCsvColumns(inputpath, useCache = not args.noCache)
+    bins = binRecords(dates, {"dia": dia, "sys": sys}, binUnit = args.bin, binSizeDays = args.binsize)
+
+    fig, dataAxes = plt.subplots()
+    dateDecimated, barView = plotBins(dataAxes, bins, daysInOneBin, args.showRange)
+
+    #time offset slider
+    sliderMaxValue = ((max(dateDecimated) - min(dateDecimated)).days - (dateWindowLengthInDays - 1))
+    plt.subplots_adjust(bottom = 0.3)
+    if(sliderMaxValue > 0):
+        axTimeOffset = plt.axes([0.3, 0.0, 0.60, 0.1])
+        print(max(dateDecimated))
+        print(min(dateDecimated))
+
+        timeOffset_slider = Slider(
+            ax=axTimeOffset,
+            label="scroll x-axis [days]",
+            valmin=0,
+            valmax=sliderMaxValue,
+            valinit=sliderMaxValue,
+            orientation="horizontal"
+        )
+        #the slider is drawn by the scroller, a full figure draw per slider step would undo the blitting
+        timeOffset_slider.drawon = False
+        scroller = blittedScroller(fig, dataAxes, barView.artists(), axTimeOffset)
+        def update(val):
+            #add pading left and right of daysInOneBin
+            newXmin = min(dateDecimated) - timedelta(days = daysInOneBin) + timedelta(days = val)
+            newXmax = min(dateDecimated) + timedelta(days = dateWindowLengthInDays + daysInOneBin - 1) + timedelta(days = val)
+            dataAxes.set_xlim([newXmin, newXmax])   #updates the bars of barView
+            scroller.redraw()
+        timeOffset_slider.on_changed(update)
+        update(sliderMaxValue)
+
+    plt.show()
+
+if __name__ == "__main__":
+    main()
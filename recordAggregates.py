@@ -0,0 +1,220 @@
+import asyncio
+import bisect
+import datetime
+import json
+import logging
+import os
+import pathlib
+import tempfile
+import time
+
+logger = logging.getLogger("omblepy")
+
+#statistics per device and user that are updated with every new record of the record store, so that dashboards
+#look them up instead of scanning the history. The journal stays the source of truth: the snapshot remembers the
+#change seq it includes and the changes after it are applied again on startup.
+
+snapshotVersion  = 1
+aggregateUnits   = ("day", "week", "month")
+dayPeriods       = {"morning": range(4, 12), "evening": range(18, 24)}     #hours of the measurements in the period
+aggregateFields  = ("sys", "dia", "bpm")
+rollingDays      = 7
+
+def bucketStart(unit, dtString):
+    """Start day ("YYYY-MM-DD") of the day / week (monday) / month bucket of a "YYYY-MM-DD HH:MM:SS" datetime."""
+    if unit == "month":
+        return dtString[:7] + "-01"
+    if unit == "week":
+        day = datetime.date.fromisoformat(dtString[:10])
+        return (day - datetime.timedelta(days = day.weekday())).isoformat()
+    return dtString[:10]
+
+def emptyAggregate():
+    aggregate = {"count": 0}
+    for field in aggregateFields:
+        aggregate.update({f"{field}_sum": 0, f"{field}_min": None, f"{field}_max": None})
+    return aggregate
+
+def addToAggregate(aggregate, record):
+    aggregate["count"] += 1
+    for field in aggregateFields:
+        value = record[field]
+        aggregate[f"{field}_sum"] += value
+        if aggregate[f"{field}_min"] is None or value < aggregate[f"{field}_min"]:
+            aggregate[f"{field}_min"] = value
+        if aggregate[f"{field}_max"] is None or value > aggregate[f"{field}_max"]:
+            aggregate[f"{field}_max"] = value
+
+def mergeAggregates(aggregates):
+    merged = emptyAggregate()
+    for aggregate in aggregates:
+        if not aggregate["count"]:
+            continue
+        merged["count"] += aggregate["count"]
+        for field in aggregateFields:
+            merged[f"{field}_sum"] += aggregate[f"{field}_sum"]
+            for statistic, pick in (("min", min), ("max", max)):
+                key = f"{field}_{statistic}"
+                merged[key] = aggregate[key] if merged[key] is None else pick(merged[key], aggregate[key])
+    return merged
+
+def summarizeAggregate(aggregate):
+    """{"count", "<field>_mean", "<field>_min", "<field>_max"} of an aggregate, the means are None without records."""
+    summary = {"count": aggregate["count"]}
+    for field in aggregateFields:
+        summary[f"{field}_mean"] = round(aggregate[f"{field}_sum"] / aggregate["count"], 1) if aggregate["count"] else None
+        summary[f"{field}_min"]  = aggregate[f"{field}_min"]
+        summary[f"{field}_max"]  = aggregate[f"{field}_max"]
+    return summary
+
+class aggregateSeries:
+    #aggregates of one unit keyed by bucket start day, the start days are also kept sorted for range lookups.
+    #records mostly arrive in time order, so a new bucket is usually appended at the end of the sorted list
+    def __init__(self, buckets = None):
+        self.buckets = buckets if buckets is not None else dict()
+        self.starts  = sorted(self.buckets)
+
+    def add(self, start, record):
+        aggregate = self.buckets.get(start)
+        if aggregate is None:
+            aggregate = self.buckets[start] = emptyAggregate()
+            if self.starts and start < self.starts[-1]:
+                bisect.insort(self.starts, start)
+            else:
+                self.starts.append(start)
+        addToAggregate(aggregate, record)
+
+    def range(self, fromStart = None, toStart = None):
+        """(start, aggregate) of the buckets with fromStart <= start <= toStart in time order."""
+        lo = 0 if fromStart is None else bisect.bisect_left(self.starts, fromStart)
+        hi = len(self.starts) if toStart is None else bisect.bisect_right(self.starts, toStart)
+        return [(start, self.buckets[start]) for start in self.starts[lo:hi]]
+
+class recordAggregates:
+    def __init__(self, store, snapshotPath = None, snapshotIntervalS = 60.0):
+        self.store             = store
+        self.snapshotPath      = pathlib.Path(snapshotPath) if snapshotPath else store.journalPath.with_name(store.journalPath.name + ".aggregates.json")
+        self.snapshotIntervalS = snapshotIntervalS
+        self.series            = dict()     #(mac, user) -> {unit or period: aggregateSeries}
+        self.appliedSeq        = 0          #change seq of the record store that is included
+        self.lastSnapshotTime  = time.monotonic()
+        self.snapshotTask      = None       #periodic snapshot written in a worker thread
+        self._loadSnapshot()
+        if store.lastSeq > self.appliedSeq:
+            logger.info(f"applying {store.lastSeq - self.appliedSeq} changes after the aggregate snapshot")
+            self.addChanges(store.changes[self.appliedSeq:])
+
+    def _loadSnapshot(self):
+        try:
+            snapshot = json.loads(self.snapshotPath.read_text())
+        except FileNotFoundError:
+            return
+        except ValueError as e:
+            logger.warning(f"ignoring unreadable aggregate snapshot {self.snapshotPath}: {e}")
+            return
+        if snapshot.get("version") != snapshotVersion or snapshot["seq"] > self.store.lastSeq:
+            #other version or written for a different journal, rebuild from the journal
+            return
+        for device in snapshot["devices"]:
+            self.series[(device["mac_address"], device["user"])] = {name: aggregateSeries(buckets) for name, buckets in device["series"].items()}
+        self.appliedSeq = snapshot["seq"]
+
+    def _snapshot(self):
+        #copy of the aggregates, the buckets keep changing while a snapshot is written in a worker thread
+        return {
+            "version": snapshotVersion,
+            "seq": self.appliedSeq,
+            "devices": [{"mac_address": macAddr, "user": user,
+                         "series": {name: {start: dict(aggregate) for start, aggregate in series.buckets.items()} for name, series in seriesByName.items()}}
+                        for (macAddr, user), seriesByName in self.series.items()],
+        }
+
+    def saveSnapshot(self):
+        """Write the aggregates atomically next to the journal, read only stores leave it to the writing process."""
+        if self.store.readOnly:
+            return
+        self._writeSnapshot(self._snapshot())
+        self.lastSnapshotTime = time.monotonic()
+
+    async def saveSnapshotAsync(self):
+        """saveSnapshot with the serialization and the write in a worker thread, only the copy is made on the event loop."""
+        if self.store.readOnly:
+            return
+        self.lastSnapshotTime = time.monotonic()
+        await asyncio.to_thread(self._writeSnapshot, self._snapshot())
+
+    def _writeSnapshot(self, snapshot):
+        try:
+            tmpFile = tempfile.NamedTemporaryFile("w", dir = self.snapshotPath.parent, prefix = self.snapshotPath.name + ".", suffix = ".tmp", delete = False)
+            try:
+                with tmpFile:
+                    json.dump(snapshot, tmpFile)
+                os.replace(tmpFile.name, self.snapshotPath)
+            except BaseException:
+                os.unlink(tmpFile.name)
+                raise
+        except OSError as e:
+            logger.warning(f"could not write the aggregate snapshot {self.snapshotPath}: {e}")
+
+    def addChanges(self, changes):
+        """Record store listener, constant work per new record."""
+        for change in changes:
+            if change["seq"] <= self.appliedSeq:
+                continue
+            seriesByName = self.series.setdefault((change["mac_address"], change["user"]), dict())
+            record = change["record"]
+            dtString = record["datetime"]
+            for unit in aggregateUnits:
+                seriesByName.setdefault(unit, aggregateSeries()).add(bucketStart(unit, dtString), record)
+            hour = int(dtString[11:13])
+            for period, hours in dayPeriods.items():
+                if hour in hours:
+                    seriesByName.setdefault(period, aggregateSeries()).add(dtString[:10], record)
+            self.appliedSeq = change["seq"]
+        if time.monotonic() - self.lastSnapshotTime >= self.snapshotIntervalS and (self.snapshotTask is None or self.snapshotTask.done()):
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                #no event loop, e.g. the journal is replayed on startup
+                self.saveSnapshot()
+            else:
+                self.snapshotTask = loop.create_task(self.saveSnapshotAsync())
+
+    def devices(self):
+        return sorted(self.series)
+
+    def buckets(self, macAddr, user, unit, fromDay = None, toDay = None):
+        """Summaries of the unit (day / week / month / morning / evening) buckets starting between fromDay and toDay."""
+        series = self.series.get((macAddr.upper(), user), dict()).get(unit)
+        if series is None:
+            return []
+        if fromDay is not None and unit in aggregateUnits:
+            #the bucket containing fromDay starts before it
+            fromDay = bucketStart(unit, fromDay)
+        return [{"bucket_start": start, **summarizeAggregate(aggregate)} for start, aggregate in series.range(fromDay, toDay)]
+
+    def rolling(self, macAddr, user, lastDay, name = "day", days = rollingDays):
+        """Merged aggregate of the days lastDay - days + 1 to lastDay, at most days lookups."""
+        series = self.series.get((macAddr.upper(), user), dict()).get(name)
+        if series is None:
+            return emptyAggregate()
+        firstDay = (datetime.date.fromisoformat(lastDay) - datetime.timedelta(days = days - 1)).isoformat()
+        return mergeAggregates(aggregate for _, aggregate in series.range(firstDay, lastDay))
+
+    def summary(self, macAddr, user):
+        """
+        Current statistics of one device user: the latest day, week and month, the rolling 7 day window and the
+        morning and evening measurements of that window. None if there are no records of the user.
+        """
+        seriesByName = self.series.get((macAddr.upper(), user))
+        if seriesByName is None:
+            return None
+        lastDay = seriesByName["day"].starts[-1]
+        summary = {"mac_address": macAddr.upper(), "user": user, "last_day": lastDay, "seq": self.appliedSeq}
+        for unit in aggregateUnits:
+            start = seriesByName[unit].starts[-1]
+            summary[unit] = {"bucket_start": start, **summarizeAggregate(seriesByName[unit].buckets[start])}
+        summary[f"rolling_{rollingDays}d"] = summarizeAggregate(self.rolling(macAddr, user, lastDay))
+        for period in dayPeriods:
+            summary[f"{period}_{rollingDays}d"] = summarizeAggregate(self.rolling(macAddr, user, lastDay, name = period))
+        return summary
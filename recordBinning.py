@@ -0,0 +1,67 @@
+import numpy
+
+#vectorized aggregation of measurements into time bins, used by plotCsv and reusable by the api.
+#timestamps are numpy datetime64 values in device local time, the values of every column are aggregated per bin.
+
+binStatistics = ("mean", "min", "max", "median", "count")
+binUnits      = ("day", "week", "month")
+
+def recordsToArrays(records, fields = ("sys", "dia", "bpm")):
+    """
+    List of record dicts (datetime as datetime or "YYYY-MM-DD HH:MM:SS" string) -> (datetime64[s] array, {field: float array}).
+    """
+    timestamps = numpy.array([record["datetime"] for record in records], dtype = "datetime64[s]")
+    columns = {field: numpy.array([record[field] for record in records], dtype = numpy.float64) for field in fields}
+    return timestamps, columns
+
+def binStarts(timestamps, binUnit = "day", binSizeDays = 1):
+    """
+    Start day (datetime64[D]) of the bin of every timestamp.
+    "day" bins are binSizeDays long and aligned to the first day of the timestamps, "week" bins start on mondays.
+    """
+    days = timestamps.astype("datetime64[D]")
+    if binUnit == "month":
+        return days.astype("datetime64[M]").astype("datetime64[D]")
+    dayNumbers = days.astype(numpy.int64)
+    if binUnit == "week":
+        #1970-01-01 was a thursday
+        return (dayNumbers - (dayNumbers + 3) % 7).astype("datetime64[D]")
+    if binUnit != "day":
+        raise ValueError(f"unsupported bin unit {binUnit}, use one of {binUnits}")
+    if binSizeDays == 1 or len(dayNumbers) == 0:
+        return days
+    firstDay = dayNumbers.min()
+    return (firstDay + (dayNumbers - firstDay) // binSizeDays * binSizeDays).astype("datetime64[D]")
+
+def binRecords(timestamps, columns, binUnit = "day", binSizeDays = 1, statistics = binStatistics):
+    """
+    Aggregate the columns into bins without a python loop over the records.
+    Returns {"bin_start": datetime64[D] array, "count": int array, "<column>_<statistic>": float array},
+    bins without measurements are omitted, the bins are sorted by time.
+    """
+    starts = binStarts(numpy.asarray(timestamps), binUnit, binSizeDays)
+    order = numpy.argsort(starts, kind = "stable")
+    sortedStarts = starts[order]
+    uniqueStarts, firstIndices, counts = numpy.unique(sortedStarts, return_index = True, return_counts = True)
+    result = {"bin_start": uniqueStarts, "count": counts}
+    if len(uniqueStarts) == 0:
+        for name in columns:
+            for statistic in statistics:
+                if statistic != "count":
+                    result[f"{name}_{statistic}"] = numpy.empty(0)
+        return result
+    for name, values in columns.items():
+        sortedValues = numpy.asarray(values, dtype = numpy.float64)[order]
+        if "mean" in statistics:
+            result[f"{name}_mean"] = numpy.add.reduceat(sortedValues, firstIndices) / counts
+        if "min" in statistics:
+            result[f"{name}_min"] = numpy.minimum.reduceat(sortedValues, firstIndices)
+        if "max" in statistics:
+            result[f"{name}_max"] = numpy.maximum.reduceat(sortedValues, firstIndices)
+        if "median" in statistics:
+            #sort the values inside of every bin, then average the one or two middle elements
+            valuesByBin = sortedValues[numpy.lexsort((sortedValues, sortedStarts))]
+            lowerMiddle = valuesByBin[firstIndices + (counts - 1) // 2]
+            upperMiddle = valuesByBin[firstIndices + counts // 2]
+            result[f"{name}_median"] = (lowerMiddle + upperMiddle) / 2
+    return result
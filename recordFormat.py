@@ -0,0 +1,284 @@
+import base64
+import datetime
+import functools
+import gzip
+import hashlib
+import json
+
+from timestampCodec import isTimestampText, parseTimestamp, formatTimestamp, timestampFormat
+
+#optional encoders, formats whose package is missing are not offered in the content negotiation
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+#post-processing of decoded records for the api, the input records (e.g. from the record cache) are never modified
+
+datetimeFormat = timestampFormat
+
+def parseDeviceDatetime(value):
+    """
+    Accepts a datetime or a string in "YYYY-MM-DD HH:MM:SS", ISO or "YYYY/MM/DD HH:MM:SS" format.
+    Raises ValueError for anything else.
+    """
+    if isinstance(value, datetime.datetime):
+        return value
+    if not isinstance(value, str):
+        raise ValueError(f"unsupported datetime type: {type(value)!r}")
+    if isTimestampText(value):
+        return parseTimestamp(value)
+    try:
+        #handles both 'T' and ' ' as separator
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.datetime.strptime(value, "%Y/%m/%d %H:%M:%S")
+    except ValueError:
+        raise ValueError(f"Cannot parse datetime string: {value!r}")
+
+formatDatetime = formatTimestamp
+
+def parseRangeEnd(value):
+    """Inclusive upper bound of a from / to range as "YYYY-MM-DD HH:MM:SS", a date without a time means the end of that day."""
+    if isinstance(value, str):
+        try:
+            day = datetime.date.fromisoformat(value)
+        except ValueError:
+            day = None
+        if day is not None:
+            return formatDatetime(datetime.datetime.combine(day, datetime.time(23, 59, 59)))
+    return formatDatetime(parseDeviceDatetime(value))
+
+@functools.lru_cache(maxsize = 65536)
+def _recordIdFromFields(dtString, sysValue, diaValue, bpmValue):
+    #dtString is formatted by formatDatetime, the id is built from its digits only
+    uniqueStr = f"{dtString[0:4]}{dtString[5:7]}{dtString[8:10]}{dtString[11:13]}{dtString[14:16]}{dtString[17:19]}_{sysValue}_{diaValue}_{bpmValue}"
+    return hashlib.md5(uniqueStr.encode()).hexdigest()[:12]
+
+def recordId(record):
+    """Stable 12 hex character id from datetime, sys, dia and bpm of a record."""
+    return _recordIdFromFields(formatDatetime(parseDeviceDatetime(record["datetime"])), record["sys"], record["dia"], record["bpm"])
+
+def _prepareRecord(dt, record):
+    dtString = formatDatetime(dt)
+    return {**record, "datetime": dtString, "id": _recordIdFromFields(dtString, record["sys"], record["dia"], record["bpm"])}
+
+def prepareRecords(recordsPerUser, newestFirst = True):
+    """
+    Single pass over the records of all users: datetime normalization, id assignment and ordering.
+    Returns new flat record dicts with "id" and the datetime formatted as "YYYY-MM-DD HH:MM:SS",
+    records with the same datetime are ordered by id so that pagination cursors are unambiguous.
+    Unparsable datetimes are replaced with the current time, like the api always did.
+    """
+    preparedRecords = []
+    for userRecords in recordsPerUser:
+        for record in userRecords:
+            try:
+                dt = parseDeviceDatetime(record["datetime"])
+            except ValueError:
+                dt = datetime.datetime.now().replace(microsecond = 0)
+            preparedRecords.append(_prepareRecord(dt, record))
+    #the formatted datetime strings sort in time order
+    preparedRecords.sort(key = lambda record: (record["datetime"], record["id"]), reverse = newestFirst)
+    return preparedRecords
+
+def latestRecord(recordsPerUser):
+    """The newest record of all users prepared like in prepareRecords, None if there are no records."""
+    newest = None
+    for userRecords in recordsPerUser:
+        for record in userRecords:
+            try:
+                dt = parseDeviceDatetime(record["datetime"])
+            except ValueError:
+                dt = datetime.datetime.now().replace(microsecond = 0)
+            if newest is None or dt > newest[0]:
+                newest = (dt, record)
+    if newest is None:
+        return None
+    return _prepareRecord(*newest)
+
+def _jsonDefault(value):
+    if isinstance(value, datetime.datetime):
+        return formatDatetime(value)
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    if isinstance(value, (bytes, bytearray)):
+        return bytes(value).hex()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def dumpsJson(content):
+    """Serialize to utf-8 json bytes, uses orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(content, default = _jsonDefault, option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, default = _jsonDefault, ensure_ascii = False, separators = (",", ":")).encode("utf-8")
+
+
+#bulk record formats, each one carries the same response envelope and the same record fields
+recordFields             = ["id", "datetime", "sys", "dia", "bpm", "mov", "ihb"]
+recordSourceFields       = ["mac_address", "user"]     #optional, records of the record store carry their device and user
+mediaTypeJson            = "application/json"
+mediaTypeColumnarJson    = "application/vnd.omron.columnar+json"
+mediaTypeMsgpack         = "application/msgpack"
+mediaTypeArrow           = "application/vnd.apache.arrow.stream"
+compressionMinBytes      = 1024
+
+def availableMediaTypes():
+    mediaTypes = [mediaTypeJson, mediaTypeColumnarJson]
+    if msgpack is not None:
+        mediaTypes.append(mediaTypeMsgpack)
+    if pyarrow is not None:
+        mediaTypes.append(mediaTypeArrow)
+    return mediaTypes
+
+def _parseQualityList(headerValue):
+    #"a/b;q=0.5, c/d" -> [("a/b", 0.5), ("c/d", 1.0)], in header order
+    entries = []
+    for part in (headerValue or "").split(","):
+        name, *params = [token.strip() for token in part.split(";")]
+        if not name:
+            continue
+        quality = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        entries.append((name.lower(), quality))
+    return entries
+
+def negotiateMediaType(acceptHeader, supported = None):
+    """
+    Best supported record format for an Accept header, json when no header is given, None if nothing acceptable is supported.
+    supported limits the formats for responses that are only available in some of them (default: availableMediaTypes).
+    """
+    if not acceptHeader:
+        return mediaTypeJson
+    supported = availableMediaTypes() if supported is None else supported
+    entries = []        #(format, quality, from a wildcard)
+    for name, quality in _parseQualityList(acceptHeader):
+        if name in ("*/*", "application/*"):
+            entries.append((mediaTypeJson, quality, True))
+        elif name == "application/x-msgpack":
+            entries.append((mediaTypeMsgpack, quality, False))
+        else:
+            entries.append((name, quality, False))
+    #a format named with q=0 is refused, also when a wildcard would select it
+    excluded = {candidate for candidate, quality, fromWildcard in entries if quality <= 0 and not fromWildcard}
+    bestMediaType, bestQuality = None, 0.0
+    for candidate, quality, _ in entries:
+        if candidate in supported and candidate not in excluded and quality > bestQuality:
+            bestMediaType, bestQuality = candidate, quality
+    return bestMediaType
+
+def _columnFields(records):
+    return recordFields + [field for field in recordSourceFields if records and field in records[0]]
+
+def recordsToColumns(records):
+    """Row records -> one list per field."""
+    return {field: [record.get(field) for record in records] for field in _columnFields(records)}
+
+def _arrowRecordsTable(records, envelope):
+    columns = recordsToColumns(records)
+    arrays = [
+        pyarrow.array(columns["id"], type = pyarrow.string()),
+        pyarrow.compute.strptime(pyarrow.array(columns["datetime"], type = pyarrow.string()), format = datetimeFormat, unit = "s"),
+    ] + [pyarrow.array(columns[field], type = pyarrow.int16()) for field in recordFields[2:]]
+    if "mac_address" in columns:
+        arrays += [pyarrow.array(columns["mac_address"], type = pyarrow.string()), pyarrow.array(columns["user"], type = pyarrow.int16())]
+    metadata = {key: dumpsJson(value) for key, value in envelope.items()}
+    return pyarrow.Table.from_arrays(arrays, names = list(columns)).replace_schema_metadata(metadata)
+
+def encodeRecordsBody(content, mediaType, recordsKey = "records"):
+    """
+    Encode a response dict holding prepared records (see prepareRecords) under recordsKey.
+    json keeps one object per record, the other formats store one array per field.
+    """
+    if mediaType == mediaTypeJson:
+        return dumpsJson(content)
+    envelope = {key: value for key, value in content.items() if key != recordsKey}
+    records  = content[recordsKey]
+    if mediaType == mediaTypeArrow:
+        sink = pyarrow.BufferOutputStream()
+        table = _arrowRecordsTable(records, envelope)
+        with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes()
+    columnarContent = {**envelope, "format": "columnar", recordsKey: recordsToColumns(records)}
+    if mediaType == mediaTypeColumnarJson:
+        return dumpsJson(columnarContent)
+    if mediaType == mediaTypeMsgpack:
+        return msgpack.packb(columnarContent, default = _jsonDefault)
+    raise ValueError(f"unsupported media type {mediaType}")
+
+def compressBody(body, acceptEncodingHeader):
+    """Returns (body, content encoding or None), bodies below compressionMinBytes are not compressed."""
+    if len(body) < compressionMinBytes:
+        return body, None
+    qualities = dict(_parseQualityList(acceptEncodingHeader))
+    if brotli is not None and qualities.get("br", 0.0) > 0.0:
+        return brotli.compress(body, quality = 5), "br"
+    if qualities.get("gzip", 0.0) > 0.0:
+        return gzip.compress(body, compresslevel = 5), "gzip"
+    return body, None
+
+
+#conditional requests and cursor pagination, records are expected newest first like prepareRecords returns them
+
+def recordSetEtag(content, mediaType, recordsKey = "records"):
+    """
+    Strong etag of a record response, built from the record ids, the rest of the response dict and the media type.
+    The content encoding is appended by the caller ("<etag>-gzip") because it changes the bytes as well.
+    """
+    digest = hashlib.md5(mediaType.encode())
+    digest.update(dumpsJson({key: value for key, value in content.items() if key != recordsKey}))
+    for record in content[recordsKey]:
+        digest.update(record["id"].encode())
+    return f'"{digest.hexdigest()}"'
+
+def etagWithEncoding(etag, contentEncoding):
+    if contentEncoding is None:
+        return etag
+    return f'{etag[:-1]}-{contentEncoding}"'
+
+def etagMatches(ifNoneMatchHeader, etag):
+    """True if If-None-Match contains etag in any content encoding variant, or is "*"."""
+    if not ifNoneMatchHeader:
+        return False
+    for candidate in ifNoneMatchHeader.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag or any(candidate == etagWithEncoding(etag, encoding) for encoding in ("gzip", "br")):
+            return True
+    return False
+
+def encodeCursor(record, macAddr, user):
+    #records of several devices or users can share datetime and id, their source breaks the tie
+    return base64.urlsafe_b64encode(f"{record['datetime']}|{record['id']}|{macAddr}|{user}".encode()).decode().rstrip("=")
+
+def decodeCursor(cursor):
+    """(datetime, id, mac, user) of a cursor, raises ValueError for cursors that were not created by encodeCursor."""
+    try:
+        dtString, recordIdString, macAddr, userString = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode().split("|")
+        return formatDatetime(parseDeviceDatetime(dtString)), recordIdString, macAddr, int(userString)
+    except Exception:
+        raise ValueError(f"invalid cursor {cursor!r}")
@@ -0,0 +1,183 @@
+import asyncio
+import bisect
+import heapq
+import itertools
+import json
+import logging
+import os
+import pathlib
+
+from recordFormat import prepareRecords, dumpsJson, formatDatetime, parseDeviceDatetime, parseRangeEnd, encodeCursor, decodeCursor
+
+logger = logging.getLogger("omblepy")
+
+class recordStore:
+    #append-only journal of every record read from any device, one json line per new record.
+    #each new record gets the next change sequence number, which is the cursor of the change feed.
+    #a store created with readOnly follows the journal written by another process (see bleBroker.py) instead
+    def __init__(self, journalPath = "records.jsonl", readOnly = False):
+        self.journalPath = pathlib.Path(journalPath)
+        self.readOnly    = readOnly
+        self.journalSize = 0         #bytes of the journal that are indexed, always at a line end
+        self.changes     = []        #change dicts in seq order, changes[i]["seq"] == i + 1
+        self.knownIds    = set()     #(mac, user, record id) already in the journal
+        self.recordIndex = dict()    #(mac, user) -> ([(datetime, id)], [change]), both sorted by record time
+        self.changeEvent = asyncio.Event()
+        self.appendLock  = asyncio.Lock()    #one journal append at a time, the journal stays in seq order
+        self.listeners   = []        #callables receiving the list of new changes, e.g. wsHub.publish
+        self._loadJournal()
+
+    @property
+    def lastSeq(self):
+        return len(self.changes)
+
+    def _loadJournal(self):
+        self._readJournalTail()
+        if not self.readOnly and self.journalPath.exists() and self.journalPath.stat().st_size > self.journalSize:
+            #drop the partial line of an interrupted append, new lines would be glued to it
+            with open(self.journalPath, "r+b") as journalFile:
+                journalFile.truncate(self.journalSize)
+        logger.info(f"loaded {self.lastSeq} records from {self.journalPath}")
+
+    def _readJournalTail(self):
+        #indexes the complete lines appended after journalSize, returns the new changes
+        try:
+            with open(self.journalPath, "rb") as journalFile:
+                journalFile.seek(self.journalSize)
+                tail = journalFile.read()
+        except FileNotFoundError:
+            return []
+        completeLength = tail.rfind(b"\n") + 1
+        newChanges = []
+        for line in tail[:completeLength].splitlines():
+            try:
+                change = json.loads(line)
+            except ValueError:
+                #a crash during an append can leave a partial line
+                logger.warning(f"ignoring unreadable line of {self.journalPath}")
+                continue
+            self._indexChange(change)
+            newChanges.append(change)
+        self.journalSize += completeLength
+        return newChanges
+
+    def _indexChange(self, change):
+        change["seq"] = self.lastSeq + 1
+        self.changes.append(change)
+        self.knownIds.add((change["mac_address"], change["user"], change["record"]["id"]))
+        sortKeys, indexedChanges = self.recordIndex.setdefault((change["mac_address"], change["user"]), ([], []))
+        sortKey = (change["record"]["datetime"], change["record"]["id"])
+        #records of a session are appended in time order, only older records need an insert
+        position = len(sortKeys) if not sortKeys or sortKey >= sortKeys[-1] else bisect.bisect_right(sortKeys, sortKey)
+        sortKeys.insert(position, sortKey)
+        indexedChanges.insert(position, change)
+
+    async def addSession(self, sessionResult):
+        """
+        Append the records of a session result (see bleSession.readDeviceRecords) that are not in the journal yet.
+        Returns the new changes, waiting long-polls and the listeners are notified when there are any.
+        The append and fsync run in a worker thread, the records are indexed once they are on disk.
+        """
+        if self.readOnly:
+            raise RuntimeError(f"{self.journalPath} is opened read only, records are stored by the writing process")
+        if sessionResult.get("records") is None:
+            #pairing sessions read no records
+            return []
+        #shielded, a cancelled caller must not leave records in the journal that are not indexed
+        return await asyncio.shield(self._appendSession(sessionResult))
+
+    def _appendJournal(self, journalLines):
+        self.journalPath.parent.mkdir(parents = True, exist_ok = True)
+        with open(self.journalPath, "ab") as journalFile:
+            journalFile.write(journalLines)
+            journalFile.flush()
+            os.fsync(journalFile.fileno())
+
+    async def _appendSession(self, sessionResult):
+        macAddr = sessionResult["mac_address"].upper()
+        async with self.appendLock:
+            newChanges = []
+            newKeys = set()
+            for userIdx, userRecords in enumerate(sessionResult["records"]):
+                for record in prepareRecords([userRecords], newestFirst = False):
+                    changeKey = (macAddr, userIdx + 1, record["id"])
+                    if changeKey in self.knownIds or changeKey in newKeys:
+                        continue
+                    newKeys.add(changeKey)
+                    newChanges.append({"mac_address": macAddr, "device_name": sessionResult.get("device_name"), "user": userIdx + 1,
+                                       "record": record, "seq": self.lastSeq + len(newChanges) + 1})
+            if not newChanges:
+                return newChanges
+            journalLines = b"".join(dumpsJson(change) + b"\n" for change in newChanges)
+            await asyncio.to_thread(self._appendJournal, journalLines)
+            for change in newChanges:
+                self._indexChange(change)
+            self.journalSize += len(journalLines)
+        logger.info(f"{len(newChanges)} new records of {macAddr} stored, change seq {self.lastSeq}")
+        self._notify(newChanges)
+        return newChanges
+
+    def _notify(self, newChanges):
+        #wake up every waiter of the current event, later waiters use a fresh one
+        self.changeEvent.set()
+        self.changeEvent = asyncio.Event()
+        for listener in self.listeners:
+            try:
+                listener(newChanges)
+            except Exception as e:
+                logger.warning(f"record store listener {listener!r} failed: {e}")
+
+    async def followJournal(self, intervalS = 0.5):
+        """Read only stores: index and announce the records appended by the writing process, runs until cancelled."""
+        while True:
+            newChanges = self._readJournalTail()
+            if newChanges:
+                self._notify(newChanges)
+            await asyncio.sleep(intervalS)
+
+    def changesSince(self, since, limit = 500):
+        """Returns (changes with seq > since, next cursor), at most limit changes."""
+        if since < 0 or since > self.lastSeq:
+            raise ValueError(f"cursor {since} is outside of the change feed (0 to {self.lastSeq})")
+        page = self.changes[since:since + limit]
+        return page, (page[-1]["seq"] if page else since)
+
+    def queryRecords(self, macAddr = None, user = None, fromDatetime = None, toDatetime = None, limit = 100, cursor = None):
+        """
+        One page of stored records (newest first) of a device and/or user within [fromDatetime, toDatetime], older than
+        cursor (the next cursor of the previous page). Returns (page of changes, next cursor or None).
+        Every matching index is cut with binary searches, the work grows with limit and not with the history.
+        """
+        fromString = formatDatetime(parseDeviceDatetime(fromDatetime)) if fromDatetime is not None else None
+        toString   = parseRangeEnd(toDatetime)                         if toDatetime   is not None else None
+        cursorKey  = decodeCursor(cursor) if cursor is not None else None
+        macAddr    = macAddr.upper() if macAddr is not None else None
+        newestFirstRanges = []
+        for (indexMac, indexUser), (sortKeys, indexedChanges) in self.recordIndex.items():
+            if (macAddr is not None and indexMac != macAddr) or (user is not None and indexUser != user):
+                continue
+            lo = 0 if fromString is None else bisect.bisect_left(sortKeys, fromString, key = lambda sortKey: sortKey[0])
+            hi = len(sortKeys) if toString is None else bisect.bisect_right(sortKeys, toString, key = lambda sortKey: sortKey[0])
+            if cursorKey is not None:
+                #pages are ordered by (datetime, id, mac, user), a record equal to the cursor in datetime and id
+                #is still due if its index sorts before the cursor's one
+                cutBisect = bisect.bisect_right if (indexMac, indexUser) < cursorKey[2:] else bisect.bisect_left
+                hi = min(hi, cutBisect(sortKeys, cursorKey[:2]))
+            #one more than limit tells if there is a next page
+            newestFirstRanges.append(indexedChanges[max(lo, hi - limit - 1):hi][::-1])
+        changeKey = lambda change: (change["record"]["datetime"], change["record"]["id"], change["mac_address"], change["user"])
+        page = list(itertools.islice(heapq.merge(*newestFirstRanges, key = changeKey, reverse = True), limit + 1))
+        if len(page) > limit:
+            page = page[:limit]
+            return page, encodeCursor(page[-1]["record"], page[-1]["mac_address"], page[-1]["user"])
+        return page, None
+
+    async def waitForChanges(self, since, timeoutS):
+        """Wait until there are changes after since or timeoutS passed, returns True if there are changes."""
+        if self.lastSeq > since:
+            return True
+        try:
+            await asyncio.wait_for(self.changeEvent.wait(), timeoutS)
+        except asyncio.TimeoutError:
+            pass
+        return self.lastSeq > since
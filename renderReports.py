@@ -0,0 +1,120 @@
+import matplotlib
+matplotlib.use("Agg")           #headless, must happen before pyplot is imported by plotCsv
+from matplotlib import pyplot as plt
+import argparse
+import concurrent.futures
+import datetime
+import hashlib
+import json
+import os
+import pathlib
+import time
+import terminaltables
+import numpy
+
+from plotCsv import plotBins, binWidthInDays
+from recordBinning import binRecords, binUnits
+from csvColumnCache import loadCsvColumns
+
+#batch rendering of the plotCsv chart for many csv histories, e.g. a weekly report per patient
+
+hashFileName = ".report_hashes.json"    #input path -> content hash of the last rendered report, in the output directory
+
+def collectInputs(paths):
+    inputFiles = []
+    for path in map(pathlib.Path, paths):
+        if path.is_dir():
+            inputFiles.extend(sorted(path.glob("*.csv")))
+        else:
+            inputFiles.append(path)
+    return inputFiles
+
+def contentHash(inputFile, options):
+    digest = hashlib.md5(json.dumps(options, sort_keys = True).encode())
+    with open(inputFile, "rb") as csvFile:
+        for block in iter(lambda: csvFile.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def outputPathFor(inputFile, outputDirectory, outputFormat):
+    #named after the whole path below the current directory (absolute path otherwise): several patients usually
+    #have a user1.csv and their directories can have the same name in different parents, e.g. a/p1 and b/p1
+    inputFile = inputFile.resolve()
+    try:
+        nameParts = inputFile.relative_to(pathlib.Path.cwd()).with_suffix("").parts
+    except ValueError:
+        nameParts = inputFile.with_suffix("").parts[1:]
+    return pathlib.Path(outputDirectory) / f"{'_'.join(nameParts)}.{outputFormat}"
+
+def renderReport(inputFile, outputFile, options):
+    """Render one chart, runs in a worker process. Returns the number of records."""
+    #no column cache, the input directories (e.g. of the patients) are only read
+    records = loadCsvColumns(inputFile, useCache = False)
+    if len(records) == 0:
+        raise ValueError("no records")
+    if options["days"] > 0:
+        records = records[records["datetime"] > records["datetime"].max() - numpy.timedelta64(options["days"], "D")]
+    bins = binRecords(records["datetime"], {"dia": records["dia"], "sys": records["sys"]}, binUnit = options["bin"], binSizeDays = options["binsize"])
+    fig, dataAxes = plt.subplots(figsize = (11.69, 8.27))    #a4 landscape
+    try:
+        plotBins(dataAxes, bins, binWidthInDays(options["bin"], options["binsize"]), options["showRange"])
+        firstDate, lastDate = records["datetime"].min().astype(datetime.datetime), records["datetime"].max().astype(datetime.datetime)
+        dataAxes.set_title(f"{inputFile.parent.name} {inputFile.stem}: {firstDate:%d.%m.%Y} - {lastDate:%d.%m.%Y}, {len(records)} measurements, "
+                           f"mean {records['sys'].mean():.0f}/{records['dia'].mean():.0f} mmHg")
+        fig.tight_layout()
+        fig.savefig(outputFile)
+    finally:
+        plt.close(fig)
+    return len(records)
+
+def main():
+    parser = argparse.ArgumentParser(description="render plotCsv charts of many csv histories without a display")
+    parser.add_argument("inputs", nargs = "+", type = str, help = "csv files or directories containing csv files")
+    parser.add_argument("-o", "--outDir",  type = str, default = "reports",             help = "output directory")
+    parser.add_argument("-f", "--format",  choices = ["png", "pdf", "svg"], default = "png", help = "output file format")
+    parser.add_argument("-d", "--days",    type = int, default = 7,                     help = "only the last DAYS days of every history, 0 for the full history")
+    parser.add_argument("-b", "--binsize", type = int, default = 1,                     help = "number of days over which the measurements are combined and averaged")
+    parser.add_argument("--bin",           choices = binUnits, default = "day",         help = "calendar unit of the bins, --binsize applies to day bins")
+    parser.add_argument("--showRange",     action = "store_true",                       help = "draw the min dia to max sys range of every bin")
+    parser.add_argument("-j", "--jobs",    type = int, default = os.cpu_count(),        help = "worker processes (default: number of cores)")
+    parser.add_argument("--force",         action = "store_true",                       help = "render even if the input did not change since the last run")
+    args = parser.parse_args()
+
+    outputDirectory = pathlib.Path(args.outDir)
+    outputDirectory.mkdir(parents = True, exist_ok = True)
+    hashFile = outputDirectory / hashFileName
+    renderedHashes = json.loads(hashFile.read_text()) if hashFile.exists() else {}
+    options = {"days": args.days, "binsize": args.binsize, "bin": args.bin, "showRange": args.showRange, "format": args.format}
+
+    startTime = time.perf_counter()
+    pendingRenders = dict()             #future -> (input file, content hash)
+    numSkipped = numRendered = numRecords = 0
+    failures = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers = args.jobs) as executor:
+        for inputFile in collectInputs(args.inputs):
+            inputHash = contentHash(inputFile, options)
+            outputFile = outputPathFor(inputFile, outputDirectory, args.format)
+            if not args.force and renderedHashes.get(str(inputFile)) == inputHash and outputFile.exists():
+                numSkipped += 1
+                continue
+            pendingRenders[executor.submit(renderReport, inputFile, outputFile, options)] = (inputFile, inputHash)
+        for future in concurrent.futures.as_completed(pendingRenders):
+            inputFile, inputHash = pendingRenders[future]
+            try:
+                numRecords += future.result()
+                numRendered += 1
+                renderedHashes[str(inputFile)] = inputHash
+            except Exception as e:
+                failures.append([str(inputFile), str(e)])
+    wallTime = time.perf_counter() - startTime
+    hashFile.write_text(json.dumps(renderedHashes, indent = 1, sort_keys = True))
+
+    if failures:
+        print(terminaltables.AsciiTable([["FAILED INPUT", "ERROR"]] + failures).table)
+    print(terminaltables.AsciiTable([
+        ["RENDERED", "SKIPPED", "FAILED", "WALL [s]", "REPORTS/S", "RECORDS/S", "WORKERS"],
+        [numRendered, numSkipped, len(failures), f"{wallTime:.2f}", f"{numRendered / wallTime:.1f}", f"{numRecords / wallTime:.0f}", args.jobs],
+    ]).table)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import asyncio
+import cProfile
+import logging
+import pathlib
+import re
+import time
+import uuid
+
+logger = logging.getLogger("omblepy")
+
+class _slowCallbackCollector(logging.Handler):
+    #collects the "Executing <Handle ...> took x seconds" warnings of the asyncio debug mode
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(self.format(record))
+
+
+class requestProfiler:
+    #opt-in deterministic profiling of single requests, the .prof files can be opened with
+    #snakeviz, flameprof or python -m pstats, only one request is profiled at a time
+    def __init__(self, enabled = False, profileDirectory = "profiles", maxProfiles = 50, slowCallbackS = 0.1):
+        self.enabled          = enabled
+        self.profileDirectory = pathlib.Path(profileDirectory)
+        self.maxProfiles      = maxProfiles
+        self.slowCallbackS    = slowCallbackS
+        self.lock             = asyncio.Lock()
+
+    def isRequested(self, headers, queryParams):
+        if not self.enabled:
+            return False
+        flag = headers.get("x-profile") or queryParams.get("profile") or ""
+        return flag.lower() in ("1", "true", "yes")
+
+    def _pruneProfiles(self):
+        profileFiles = sorted(self.profileDirectory.glob("*.prof"), key = lambda path: path.stat().st_mtime)
+        for profileFile in profileFiles[:max(0, len(profileFiles) - self.maxProfiles)]:
+            profileFile.unlink(missing_ok = True)
+            profileFile.with_suffix(".slow.txt").unlink(missing_ok = True)
+
+    async def profile(self, requestLabel, awaitable):
+        """
+        Await awaitable under cProfile and the asyncio slow callback detection.
+        Returns (result, profile file name), the file name is None when another request is already profiled.
+        """
+        if self.lock.locked():
+            logger.info(f"profiling of {requestLabel} skipped, another request is being profiled")
+            return await awaitable, None
+        async with self.lock:
+            loop = asyncio.get_running_loop()
+            previousDebug, previousSlowCallbackS = loop.get_debug(), loop.slow_callback_duration
+            slowCallbacks = _slowCallbackCollector()
+            asyncioLogger = logging.getLogger("asyncio")
+            asyncioLogger.addHandler(slowCallbacks)
+            loop.set_debug(True)
+            loop.slow_callback_duration = self.slowCallbackS
+            profiler = cProfile.Profile()
+            startTime = time.perf_counter()
+            profiler.enable()
+            try:
+                result = await awaitable
+            finally:
+                profiler.disable()
+                loop.set_debug(previousDebug)
+                loop.slow_callback_duration = previousSlowCallbackS
+                asyncioLogger.removeHandler(slowCallbacks)
+
+            wallTime = time.perf_counter() - startTime
+            safeLabel = re.sub(r"[^A-Za-z0-9]+", "_", requestLabel).strip("_") or "root"
+            profileName = f"{time.strftime('%Y_%m_%d__%H_%M_%S')}_{safeLabel}_{uuid.uuid4().hex[:6]}"
+            self.profileDirectory.mkdir(parents = True, exist_ok = True)
+            profileFile = self.profileDirectory / f"{profileName}.prof"
+            profiler.dump_stats(profileFile)
+            slowCallbackLines = [f"{requestLabel} took {wallTime:.3f} s, slow callback threshold {self.slowCallbackS} s"] + slowCallbacks.messages
+            profileFile.with_suffix(".slow.txt").write_text("\n".join(slowCallbackLines) + "\n")
+            self._pruneProfiles()
+            logger.info(f"profile of {requestLabel} written to {profileFile}")
+            return result, profileFile.name
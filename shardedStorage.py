@@ -0,0 +1,126 @@
+import datetime
+import json
+import logging
+import os
+import pathlib
+import tempfile
+import threading
+
+from omblepy import mergeIntoCsv, readCsv, saveUBPMJson
+from timestampCodec import formatTimestamp
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None        #windows: only the writers of this process are serialized
+
+logger = logging.getLogger("omblepy")
+
+#csv histories sharded by device and user: <root>/<mac>/userN.csv plus ubpm.json of the device, and <root>/manifest.json
+#listing every shard with its record count and time range. Every shard has its own lock, so that the records of
+#different devices are written in parallel (threads or processes) while writes of the same shard are serialized.
+
+manifestVersion = 1
+
+class fileLock:
+    #exclusive lock of a path for the threads of this process and (with fcntl) for other processes
+    _threadLocks = dict()
+    _threadLocksGuard = threading.Lock()
+
+    def __init__(self, path):
+        self.path = pathlib.Path(str(path) + ".lock")
+        with fileLock._threadLocksGuard:
+            self.threadLock = fileLock._threadLocks.setdefault(str(self.path.resolve()), threading.Lock())
+        self.lockFile = None
+
+    def __enter__(self):
+        self.threadLock.acquire()
+        try:
+            if fcntl is not None:
+                self.lockFile = open(self.path, "a")
+                fcntl.flock(self.lockFile.fileno(), fcntl.LOCK_EX)
+        except BaseException:
+            self.threadLock.release()
+            raise
+        return self
+
+    def __exit__(self, *excInfo):
+        if self.lockFile is not None:
+            fcntl.flock(self.lockFile.fileno(), fcntl.LOCK_UN)
+            self.lockFile.close()
+            self.lockFile = None
+        self.threadLock.release()
+
+def shardDirectoryName(macAddr):
+    #":" is not allowed in windows file names
+    return macAddr.upper().replace(":", "-")
+
+class shardedStorage:
+    def __init__(self, rootDirectory = "records"):
+        self.root         = pathlib.Path(rootDirectory)
+        self.manifestPath = self.root / "manifest.json"
+        self.root.mkdir(parents = True, exist_ok = True)
+
+    def shardPath(self, macAddr, user):
+        return self.root / shardDirectoryName(macAddr) / f"user{user}.csv"
+
+    def readManifest(self):
+        """{"version", "shards": {"<MAC>/user<N>": {"mac_address", "user", "path", "records", "first", "last", "updated"}}}"""
+        try:
+            return json.loads(self.manifestPath.read_text())
+        except FileNotFoundError:
+            return {"version": manifestVersion, "shards": dict()}
+
+    def shards(self, macAddr = None):
+        return [shard for shard in self.readManifest()["shards"].values() if macAddr is None or shard["mac_address"] == macAddr.upper()]
+
+    def _updateManifest(self, shardEntries):
+        with fileLock(self.manifestPath):
+            manifest = self.readManifest()
+            for shard in shardEntries:
+                manifest["shards"][f"{shard['mac_address']}/user{shard['user']}"] = shard
+            #unique temp file, without fcntl the manifest lock does not reach other processes
+            tmpFile = tempfile.NamedTemporaryFile("w", dir = self.root, prefix = "manifest.json.", suffix = ".tmp", delete = False)
+            try:
+                with tmpFile:
+                    json.dump(manifest, tmpFile, indent = 1, sort_keys = True)
+                os.replace(tmpFile.name, self.manifestPath)
+            except BaseException:
+                os.unlink(tmpFile.name)
+                raise
+
+    def writeShard(self, macAddr, user, records):
+        """
+        Merge records (datetime as datetime.datetime) into the shard of a device user and update the manifest.
+        Safe to call for different shards from several threads or processes at the same time. Returns the manifest entry.
+        """
+        macAddr = macAddr.upper()
+        shardPath = self.shardPath(macAddr, user)
+        shardPath.parent.mkdir(parents = True, exist_ok = True)
+        with fileLock(shardPath):
+            mergedRecords = mergeIntoCsv(shardPath, records)
+            shard = {
+                "mac_address": macAddr,
+                "user": user,
+                "path": shardPath.relative_to(self.root).as_posix(),
+                "records": len(mergedRecords),
+                "first": mergedRecords[0]["datetime"] if mergedRecords else None,
+                "last": mergedRecords[-1]["datetime"] if mergedRecords else None,
+                "updated": formatTimestamp(datetime.datetime.now()),
+            }
+            #still holding the shard lock, so that the manifest entries of one shard are written in order
+            self._updateManifest([shard])
+        return shard
+
+    def writeDeviceUbpm(self, macAddr):
+        """Rewrite the ubpm.json of a device from all of its user shards."""
+        deviceDirectory = self.root / shardDirectoryName(macAddr)
+        with fileLock(deviceDirectory / "ubpm.json"):
+            allRecords = []
+            for shard in sorted(self.shards(macAddr), key = lambda shard: shard["user"]):
+                while len(allRecords) < shard["user"]:
+                    allRecords.append([])
+                with fileLock(self.root / shard["path"]):
+                    records = readCsv(self.root / shard["path"])
+                allRecords[shard["user"] - 1] = [{**record, "datetime": formatTimestamp(record["datetime"])} for record in records]
+            saveUBPMJson(allRecords, deviceDirectory)
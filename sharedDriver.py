@@ -1,4 +1,6 @@
 import logging
+import time
+from bleMetrics import blePhaseSeconds, recordsReadTotal
 logger = logging.getLogger("omblepy")
 
 class sharedDeviceDriverCode():
@@ -37,7 +39,8 @@ class sharedDeviceDriverCode():
         newUnreadRecordSettings = unreadRecordsSettingsCopy[:4] + resetUnreadRecordsBytes * 2 + unreadRecordsSettingsCopy[8:]
         self.cachedSettingsBytes[slice(*self.settingsUnreadRecordsBytes)] = newUnreadRecordSettings
     
-    async def getRecords(self, btobj, useUnreadCounter, syncTime):
+    async def getRecords(self, btobj, useUnreadCounter, syncTime, progressCallback = None):
+        #progressCallback(bytesRead, bytesTotal) is called after every record block read from the eeprom
         if self.deviceUseLockUnlock:
             await btobj.unlockWithUnlockKey()
         await btobj.startTransmission()
@@ -60,12 +63,24 @@ class sharedDeviceDriverCode():
             
         #read records for all users
         logger.info("start reading data, this can take a while, use debug flag to see progress")
+        blockProgressCallback = None
+        if progressCallback is not None:
+            bytesTotal = sum(readCommand["size"] for userReadCommandsList in allUsersReadCommandsList for readCommand in userReadCommandsList)
+            bytesRead  = 0
+            def blockProgressCallback(blockSize):
+                nonlocal bytesRead
+                bytesRead += blockSize
+                progressCallback(bytesRead, bytesTotal)
+            progressCallback(0, bytesTotal)
+        deviceLabel = getattr(btobj.ble_client, "address", "unknown")
+        decodeSeconds = 0.0
         allUserRecordsList = []
         for userIdx, userReadCommandsList in enumerate(allUsersReadCommandsList):
             userConcatenatedRecordBytes = bytearray()
             for readCommand in userReadCommandsList:
-                userConcatenatedRecordBytes += await btobj.readContinuousEepromData(readCommand["address"], readCommand["size"], self.transmissionBlockSize)
+                userConcatenatedRecordBytes += await btobj.readContinuousEepromData(readCommand["address"], readCommand["size"], self.transmissionBlockSize, blockProgressCallback)
             #seperate the concatenated bytes into individual records
+            decodeStartTime = time.perf_counter()
             perUserAnalyzedRecordsList = []
             for recordStartOffset in range(0, len(userConcatenatedRecordBytes), self.recordByteSize):
                 singleRecordBytes = userConcatenatedRecordBytes[recordStartOffset:recordStartOffset+self.recordByteSize]
@@ -75,7 +90,10 @@ class sharedDeviceDriverCode():
                         perUserAnalyzedRecordsList.append(singleRecordDict)
                     except:
                         logger.warning(f"Error parsing record for user{userIdx+1} at offset {recordStartOffset} data {bytes(singleRecordBytes).hex()}, ignoring this record.")
+            decodeSeconds += time.perf_counter() - decodeStartTime
+            recordsReadTotal.inc(len(perUserAnalyzedRecordsList), device=deviceLabel, user=userIdx+1)
             allUserRecordsList.append(perUserAnalyzedRecordsList)
+        blePhaseSeconds.observe(decodeSeconds, phase="decode")
             
         if(useUnreadCounter):
             self.resetUnreadRecordsCounter()
@@ -0,0 +1,176 @@
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import threading
+import time
+
+from omblepy import appendCsv, saveUBPMJson
+from timestampCodec import parseTimestamp
+
+logger = logging.getLogger("omblepy")
+
+csvFields = ("dia", "sys", "bpm", "mov", "ihb")
+
+class storageWriter:
+    #writes userN.csv / ubpm.json on its own thread, so that the event loop keeps serving ble notifications while
+    #the files are read, backed up and rewritten. Sessions submitted close together are written as one batch:
+    #one read + atomic rewrite per file instead of one per session.
+    #with a shardedStorage the sessions of every device go to their own shards, which are written in parallel
+    def __init__(self, directory = ".", maxPendingSessions = 16, batchDelayS = 0.05, maxBatchSessions = 64, shards = None, shardWriters = 4):
+        self.directory          = directory
+        self.shards             = shards
+        self.shardExecutor      = concurrent.futures.ThreadPoolExecutor(shardWriters, thread_name_prefix = "shardWriter") if shards is not None else None
+        self.maxPendingSessions = maxPendingSessions    #above this waitForCapacity / submitAsync wait
+        self.batchDelayS        = batchDelayS           #how long the first session of a batch waits for more
+        self.maxBatchSessions   = maxBatchSessions
+        self.pending            = collections.deque()   #(mac or None, records per user, future)
+        self.condition          = threading.Condition()
+        self.writing            = 0                     #sessions of the batch that is written right now
+        self.closed             = False
+        self.thread             = threading.Thread(target = self._run, name = "storageWriter", daemon = True)
+        self.thread.start()
+
+    @property
+    def queueDepth(self):
+        """Sessions submitted but not written yet."""
+        with self.condition:
+            return len(self.pending) + self.writing
+
+    @property
+    def isBackpressured(self):
+        return self.queueDepth >= self.maxPendingSessions
+
+    def submit(self, allRecords, macAddr = None):
+        """
+        Queue the records of a session (list of record lists per user, like getRecords returns) for appendCsv and
+        saveUBPMJson, or for the shards of macAddr when the writer has a shardedStorage.
+        Never blocks, returns a concurrent.futures.Future that is done when the batch is on disk.
+        """
+        future = concurrent.futures.Future()
+        #the writer thread formats the datetimes in place, the caller keeps its records
+        records = [[dict(record) for record in userRecords] for userRecords in allRecords]
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("storage writer is closed")
+            self.pending.append((macAddr if self.shards is not None else None, records, future))
+            self.condition.notify_all()
+        return future
+
+    def submitChanges(self, changes):
+        """Record store listener (see recordStore.listeners): queues the new records of the changes per device and user."""
+        recordsByDevice = dict()
+        for change in changes:
+            allRecords = recordsByDevice.setdefault(change["mac_address"], [])
+            while len(allRecords) < change["user"]:
+                allRecords.append([])
+            record = change["record"]
+            allRecords[change["user"] - 1].append({"datetime": parseTimestamp(record["datetime"]), **{field: record.get(field, 0) for field in csvFields}})
+        for macAddr, allRecords in recordsByDevice.items():
+            self.submit(allRecords, macAddr)
+
+    async def waitForCapacity(self, pollIntervalS = 0.05):
+        """Backpressure hook: returns once fewer than maxPendingSessions sessions wait to be written."""
+        while self.isBackpressured:
+            await asyncio.sleep(pollIntervalS)
+
+    async def submitAsync(self, allRecords, macAddr = None):
+        """submit after waiting for capacity, returns when the records are on disk."""
+        await self.waitForCapacity()
+        await asyncio.wrap_future(self.submit(allRecords, macAddr))
+
+    def flush(self, timeoutS = None):
+        """Wait until everything submitted so far is written, returns False on timeout."""
+        deadline = None if timeoutS is None else time.monotonic() + timeoutS
+        with self.condition:
+            while self.pending or self.writing:
+                remainingS = None if deadline is None else deadline - time.monotonic()
+                if remainingS is not None and remainingS <= 0:
+                    return False
+                self.condition.wait(remainingS)
+        return True
+
+    async def flushAsync(self, timeoutS = None):
+        return await asyncio.to_thread(self.flush, timeoutS)
+
+    def close(self, timeoutS = None):
+        """Write the pending sessions and stop the thread."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join(timeoutS)
+        if self.shardExecutor is not None:
+            self.shardExecutor.shutdown()
+
+    async def closeAsync(self, timeoutS = None):
+        await asyncio.to_thread(self.close, timeoutS)
+
+    def _takeBatch(self):
+        with self.condition:
+            while not self.pending and not self.closed:
+                self.condition.wait()
+            if not self.pending:
+                return None
+            #give concurrent syncs a moment to join the batch
+            deadline = time.monotonic() + self.batchDelayS
+            while len(self.pending) < self.maxBatchSessions and not self.closed and time.monotonic() < deadline:
+                self.condition.wait(deadline - time.monotonic())
+            batch = [self.pending.popleft() for _ in range(min(len(self.pending), self.maxBatchSessions))]
+            self.writing = len(batch)
+            return batch
+
+    @staticmethod
+    def _mergeSessions(batch):
+        #{mac or None: one record list per user}, a datetime read by several sessions is taken from the last one like appendCsv does
+        recordsByDevice = dict()
+        for macAddr, allRecords, _ in batch:
+            recordsByUser = recordsByDevice.setdefault(macAddr, [])
+            for userIdx, userRecords in enumerate(allRecords):
+                if userIdx == len(recordsByUser):
+                    recordsByUser.append(dict())
+                for record in userRecords:
+                    recordsByUser[userIdx][record["datetime"]] = record
+        return {macAddr: [list(userRecords.values()) for userRecords in recordsByUser] for macAddr, recordsByUser in recordsByDevice.items()}
+
+    def _writeDevice(self, macAddr, allRecords):
+        for userIdx, userRecords in enumerate(allRecords):
+            if userRecords:
+                self.shards.writeShard(macAddr, userIdx + 1, userRecords)
+        self.shards.writeDeviceUbpm(macAddr)
+
+    def _writeBatch(self, batch):
+        """Returns {mac or None: exception} of the devices that could not be written."""
+        recordsByDevice = self._mergeSessions(batch)
+        flatRecords = recordsByDevice.pop(None, None)
+        #the devices are independent shards, they are written in parallel
+        shardWrites = {macAddr: self.shardExecutor.submit(self._writeDevice, macAddr, allRecords) for macAddr, allRecords in recordsByDevice.items()}
+        errors = dict()
+        if flatRecords is not None:
+            try:
+                appendCsv(flatRecords, self.directory)
+                saveUBPMJson(flatRecords, self.directory)
+            except Exception as e:
+                errors[None] = e
+        for macAddr, shardWrite in shardWrites.items():
+            if shardWrite.exception() is not None:
+                errors[macAddr] = shardWrite.exception()
+        return errors
+
+    def _run(self):
+        while True:
+            batch = self._takeBatch()
+            if batch is None:
+                return
+            startTime = time.perf_counter()
+            errors = self._writeBatch(batch)
+            for macAddr, error in errors.items():
+                logger.error(f"storing the records of {macAddr or self.directory} failed: {error}")
+            logger.debug(f"stored {len(batch)} sessions in {time.perf_counter() - startTime:.3f} s")
+            for macAddr, _, future in batch:
+                if macAddr in errors:
+                    future.set_exception(errors[macAddr])
+                else:
+                    future.set_result(None)
+            with self.condition:
+                self.writing = 0
+                self.condition.notify_all()
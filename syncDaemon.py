@@ -0,0 +1,86 @@
+import asyncio
+import logging
+import time
+
+from omblepy import scanForDevicesWithNewData
+from bleSession import readDeviceRecords
+
+logger = logging.getLogger("omblepy")
+
+class recordCache:
+    #decoded records per mac address, the record lists are shared between requests and must not be mutated
+    def __init__(self):
+        self.entries = dict()   #mac -> {"mac_address", "device_name", "records", "fetched_at"}
+
+    def get(self, macAddr, maxAgeS = None):
+        entry = self.entries.get(macAddr.upper())
+        if entry is None:
+            return None
+        if maxAgeS is not None and (time.time() - entry["fetched_at"]) > maxAgeS:
+            return None
+        return entry
+
+    def put(self, sessionResult):
+        entry = dict(sessionResult)
+        entry["fetched_at"] = time.time()
+        self.entries[sessionResult["mac_address"].upper()] = entry
+        return entry
+
+
+class syncDaemon:
+    #refreshes every known device in the background, so that api requests can be answered from the cache,
+    #new records are also appended to the record store (change feed) when one is given
+    def __init__(self, cache, driverClass, intervalS = 300.0, macAddrs = (), store = None):
+        self.cache       = cache
+        self.store       = store
+        self.driverClass = driverClass
+        self.intervalS   = intervalS
+        self.knownMacs   = {macAddr.upper() for macAddr in macAddrs}
+        self.task        = None
+
+    def addDevice(self, macAddr):
+        self.knownMacs.add(macAddr.upper())
+
+    async def syncDevice(self, macAddr):
+        #the full history is cached, unread counters and device time are left untouched
+        sessionResult = await readDeviceRecords(macAddr, self.driverClass)
+        if self.store is not None:
+            await self.store.addSession(sessionResult)
+        return self.cache.put(sessionResult)
+
+    async def cachedRead(self, macAddr, maxAgeS = None):
+        """Read-through access: serve the cached entry unless it is missing or older than maxAgeS."""
+        self.addDevice(macAddr)
+        entry = self.cache.get(macAddr, maxAgeS)
+        if entry is None:
+            entry = await self.syncDevice(macAddr)
+        return entry
+
+    async def run(self):
+        while True:
+            if self.knownMacs:
+                try:
+                    macsToSync = await scanForDevicesWithNewData(sorted(self.knownMacs))
+                except Exception as e:
+                    logger.warning(f"background scan failed: {e}")
+                    macsToSync = []
+                for macAddr in macsToSync:
+                    try:
+                        await self.syncDevice(macAddr)
+                        logger.info(f"background sync of {macAddr} finished")
+                    except Exception as e:
+                        logger.warning(f"background sync of {macAddr} failed: {e}")
+            await asyncio.sleep(self.intervalS)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
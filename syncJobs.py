@@ -0,0 +1,90 @@
+import asyncio
+import logging
+import time
+import uuid
+
+logger = logging.getLogger("omblepy")
+
+class syncJob:
+    def __init__(self, params):
+        self.jobId      = uuid.uuid4().hex
+        self.params     = params
+        self.status     = "pending"     #pending -> running -> done / failed / cancelled
+        self.progress   = {"bytes_read": 0, "bytes_total": None}
+        self.result     = None
+        self.error      = None
+        self.createdAt  = time.time()
+        self.finishedAt = None
+        self.task       = None
+
+    def updateProgress(self, bytesRead, bytesTotal):
+        self.progress = {"bytes_read": bytesRead, "bytes_total": bytesTotal}
+
+    def isFinished(self):
+        return self.status in ("done", "failed", "cancelled")
+
+    def toDict(self):
+        return {
+            "job_id":      self.jobId,
+            "status":      self.status,
+            "params":      self.params,
+            "progress":    self.progress,
+            "result":      self.result,
+            "error":       self.error,
+            "created_at":  self.createdAt,
+            "finished_at": self.finishedAt,
+        }
+
+
+class jobRegistry:
+    #finished jobs are kept for retentionS seconds, at most maxJobs jobs are remembered
+    def __init__(self, retentionS = 3600.0, maxJobs = 1000):
+        self.retentionS = retentionS
+        self.maxJobs    = maxJobs
+        self.jobs       = dict()    #job id -> syncJob, in submission order
+
+    def _prune(self):
+        now = time.time()
+        for jobId, job in list(self.jobs.items()):
+            if job.isFinished() and (now - job.finishedAt) > self.retentionS:
+                del self.jobs[jobId]
+        finishedJobIds = [jobId for jobId, job in self.jobs.items() if job.isFinished()]
+        for jobId in finishedJobIds[:max(0, len(self.jobs) - self.maxJobs)]:
+            del self.jobs[jobId]
+
+    async def _runJob(self, job, runFunction):
+        job.status = "running"
+        try:
+            job.result = await runFunction(job)
+            job.status = "done"
+        except asyncio.CancelledError:
+            job.status = "cancelled"
+        except Exception as e:
+            logger.warning(f"sync job {job.jobId} failed: {e}")
+            job.error  = str(e)
+            job.status = "failed"
+        finally:
+            job.finishedAt = time.time()
+
+    def submit(self, params, runFunction):
+        """Start runFunction(job) as a background task and return the job immediately."""
+        self._prune()
+        job = syncJob(params)
+        job.task = asyncio.create_task(self._runJob(job, runFunction))
+        self.jobs[job.jobId] = job
+        return job
+
+    def get(self, jobId):
+        self._prune()
+        return self.jobs.get(jobId)
+
+    def cancel(self, jobId):
+        job = self.get(jobId)
+        if job is not None and not job.isFinished():
+            job.task.cancel()
+        return job
+
+    def cancelAll(self):
+        for job in self.jobs.values():
+            if not job.isFinished():
+                job.task.cancel()
@@ -0,0 +1,61 @@
+import asyncio
+import unittest
+from unittest import mock
+
+import bleSession
+
+class fakeSessions:
+    #stands in for _runDeviceSession: every session reads for readS seconds, a cancelled one needs cleanupS for its cleanup
+    def __init__(self, readS = 0.5, cleanupS = 0.5):
+        self.readS    = readS
+        self.cleanupS = cleanupS
+        self.started  = 0
+
+    async def __call__(self, macAddr, driverClass, useUnreadCounter, syncTime, pairing, scanTimeoutS, progressCallback):
+        self.started += 1
+        sessionIdx = self.started
+        try:
+            await asyncio.sleep(self.readS / 2)
+            progressCallback(1, 2)
+            await asyncio.sleep(self.readS / 2)
+            return {"mac_address": macAddr, "device_name": "fake", "records": [[]], "session": sessionIdx}
+        except asyncio.CancelledError:
+            #abort transmission and disconnect, shielded like the bounded cleanup of a real session
+            await asyncio.shield(asyncio.sleep(self.cleanupS))
+            raise
+
+class sessionSharingTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        bleSession.inFlightSessions.clear()
+        self.sessions = fakeSessions()
+        patcher = mock.patch.object(bleSession, "_runDeviceSession", self.sessions)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_requestAfterCancelledSessionStartsNewSession(self):
+        firstRequest = asyncio.create_task(bleSession.readDeviceRecords("AA", None))
+        await asyncio.sleep(0.1)
+        firstRequest.cancel()
+        await asyncio.sleep(0.1)
+        #the cancelled session is still cleaning up, the second request must not join it
+        sessionResult = await bleSession.readDeviceRecords("AA", None)
+        self.assertEqual(sessionResult["session"], 2)
+        with self.assertRaises(asyncio.CancelledError):
+            await firstRequest
+
+    async def test_compatibleRequestsShareSession(self):
+        sessionResults = await asyncio.gather(bleSession.readDeviceRecords("AA", None), bleSession.readDeviceRecords("aa", None))
+        self.assertEqual([sessionResult["session"] for sessionResult in sessionResults], [1, 1])
+
+    async def test_departedWaiterGetsNoProgress(self):
+        firstProgress, secondProgress = [], []
+        firstRequest = asyncio.create_task(bleSession.readDeviceRecords("AA", None, progressCallback = lambda *progress: firstProgress.append(progress)))
+        secondRequest = asyncio.create_task(bleSession.readDeviceRecords("AA", None, progressCallback = lambda *progress: secondProgress.append(progress)))
+        await asyncio.sleep(0.1)
+        firstRequest.cancel()
+        await secondRequest
+        self.assertEqual(firstProgress, [])
+        self.assertEqual(secondProgress, [(1, 2)])
+
+if __name__ == "__main__":
+    unittest.main()
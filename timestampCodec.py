@@ -0,0 +1,79 @@
+import datetime
+
+import numpy
+
+#codec for the one timestamp format of the csv files, ubpm export and api: "YYYY-MM-DD HH:MM:SS" (always 19 characters).
+#single values go through the C implementation of datetime.fromisoformat / isoformat instead of strptime / strftime,
+#whole columns are parsed from their digits at fixed offsets with numpy.
+
+timestampFormat = "%Y-%m-%d %H:%M:%S"
+timestampLength = 19
+_separators     = {4: ord("-"), 7: ord("-"), 10: ord(" "), 13: ord(":"), 16: ord(":")}
+
+def isTimestampText(text):
+    """Cheap check of the separators, lets callers with several accepted formats avoid exceptions on the common one."""
+    return len(text) == timestampLength and text[4] == "-" and text[7] == "-" and text[10] == " " and text[13] == ":" and text[16] == ":"
+
+def parseTimestamp(text):
+    """"YYYY-MM-DD HH:MM:SS" -> datetime.datetime, ValueError for any other format."""
+    if not isTimestampText(text):
+        raise ValueError(f"timestamp {text!r} does not match {timestampFormat}")
+    return datetime.datetime.fromisoformat(text)
+
+def formatTimestamp(value):
+    """datetime.datetime -> "YYYY-MM-DD HH:MM:SS", sub-second parts are dropped like strftime(timestampFormat) does."""
+    return value.isoformat(" ", "seconds")
+
+def parseTimestampBytes(buffer, starts):
+    """
+    Timestamps stored at the byte offsets starts of a uint8 buffer -> datetime64[s] array.
+    Raises ValueError when one of them is not in the fixed format.
+    """
+    starts = numpy.asarray(starts, dtype = numpy.int64)
+    if len(starts) == 0:
+        return numpy.empty(0, dtype = "datetime64[s]")
+    if starts.max() + timestampLength > len(buffer):
+        raise ValueError("timestamp exceeds the buffer")
+    characters = buffer[starts[:, None] + numpy.arange(timestampLength)]
+    digitColumns = numpy.array([idx for idx in range(timestampLength) if idx not in _separators])
+    separatorColumns = numpy.array(list(_separators))
+    if (characters[:, separatorColumns] != numpy.array(list(_separators.values()), dtype = numpy.uint8)).any():
+        raise ValueError(f"timestamps do not match {timestampFormat}")
+    digitValues = characters[:, digitColumns].astype(numpy.int64) - ord("0")
+    if ((digitValues < 0) | (digitValues > 9)).any():
+        raise ValueError(f"timestamps do not match {timestampFormat}")
+    #digit columns without separators: YYYY MM DD hh mm ss
+    year   = digitValues[:, 0:4] @ numpy.array([1000, 100, 10, 1])
+    month  = digitValues[:, 4:6] @ numpy.array([10, 1])
+    day    = digitValues[:, 6:8] @ numpy.array([10, 1])
+    hour   = digitValues[:, 8:10] @ numpy.array([10, 1])
+    minute = digitValues[:, 10:12] @ numpy.array([10, 1])
+    second = digitValues[:, 12:14] @ numpy.array([10, 1])
+    if ((month < 1) | (month > 12) | (day < 1) | (hour > 23) | (minute > 59) | (second > 59)).any():
+        raise ValueError("timestamps out of range")
+    months = ((year - 1970) * 12 + month - 1).astype("datetime64[M]")
+    days = months.astype("datetime64[D]") + (day - 1)
+    if (days.astype("datetime64[M]") != months).any():
+        raise ValueError("day out of range for month")
+    return days.astype("datetime64[s]") + (hour * 3600 + minute * 60 + second)
+
+def parseTimestampColumn(texts):
+    """Sequence of "YYYY-MM-DD HH:MM:SS" strings -> datetime64[s] array."""
+    if any(len(text) != timestampLength for text in texts):
+        raise ValueError(f"timestamps do not match {timestampFormat}")
+    joined = "".join(texts).encode("ascii")
+    if len(joined) != len(texts) * timestampLength:
+        raise ValueError(f"timestamps do not match {timestampFormat}")
+    return parseTimestampBytes(numpy.frombuffer(joined, dtype = numpy.uint8), numpy.arange(len(texts)) * timestampLength)
+
+def formatTimestampColumn(timestamps):
+    """datetime64 array -> numpy array of "YYYY-MM-DD HH:MM:SS" strings."""
+    #datetime_as_string returns a wider string dtype than needed for 4 digit years
+    texts = numpy.datetime_as_string(numpy.asarray(timestamps, dtype = "datetime64[s]"), unit = "s").astype(f"<U{timestampLength}")
+    characters = texts.view("<U1").reshape(len(texts), timestampLength)
+    characters[:, 10] = " "
+    return texts
+
+def toDatetimeList(timestamps):
+    """datetime64 array -> list of datetime.datetime."""
+    return numpy.asarray(timestamps, dtype = "datetime64[s]").tolist()
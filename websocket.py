@@ -1,10 +1,22 @@
+async def wait_for_ws_disconnect(websocket: WebSocket):
+    """
+    Menunggu sampai WebSocket client menutup koneksi, pesan lain diabaikan.
+    """
+    while True:
+        message = await websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            return
+        print(f"Client message: {message.get('text')}")
+
 @app.websocket("/ws/bp-data")
 async def connect_and_read_latest_ws(websocket: WebSocket):
     """
     WebSocket untuk pairing dan membaca data pengukuran terbaru dari perangkat Omron.
+    Jika client menutup koneksi selama pembacaan, sesi BLE dibatalkan.
     """
     await websocket.accept()
-    client = None  # Variabel untuk BLE client
+    client_gone = False
+    disconnect_task = None
     try:
         # Terima payload dari WebSocket client
         data = await websocket.receive_json()
@@ -13,69 +25,58 @@ async def connect_and_read_latest_ws(websocket: WebSocket):
         sync_time = data.get("sync_time", False)
         new_records_only = data.get("new_records_only", False)
 
-        # Scan perangkat BLE
-        devices = await BleakScanner.discover()
-        selected_device = next((dev for dev in devices if dev.address == mac_address), None)
-        if not selected_device:
-            await websocket.send_json({"error": "Device not found during scan."})
+        # Scan, koneksi, pairing dan pembacaan dalam satu sesi BLE
+        read_task = asyncio.create_task(ble_backend.readDevice(
+            mac_address,
+            useUnreadCounter=new_records_only,
+            syncTime=sync_time,
+            pairing=pairing,
+        ))
+        disconnect_task = asyncio.create_task(wait_for_ws_disconnect(websocket))
+        await asyncio.wait({read_task, disconnect_task}, return_when=asyncio.FIRST_COMPLETED)
+        if not read_task.done():
+            # Client sudah pergi, hentikan sesi BLE
+            print("WebSocket client disconnected, cancelling BLE session.")
+            client_gone = True
+            read_task.cancel()
+            try:
+                await read_task
+            except asyncio.CancelledError:
+                pass
             return
 
-        client = BleakClient(selected_device.address)
-        print("Device: ", selected_device.address, selected_device.name)
-
-        # Koneksi dan pairing ke perangkat BLE
-        await client.connect()
-        await client.pair(protection_level=2)
-        if not client.is_connected:
-            await websocket.send_json({"error": "Failed to connect to the BLE device."})
+        try:
+            session = read_task.result()
+        except LookupError:
+            await websocket.send_json({"error": "Device not found during scan."})
             return
 
-        # Inisialisasi handler BLE
-        bluetoothTxRxObj = bluetoothTxRxHandler(client)
-        dev_driver = deviceSpecificDriver()
-
         if pairing:
-            # Pairing mode
-            if dev_driver.deviceUseLockUnlock:
-                await bluetoothTxRxObj.writeNewUnlockKey()
-
-            await bluetoothTxRxObj.startTransmission()
-            await bluetoothTxRxObj.endTransmission()
             await websocket.send_json({"message": "Pairing successful."})
+        elif not any(session["records"]):
+            await websocket.send_json({"error": "No records found."})
         else:
-            # Mulai komunikasi data
-            await bluetoothTxRxObj.startTransmission()
-            records = await dev_driver.getRecords(
-                btobj=bluetoothTxRxObj,
-                useUnreadCounter=new_records_only,
-                syncTime=sync_time,
-            )
-            await bluetoothTxRxObj.endTransmission()
-            if not records:
-                await websocket.send_json({"error": "No records found."})
-            else:
-                latest_record = records[-1][-1]
-                await websocket.send_json({
-                    "message": "Newest record read with success.",
-                    "mac_address": selected_device.address,
-                    "device_name": selected_device.name,
-                    "latest_record": latest_record
-                })
+            latest_record = max((rec for per_user in session["records"] for rec in per_user), key=lambda r: r["datetime"])
+            await websocket.send_json({
+                "message": "Newest record read with success.",
+                "mac_address": session["mac_address"],
+                "device_name": session["device_name"],
+                "latest_record": {**latest_record, "datetime": formatTimestamp(latest_record["datetime"])}
+            })
 
         # Tunggu komunikasi tetap terbuka
-        while True:
-            try:
-                # Terima data dari client (kalau ada)
-                client_data = await websocket.receive_text()
-                print(f"Client message: {client_data}")
-            except WebSocketDisconnect:
-                print("WebSocket client disconnected.")
-                break
+        await disconnect_task
+        client_gone = True
+        print("WebSocket client disconnected.")
 
+    except WebSocketDisconnect:
+        client_gone = True
+        print("WebSocket client disconnected.")
     except Exception as e:
         await websocket.send_json({"error": str(e)})
     finally:
-        # Pastikan disconnect BLE
-        if client and client.is_connected:
-            await client.disconnect()
-        await websocket.close()
+        # Sesi BLE sudah diputus oleh readDeviceRecords
+        if disconnect_task is not None and not disconnect_task.done():
+            disconnect_task.cancel()
+        if not client_gone:
+            await websocket.close()
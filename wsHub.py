@@ -0,0 +1,93 @@
+import asyncio
+import logging
+
+from recordFormat import dumpsJson
+
+logger = logging.getLogger("omblepy")
+
+class wsSubscriber:
+    def __init__(self, websocket, macAddrs = (), users = (), maxQueue = 100):
+        self.websocket = websocket
+        self.macAddrs  = {macAddr.upper() for macAddr in macAddrs}     #empty -> every device
+        self.users     = set(users)                                    #empty -> every user
+        self.queue     = asyncio.Queue(maxQueue)
+        self.dropped   = False
+        self.task      = None
+
+    def matches(self, change):
+        return (not self.macAddrs or change["mac_address"] in self.macAddrs) and (not self.users or change["user"] in self.users)
+
+
+class wsHub:
+    #fans out the new records of the record store to every subscribed websocket.
+    #each message is encoded once, subscribers that fall more than maxQueue messages behind are disconnected
+    #instead of slowing down the others, idle connections get a heartbeat every heartbeatS seconds
+    def __init__(self, maxQueue = 100, heartbeatS = 20.0):
+        self.maxQueue    = maxQueue
+        self.heartbeatS  = heartbeatS
+        self.subscribers = set()
+
+    def publish(self, changes):
+        """Record store listener, queues every change for the matching subscribers."""
+        for change in changes:
+            message = None
+            for subscriber in list(self.subscribers):
+                if subscriber.dropped or not subscriber.matches(change):
+                    continue
+                if message is None:
+                    message = dumpsJson({"type": "record", **change}).decode("utf-8")
+                try:
+                    subscriber.queue.put_nowait(message)
+                except asyncio.QueueFull:
+                    logger.warning(f"websocket subscriber is {self.maxQueue} messages behind, disconnecting it")
+                    subscriber.dropped = True
+                    if subscriber.task is not None:
+                        subscriber.task.cancel()
+
+    async def _nextMessage(self, subscriber):
+        #not asyncio.wait_for, it can swallow the cancellation of a dropped subscriber when the get completes at the same time
+        getTask = asyncio.ensure_future(subscriber.queue.get())
+        try:
+            done, _ = await asyncio.wait({getTask}, timeout = self.heartbeatS)
+        finally:
+            getTask.cancel()
+        return getTask.result() if done else '{"type":"heartbeat"}'
+
+    async def _sendLoop(self, subscriber):
+        while True:
+            await subscriber.websocket.send_text(await self._nextMessage(subscriber))
+
+    async def _receiveLoop(self, subscriber):
+        #incoming messages are ignored, only the disconnect is of interest
+        while True:
+            message = await subscriber.websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+
+    async def _serveSubscriber(self, subscriber):
+        sendTask    = asyncio.create_task(self._sendLoop(subscriber))
+        receiveTask = asyncio.create_task(self._receiveLoop(subscriber))
+        try:
+            done, _ = await asyncio.wait({sendTask, receiveTask}, return_when = asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+        finally:
+            sendTask.cancel()
+            receiveTask.cancel()
+            await asyncio.gather(sendTask, receiveTask, return_exceptions = True)
+
+    async def serve(self, websocket, macAddrs = (), users = ()):
+        """Stream new records to an accepted websocket until the client disconnects or is dropped."""
+        subscriber = wsSubscriber(websocket, macAddrs, users, self.maxQueue)
+        subscriber.task = asyncio.create_task(self._serveSubscriber(subscriber))
+        self.subscribers.add(subscriber)
+        logger.info(f"websocket subscribed to devices {sorted(subscriber.macAddrs) or 'all'}, users {sorted(subscriber.users) or 'all'}")
+        try:
+            await subscriber.task
+        except asyncio.CancelledError:
+            if not subscriber.dropped:
+                raise
+            #1013: try again later, the client reconnects and catches up with GET /changes
+            await websocket.close(code = 1013)
+        finally:
+            self.subscribers.discard(subscriber)